@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 from pathlib import Path
 import environ # type: ignore
 import os
+from botocore.config import Config
 
 # Initialize environ
 env = environ.Env(
@@ -49,27 +50,77 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
+    'django.contrib.postgres',
     'application',
     'users',
     'storages',
 ]
 
 MIDDLEWARE = [
+    'application.middleware.MetricsMiddleware',  # Request, SQL, template and storage timings for /metrics
     'django.middleware.security.SecurityMiddleware',
+    'application.middleware.QueryBudgetMiddleware',  # Counts each request's queries against its view's budget
+    'application.middleware.SlowQueryMiddleware',  # Logs slow queries of the busiest views with their plans
     'whitenoise.middleware.WhiteNoiseMiddleware',  # Handles static files in production
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'application.middleware.ViewerContextMiddleware',  # Batch-loads the viewer's memberships/roles/follows
+    'application.middleware.ReplicaMiddleware',  # Sends the marked read-only views to the read replicas
+    'application.middleware.ShardMiddleware',  # Sends a community's content queries to its shard
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# ASGI deployment profile (docker-compose.asgi.yml): gunicorn with uvicorn
+# workers serving SocialHub.asgi, with the read-heavy pages routed to
+# application.async_views
+ASYNC_VIEWS = env.bool('ASYNC_VIEWS', default=False)
+if ASYNC_VIEWS:
+    # WhiteNoise is sync-only and would put every request through a thread
+    # hop; static files come from S3 (STATIC_URL) either way
+    MIDDLEWARE.remove('whitenoise.middleware.WhiteNoiseMiddleware')
+
+# Query budgets (application/query_budgets.py): 'off', 'warn' to log the
+# requests over budget (staging), or 'raise' to make them fail (development)
+QUERY_BUDGET_MODE = env('QUERY_BUDGET_MODE', default='off')
+
+# Request metrics (application/metrics.py), served at /metrics to staff or
+# to requests with "Authorization: Bearer <METRICS_TOKEN>" (the scraper).
+# With METRICS_DIR set, the gunicorn workers add up their metrics there
+METRICS_ENABLED = env.bool('METRICS_ENABLED', default=True)
+METRICS_DIR = env('METRICS_DIR', default='')
+METRICS_FLUSH_SECONDS = env.int('METRICS_FLUSH_SECONDS', default=5)
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
+# Slow query log (application/slow_queries.py): queries of these views that
+# take at least SLOW_QUERY_MS (0 turns it off) are logged with their plan, to
+# the rotating file SLOW_QUERY_LOG when it is set
+SLOW_QUERY_MS = env.int('SLOW_QUERY_MS', default=200)
+SLOW_QUERY_VIEWS = env.list('SLOW_QUERY_VIEWS', default=['home', 'search', 'community_content'])
+SLOW_QUERY_LOG = env('SLOW_QUERY_LOG', default='')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {},
+    'loggers': {},
+}
+if SLOW_QUERY_LOG:
+    LOGGING['handlers']['slow_queries'] = {
+        'class': 'logging.handlers.RotatingFileHandler',
+        'filename': SLOW_QUERY_LOG,
+        'maxBytes': env.int('SLOW_QUERY_LOG_MAX_BYTES', default=10 * 1024 * 1024),
+        'backupCount': env.int('SLOW_QUERY_LOG_BACKUPS', default=5),
+    }
+    LOGGING['loggers']['application.slow_queries'] = {'handlers': ['slow_queries'], 'level': 'WARNING', 'propagate': False}
+
 ROOT_URLCONF = 'SocialHub.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'application.metrics.TimedDjangoTemplates',  # Django templates, with render time recorded
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -79,6 +130,7 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'django.template.context_processors.media',
+                'application.context_processors.fragment_cache',
             ],
         },
     },
@@ -102,6 +154,54 @@ DATABASES = {
     }
 }
 
+# Read replicas of the default database (application.replicas): hosts, each
+# optionally host:port, with the same database name, user and password.
+# Sessions stay on the primary for REPLICA_STICKY_SECONDS after they write
+DATABASE_REPLICAS = []
+for number, replica_host in enumerate(env.list('DB_REPLICA_HOSTS', default=[]), 1):
+    replica_host, _, replica_port = replica_host.partition(':')
+    DATABASES[f'replica{number}'] = dict(
+        DATABASES['default'], HOST=replica_host, PORT=replica_port or DATABASES['default']['PORT'],
+        # Tests read the test database through it rather than creating another
+        TEST={'MIRROR': 'default'},
+    )
+    DATABASE_REPLICAS.append(f'replica{number}')
+REPLICA_STICKY_SECONDS = env.int('REPLICA_STICKY_SECONDS', default=10)
+
+# Community content shards (application.sharding): the default database is
+# the first, DB_SHARD_HOSTS (host[:port], same database name, user and
+# password) add shard1, shard2... Run migrate --database=<alias> on each.
+# New communities go to the least loaded of SHARDS_FOR_NEW_COMMUNITIES;
+# leave a shard out of it to keep it for communities moved there with
+# move_community
+DATABASE_SHARDS = ['default']
+for number, shard_host in enumerate(env.list('DB_SHARD_HOSTS', default=[]), 1):
+    shard_host, _, shard_port = shard_host.partition(':')
+    DATABASES[f'shard{number}'] = dict(DATABASES['default'], HOST=shard_host, PORT=shard_port or DATABASES['default']['PORT'])
+    DATABASE_SHARDS.append(f'shard{number}')
+SHARDS_FOR_NEW_COMMUNITIES = env.list('SHARDS_FOR_NEW_COMMUNITIES', default=DATABASE_SHARDS)
+# Threads per process for the queries home and search send to every shard
+SHARD_FANOUT_WORKERS = env.int('SHARD_FANOUT_WORKERS', default=16)
+DATABASE_ROUTERS = ['application.sharding.ShardRouter', 'application.replicas.ReplicaRouter']
+
+
+# Cache
+# Local memory by default (per process, used in tests); point CACHE_URL at a
+# shared backend in production, e.g. pymemcache://memcached:11211
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
+# Cached template fragments are keyed by object version stamps, so the
+# timeout only bounds how long stale versions linger before eviction
+FRAGMENT_CACHE_TIMEOUT = env.int('FRAGMENT_CACHE_TIMEOUT', default=60 * 60 * 24)
+
+# Live updates (application.live). The in-process broker only reaches streams
+# served by the same process; use application.live.RedisBroker whenever the
+# web and ASGI processes are separate
+LIVE_BROKER = env('LIVE_BROKER', default='application.live.InProcessBroker')
+LIVE_REDIS_URL = env('LIVE_REDIS_URL', default='redis://localhost:6379/0')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -141,6 +241,12 @@ AWS_S3_REGION_NAME = 'eu-north-1'
 AWS_S3_CUSTOM_DOMAIN = f'{AWS_STORAGE_BUCKET_NAME}.s3.{AWS_S3_REGION_NAME}.amazonaws.com'
 AWS_S3_FILE_OVERWRITE = False
 AWS_DEFAULT_ACL = None
+# One pooled client per thread is shared by all storage instances (see
+# application.storage); size the pool for the worker's concurrent uploads
+AWS_S3_CLIENT_CONFIG = Config(
+    max_pool_connections=env.int('AWS_S3_MAX_POOL_CONNECTIONS', default=20),
+    retries={'max_attempts': 3, 'mode': 'standard'},
+)
 
 
 # Static files (CSS, JavaScript, Images)
@@ -154,6 +260,10 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL= f'https://{AWS_S3_CUSTOM_DOMAIN}/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Uploaded images wait here (local disk, shared with the process_images
+# worker) until their variants are generated and stored
+IMAGE_STAGING_ROOT = env('IMAGE_STAGING_ROOT', default=os.path.join(BASE_DIR, 'staging'))
+
 
 
 # Default primary key field type
@@ -167,4 +277,7 @@ CSRF_TRUSTED_ORIGINS = [
     'https://swe573.burakcosar.com',
 ]
 
-DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
\ No newline at end of file
+# Media is content-addressed: identical uploads are stored once and reference
+# counted. application.storage.ContentAddressedFileSystemStorage is the
+# offline equivalent
+DEFAULT_FILE_STORAGE = 'application.storage.ContentAddressedS3Storage'
\ No newline at end of file
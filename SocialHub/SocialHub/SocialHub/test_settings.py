@@ -0,0 +1,60 @@
+"""
+Test settings: SQLite databases, local media storage, the local memory
+cache and the in-process live broker, so the tests need no PostgreSQL, S3 or
+Redis. Used by pytest (pytest.ini), or:
+
+    python manage.py test application --settings=SocialHub.test_settings
+"""
+
+import os
+import tempfile
+
+# settings.py reads these from the environment (.env)
+for name, value in {
+    'SECRET_KEY': 'tests',
+    'DEBUG': 'False',
+    'ALLOWED_HOSTS': 'testserver,localhost',
+    'DB_NAME': 'socialhub',
+    'DB_USER': '',
+    'DB_PASSWORD': '',
+    'DB_HOST': '',
+    'DB_PORT': '',
+}.items():
+    os.environ.setdefault(name, value)
+
+from .settings import *  # noqa: E402,F401,F403
+
+TEST_ROOT = os.path.join(tempfile.gettempdir(), 'socialhub-tests')
+
+# The primary, and a replica that reads the primary's test database
+# (application.replicas). DATABASE_REPLICAS is empty so only the tests that
+# switch it on with override_settings read through replica1.
+# shard1 and shard2 stand in for community shards (application.sharding),
+# used by the tests that list them in DATABASE_SHARDS
+DATABASES = {
+    'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(TEST_ROOT, 'default.sqlite3')},
+    'replica1': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(TEST_ROOT, 'default.sqlite3'),
+                 'TEST': {'MIRROR': 'default'}},
+    'shard1': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(TEST_ROOT, 'shard1.sqlite3')},
+    'shard2': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(TEST_ROOT, 'shard2.sqlite3')},
+}
+DATABASE_REPLICAS = []
+DATABASE_SHARDS = ['default']
+SHARDS_FOR_NEW_COMMUNITIES = ['default']
+
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+LIVE_BROKER = 'application.live.InProcessBroker'
+
+DEFAULT_FILE_STORAGE = 'application.storage.ContentAddressedFileSystemStorage'
+STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
+STATIC_URL = '/static/'
+MEDIA_URL = '/media/'
+MEDIA_ROOT = os.path.join(TEST_ROOT, 'media')
+IMAGE_STAGING_ROOT = os.path.join(TEST_ROOT, 'staging')
+
+# Going over a query budget fails the test
+QUERY_BUDGET_MODE = 'raise'
+METRICS_DIR = ''
+SLOW_QUERY_MS = 0
+
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class ApplicationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'application'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .sharding import reserve_id_ranges
+        post_migrate.connect(reserve_id_ranges, sender=self)
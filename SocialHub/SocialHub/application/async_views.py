@@ -0,0 +1,205 @@
+import asyncio
+import json
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.contrib.auth.views import redirect_to_login
+from django.http import Http404
+from django.shortcuts import render
+from . import search as search_engine
+from . import sharding
+from . import threads
+from . import views
+from .filtering import filterable_fields, filter_from_query
+from .images import display_image
+from .models import Comment, Community, CommunityMembership, Post
+from .pagination import apaginate
+from .replicas import read_from_replica
+from .timeline import aget_timeline
+
+User = get_user_model()
+
+# ASYNC READ VIEWS
+# Used instead of the views of the same name in views.py when
+# settings.ASYNC_VIEWS is on (uvicorn workers, see docker-compose.asgi.yml).
+# Independent queries are awaited together with asyncio.gather. Django 4.2's
+# async ORM still runs each query through sync_to_async on the request's
+# thread-sensitive executor, so they go to the database one after another;
+# what the worker gains is serving other requests while it waits. Templates
+# are rendered in that executor too, as they may still touch the database
+
+
+def async_login_required(view):
+    # login_required for async views. ViewerContextMiddleware has already
+    # loaded request.user, so reading it here doesn't query
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+async def _render(request, template_name, context=None):
+    return await sync_to_async(render)(request, template_name, context)
+
+
+async def _get_or_404(queryset, **lookup):
+    try:
+        return await queryset.aget(**lookup)
+    except queryset.model.DoesNotExist:
+        raise Http404(f'No {queryset.model._meta.object_name} matches the given query.')
+
+
+async def _list(queryset):
+    return [row async for row in queryset]
+
+
+async def _set(queryset):
+    return {row async for row in queryset}
+
+
+@read_from_replica
+async def home(request):
+    viewer = request.viewer
+    await sync_to_async(viewer.preload)('member_ids')
+    posts, following_posts, communities, trending_communities, followed_communities = await asyncio.gather(
+        sync_to_async(sharding.paginate)(Post.objects.all(), request, related_fields=('community', 'created_by')),
+        aget_timeline(request.user, request, param='following_cursor'),
+        _list(Community.objects.exclude(isPrivate=True).order_by('-member_count', 'id')[:views.POPULAR_COMMUNITIES]),
+        _list(Community.objects.exclude(isPrivate=True).filter(trending_score__gt=0).order_by('-trending_score', 'id')[:views.POPULAR_COMMUNITIES]),
+        _list(Community.objects.filter(id__in=viewer.member_ids).order_by('-member_count', 'id')),
+    )
+    return await _render(request, 'home.html', {'posts': posts, 'following_posts': following_posts, 'communities': communities, 'trending_communities': trending_communities, 'followed_communities': followed_communities})
+
+
+@read_from_replica
+@async_login_required
+async def search(request):
+    searched = (request.POST.get('searched') or request.GET.get('searched') or '').strip()
+    if request.method == "POST" or 'searched' in request.GET:
+        if searched:
+            return await _render(request, 'search.html', {'searched': searched, **await search_engine.asearch(request, searched)})
+        else:
+            return await _render(request, 'search.html', {'error': 'Please enter a search term.'})
+    else:
+        return await _render(request, 'search.html')
+
+
+@read_from_replica
+@async_login_required
+async def community_content(request, community_id):
+    viewer = request.viewer
+    community, filter_fields, _ = await asyncio.gather(
+        _get_or_404(Community.objects.all(), id=community_id),
+        sync_to_async(filterable_fields)(community_id),
+        sync_to_async(viewer.preload)('member_ids', 'admin_ids', 'invited_ids'),
+    )
+    user_is_member = viewer.is_member(community.id)
+    user_is_admin = viewer.is_admin(community.id)
+    is_private = community.isPrivate
+    user_is_invited = viewer.is_invited(community.id)
+
+    # If the community is private and the user is not a member or invited
+    if is_private and not (user_is_member or user_is_invited):
+        return await _render(request, 'error.html')
+
+    sort = 'hot' if request.GET.get('sort') == 'hot' else 'new'
+    ordering = ('-hot_score', '-id') if sort == 'hot' else ('-created_at', '-id')
+    posts, active_filter, filter_error = filter_from_query(sharding.related(community.posts.all(), 'created_by'), filter_fields, request.GET)
+    templates, posts, memberships, member_admin_ids, member_moderator_ids = await asyncio.gather(
+        _list(community.templates.all()),
+        apaginate(posts, request, ordering=ordering),
+        apaginate(
+            CommunityMembership.objects.filter(community=community).select_related('user'),
+            request, param='members_cursor', ordering=('date_joined', 'id'),
+        ),
+        _set(community.admin.values_list('id', flat=True)),
+        _set(community.moderator.values_list('id', flat=True)),
+    )
+
+    return await _render(request, 'community.html', {
+        'community': community,
+        'is_private': is_private,
+        'user_is_member': user_is_member,
+        'user_is_admin': user_is_admin,
+        'user_is_invited': user_is_invited,
+        'templates': templates,
+        'posts': posts,
+        'sort': sort,
+        'filter_fields': filter_fields,
+        'filter_operators': views.FILTER_OPERATORS,
+        'active_filter': active_filter,
+        'filter_error': filter_error,
+        'memberships': memberships,
+        'member_admin_ids': member_admin_ids,
+        'member_moderator_ids': member_moderator_ids,
+    })
+
+
+@read_from_replica
+@async_login_required
+async def list_communities(request):
+    viewer = request.viewer
+    communities, _ = await asyncio.gather(
+        _list(Community.objects.all()),
+        sync_to_async(viewer.preload)('member_ids', 'invited_ids', 'admin_ids'),
+    )
+    communities_data = []
+    for community in communities:
+        communities_data.append({
+            'community': community,
+            'is_member': viewer.is_member(community.id),
+            'is_invited': viewer.is_invited(community.id),
+            'is_admin': viewer.is_admin(community.id),
+        })
+    return await _render(request, 'list_communities.html', {'communities': communities_data})
+
+
+@read_from_replica
+async def view_post(request, community_id, post_id):
+    if request.method == 'POST':
+        # Adding a comment stays on the sync view
+        return await sync_to_async(views.view_post)(request, community_id, post_id)
+    viewer = request.viewer
+    community, post, comments, _ = await asyncio.gather(
+        _get_or_404(Community.objects.all(), pk=community_id),
+        _get_or_404(sharding.related(Post.objects.all(), 'community', 'created_by'), pk=post_id),
+        # Top-level comments only; their replies are loaded by comment_replies
+        apaginate(sharding.related(Comment.objects.filter(post_id=post_id, depth=0), 'user'), request,
+                  ordering=('path',), page_size=threads.THREADS_PER_PAGE),
+        sync_to_async(viewer.preload)('member_ids'),
+    )
+    if isinstance(post.data, str):
+        try:
+            post.data = json.loads(post.data)
+        except json.JSONDecodeError:
+            post.data = {}
+    return await _render(request, 'view_post.html', {
+        'community': community,
+        'post': post,
+        'comments': comments,
+        'form': views.CommentForm(),
+        'user_is_member': viewer.is_member(community.id),
+        'post_image': display_image(post.data),
+    })
+
+
+@read_from_replica
+@async_login_required
+async def view_user(request, user_id):
+    Follow = User.following.through
+    user, memberships, following, followed_by = await asyncio.gather(
+        _get_or_404(User.objects.all(), pk=user_id),
+        _list(CommunityMembership.objects.filter(user_id=user_id).select_related('community')),
+        apaginate(
+            Follow.objects.filter(from_socialhubuser_id=user_id).select_related('to_socialhubuser'),
+            request, param='following_cursor', ordering=('-id',),
+        ),
+        apaginate(
+            Follow.objects.filter(to_socialhubuser_id=user_id).select_related('from_socialhubuser'),
+            request, param='followers_cursor', ordering=('-id',),
+        ),
+    )
+    communities = [membership.community for membership in memberships]
+    return await _render(request, 'view_user.html', {'user': user, 'communities': communities, 'following': following, 'followed_by': followed_by})
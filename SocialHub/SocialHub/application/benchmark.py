@@ -0,0 +1,214 @@
+import time
+from contextlib import contextmanager
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import Client
+from django.urls import reverse
+from .models import Comment, Community, CommunityMembership
+from .query_budgets import QueryCounter, budget_for
+
+# VIEW BENCHMARKS
+# Every URL of application/urls.py and users/urls.py, requested through the
+# test client against seeded data (see application.seeding). Each request
+# runs in a transaction that is rolled back, so views that write (join,
+# follow, comment...) see the same data every time. Reported per route:
+# latency percentiles and the query count, both with a warm fragment cache,
+# plus the query count of the first, cold-cache request
+
+# Form values per template field type for the create_post POST (seeded
+# templates have no image fields)
+SAMPLE_VALUES = {
+    'text': 'Benchmark', 'textArea': 'Benchmark', 'number': '1', 'float': '1.5', 'date': '2024-01-01',
+    'time': '12:00', 'color': '#000000', 'url': 'https://example.com', 'email': 'benchmark@example.com',
+    'phone': '555',
+}
+
+
+def _post_form(template):
+    data = {'title': 'Benchmark post'}
+    for field_name, field_type in template.fields.values_list('field_name', 'field_type'):
+        if field_type == 'geolocation':
+            data.update({f'{field_name}_latitude': '41.0', f'{field_name}_longitude': '29.0'})
+        else:
+            data[field_name] = SAMPLE_VALUES.get(field_type, 'Benchmark')
+    return data
+
+
+# (label, URL name, method, how to build (args, query or form data) from the context)
+ROUTES = [
+    ('home', 'home', 'GET', lambda c: ((), {})),
+    ('search', 'search', 'GET', lambda c: ((), {'searched': c['word']})),
+    ('typeahead', 'typeahead', 'GET', lambda c: ((), {'type': 'users', 'q': c['user'].username[:3]})),
+    ('create_community', 'create_community', 'GET', lambda c: ((), {})),
+    ('create_community POST', 'create_community', 'POST', lambda c: ((), {'name': 'Benchmark community', 'description': 'd'})),
+    ('community_content', 'community_content', 'GET', lambda c: ((c['community'].id,), {})),
+    ('community_content hot', 'community_content', 'GET', lambda c: ((c['community'].id,), {'sort': 'hot'})),
+    ('community_locations', 'community_locations', 'GET', lambda c: ((c['community'].id,), {'bbox': '-90,-180,90,180'})),
+    ('community_events', 'community_events', 'GET', lambda c: ((c['community'].id,), {})),
+    ('join_community', 'join_community', 'GET', lambda c: ((c['other_community'].id,), {})),
+    ('leave_community', 'leave_community', 'GET', lambda c: ((c['community'].id,), {})),
+    ('list_communities', 'list_communities', 'GET', lambda c: ((), {})),
+    ('manage_community', 'manage_community', 'GET', lambda c: ((c['community'].id,), {})),
+    ('import_posts', 'import_posts', 'GET', lambda c: ((c['community'].id,), {})),
+    ('export_community', 'export_community', 'GET', lambda c: ((c['community'].id,), {'format': 'jsonl'})),
+    ('create_template', 'create_template', 'GET', lambda c: ((c['community'].id,), {})),
+    ('create_post', 'create_post', 'GET', lambda c: ((c['community'].id, c['template'].id), {})),
+    ('create_post POST', 'create_post', 'POST', lambda c: ((c['community'].id, c['template'].id), _post_form(c['template']))),
+    ('view_post', 'view_post', 'GET', lambda c: ((c['community'].id, c['post'].id), {})),
+    ('view_post POST', 'view_post', 'POST', lambda c: ((c['community'].id, c['post'].id), {'content': 'Benchmark comment'})),
+    ('comment_replies', 'comment_replies', 'GET', lambda c: ((c['community'].id, c['post'].id, c['comment'].id), {})),
+    ('post_events', 'post_events', 'GET', lambda c: ((c['community'].id, c['post'].id), {})),
+    ('edit_post', 'edit_post', 'GET', lambda c: ((c['community'].id, c['post'].id), {})),
+    ('edit_post POST', 'edit_post', 'POST', lambda c: ((c['community'].id, c['post'].id), {'title': 'Benchmark title'})),
+    ('delete_post', 'delete_post', 'GET', lambda c: ((c['community'].id, c['post'].id), {})),
+    ('delete_post POST', 'delete_post', 'POST', lambda c: ((c['community'].id, c['own_post'].id), {})),
+    ('invite_users', 'invite_users', 'GET', lambda c: ((c['community'].id,), {})),
+    ('add_moderator', 'add_moderator', 'GET', lambda c: ((c['community'].id, c['member'].id), {})),
+    ('remove_moderator', 'remove_moderator', 'GET', lambda c: ((c['community'].id, c['member'].id), {})),
+    ('view_user', 'view_user', 'GET', lambda c: ((c['member'].id,), {})),
+    ('delete_user', 'delete_user', 'GET', lambda c: ((c['user'].id,), {})),
+    ('follow_user', 'follow_user', 'GET', lambda c: ((c['member'].id,), {})),
+    ('unfollow_user', 'unfollow_user', 'GET', lambda c: ((c['member'].id,), {})),
+    ('conduct', 'conduct', 'GET', lambda c: ((), {})),
+    ('metrics', 'metrics', 'GET', lambda c: ((), {})),
+    ('login', 'login', 'GET', lambda c: ((), {})),
+    ('logout', 'logout', 'GET', lambda c: ((), {})),
+    ('register_user', 'register_user', 'GET', lambda c: ((), {})),
+    ('view_profile', 'view_profile', 'GET', lambda c: ((), {})),
+]
+
+
+def benchmark_context():
+    # The objects the routes are pointed at: the busiest public community,
+    # one of its admins (the benchmark user), its most commented post...
+    community = Community.objects.filter(isPrivate=False).order_by('-post_count', 'id').first()
+    if community is None:
+        return None
+    user = community.admin.order_by('id').first()
+    post = community.posts.order_by('-comment_count', 'id').first()
+    member = (CommunityMembership.objects.filter(community=community).exclude(user=user)
+              .select_related('user').order_by('id').first())
+    return {
+        'community': community,
+        'user': user,
+        'member': member.user if member else user,
+        'other_community': Community.objects.filter(isPrivate=False).exclude(members=user).order_by('id').first() or community,
+        'template': community.templates.order_by('id').first(),
+        'post': post,
+        # Only its author may delete a post
+        'own_post': community.posts.filter(created_by=user).order_by('-comment_count', 'id').first() or post,
+        'comment': Comment.objects.filter(post=post, depth=0).order_by('-reply_count', 'id').first() if post else None,
+        'word': (post.title.split() or ['a'])[0] if post else 'a',
+    }
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def _request(client, method, url, data):
+    # (status, seconds, queries), rolled back afterwards
+    counter = QueryCounter()
+    with transaction.atomic():
+        with connection.execute_wrapper(counter):
+            started = time.perf_counter()
+            response = client.post(url, data) if method == 'POST' else client.get(url, data)
+            if response.streaming:
+                for chunk in response.streaming_content:
+                    pass
+            elapsed = time.perf_counter() - started
+        transaction.set_rollback(True)
+    return response.status_code, elapsed, counter.count
+
+
+def run_routes(iterations=20, warmup=3, routes=None):
+    # {label: {'status', 'p50', 'p90', 'p99' (ms), 'queries', 'cold_queries'}}
+    context = benchmark_context()
+    if context is None or context['post'] is None:
+        raise ValueError('Nothing to benchmark: seed the database first')
+    results = {}
+    for label, name, method, build in ROUTES:
+        if routes and label not in routes:
+            continue
+        args, data = build(context)
+        url = reverse(name, args=args)
+        client = Client()
+        client.force_login(context['user'])
+        cache.clear()
+        status, elapsed, cold_queries = _request(client, method, url, data)
+        durations, counts = [], []
+        for i in range(warmup + iterations):
+            if name == 'logout':
+                client.force_login(context['user'])
+            status, elapsed, queries = _request(client, method, url, data)
+            if i >= warmup:
+                durations.append(elapsed * 1000)
+                counts.append(queries)
+        results[label] = {
+            'status': status,
+            'p50': round(percentile(durations, 0.5), 2),
+            'p90': round(percentile(durations, 0.9), 2),
+            'p99': round(percentile(durations, 0.99), 2),
+            'queries': max(counts),
+            'cold_queries': cold_queries,
+        }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # [(label, message), ...] for the routes that got worse than the baseline:
+    # any extra query, or a p90 more than `tolerance` (a fraction) slower
+    regressions = []
+    for label, result in results.items():
+        before = baseline.get(label)
+        if before is None:
+            continue
+        for key in ('queries', 'cold_queries'):
+            if result[key] > before[key]:
+                regressions.append((label, f'{key} {before[key]} -> {result[key]}'))
+        if result['p90'] > before['p90'] * (1 + tolerance):
+            regressions.append((label, f"p90 {before['p90']}ms -> {result['p90']}ms"))
+    return regressions
+
+
+def over_budget(results):
+    # [(label, queries, budget), ...] for the routes whose warm or cold
+    # query count went over their view's budget
+    requests = {label: (name, method) for label, name, method, build in ROUTES}
+    exceeded = []
+    for label, result in results.items():
+        budget = budget_for(*requests[label])
+        queries = max(result['queries'], result['cold_queries'])
+        if budget is not None and queries > budget:
+            exceeded.append((label, queries, budget))
+    return exceeded
+
+
+class QueryBudgetAssertions:
+    # TestCase mixin: fails the test when requests go over their view's
+    # query budget, one at a time or every route of a benchmark run
+
+    @contextmanager
+    def assertWithinBudget(self, url_name, method='GET'):
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            yield counter
+        budget = budget_for(url_name, method)
+        if budget is not None:
+            self.assertLessEqual(counter.count, budget, f'{method} {url_name} ran {counter.count} queries, over its budget of {budget}')
+
+    def assertRoutesWithinBudget(self, results):
+        exceeded = over_budget(results)
+        self.assertFalse(exceeded, 'Over budget: ' + ', '.join(
+            f'{label} ran {queries} queries (budget {budget})' for label, queries, budget in exceeded
+        ))
+
+
+def uncovered_url_names():
+    # URL names of application/urls.py and users/urls.py missing from ROUTES
+    from application import urls as application_urls
+    from users import urls as users_urls
+
+    names = {pattern.name for module in (application_urls, users_urls) for pattern in module.urlpatterns if pattern.name}
+    return sorted(names - {name for label, name, method, build in ROUTES})
@@ -0,0 +1,53 @@
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from . import sharding
+from .models import Comment, Community, CommunityMembership, Post
+
+BATCH_SIZE = 1000
+
+
+def bump(model, pk, **deltas):
+    # Single UPDATE ... SET field = field + delta, so concurrent writers don't lose counts
+    model.objects.filter(pk=pk).update(**{field: F(field) + delta for field, delta in deltas.items()})
+
+
+def _count_of(model, fk):
+    return Coalesce(Subquery(
+        model.objects.filter(**{fk: OuterRef('pk')}).order_by().values(fk).annotate(n=Count('pk')).values('n')
+    ), 0)
+
+
+def _repair(model, field, actual):
+    drifted = list(model.objects.annotate(actual=actual).exclude(**{field: F('actual')}).values_list('pk', flat=True))
+    for start in range(0, len(drifted), BATCH_SIZE):
+        # Counts are shown inside cached fragments, so repaired rows get a new version too
+        model.objects.filter(pk__in=drifted[start:start + BATCH_SIZE]).update(**{field: actual, 'cache_version': F('cache_version') + 1})
+    return len(drifted)
+
+
+def _repair_post_counts():
+    # Community.post_count when the posts are on several shards: counted on
+    # each one and added up here. A community being moved has its posts on
+    # two shards for a while, so it waits for the next run
+    counted = {}
+    for counts in sharding.fan_out(lambda: list(Post.objects.order_by().values_list('community_id').annotate(n=Count('pk')))):
+        for community_id, count in counts:
+            counted[community_id] = counted.get(community_id, 0) + count
+    drifted = [
+        (pk, counted.get(pk, 0))
+        for pk, stored in Community.objects.filter(moving_to='').values_list('pk', 'post_count').iterator()
+        if stored != counted.get(pk, 0)
+    ]
+    for pk, actual in drifted:
+        Community.objects.filter(pk=pk).update(post_count=actual, cache_version=F('cache_version') + 1)
+    return len(drifted)
+
+
+def reconcile():
+    # Recounts every stored counter and fixes the rows that drifted
+    return {
+        'Community.member_count': _repair(Community, 'member_count', _count_of(CommunityMembership, 'community')),
+        'Community.post_count': (_repair_post_counts() if sharding.enabled()
+                                 else _repair(Community, 'post_count', _count_of(Post, 'community'))),
+        'Post.comment_count': sum(sharding.fan_out(lambda: _repair(Post, 'comment_count', _count_of(Comment, 'post')))),
+    }
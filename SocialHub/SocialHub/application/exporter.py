@@ -0,0 +1,98 @@
+import csv
+import json
+from itertools import islice
+from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
+from . import sharding
+from .models import Comment, Post
+
+User = get_user_model()
+
+# COMMUNITY EXPORT
+# Posts are read through a server-side cursor (.iterator) CHUNK_SIZE at a
+# time, and each chunk's comments are fetched with one query, so memory use
+# is bounded by a chunk no matter how big the community is
+
+CHUNK_SIZE = 1000
+FORMATS = ('jsonl', 'csv')
+CSV_COLUMNS = ['record', 'id', 'post_id', 'title', 'author', 'created_at', 'data', 'content', 'parent_id']
+
+
+def post_batches(community_id, chunk_size=CHUNK_SIZE):
+    # Yields [(post, [comment, ...]), ...] as plain dicts. The community's
+    # shard is named explicitly: the rows are streamed after the request's
+    # middleware has finished. Authors come from the default database, one
+    # query per chunk
+    shard = sharding.shard_of(community_id)
+    posts = (Post.objects.using(shard).filter(community_id=community_id).order_by('id')
+             .values('id', 'title', 'created_by_id', 'created_at', 'data')
+             .iterator(chunk_size=chunk_size))
+    while True:
+        batch = list(islice(posts, chunk_size))
+        if not batch:
+            return
+        comments = {}
+        for comment in (Comment.objects.using(shard).filter(post_id__in=[post['id'] for post in batch])
+                        .order_by('post_id', 'created_at', 'id')
+                        .values('id', 'post_id', 'parent_id', 'user_id', 'created_at', 'content')):
+            comments.setdefault(comment['post_id'], []).append(comment)
+        author_ids = {post['created_by_id'] for post in batch}
+        author_ids.update(comment['user_id'] for post_comments in comments.values() for comment in post_comments)
+        usernames = dict(User.objects.filter(id__in=author_ids).values_list('id', 'username'))
+        for post in batch:
+            post['author'] = usernames.get(post['created_by_id'])
+            for comment in comments.get(post['id'], []):
+                comment['author'] = usernames.get(comment['user_id'])
+        yield [(post, comments.get(post['id'], [])) for post in batch]
+
+
+def _comment_json(comment):
+    return {'id': comment['id'], 'parent_id': comment['parent_id'], 'author': comment['author'],
+            'created_at': comment['created_at'], 'content': comment['content']}
+
+
+def jsonl_lines(community_id, chunk_size=CHUNK_SIZE):
+    # One post per line with its comments nested
+    for batch in post_batches(community_id, chunk_size):
+        yield ''.join(
+            json.dumps({
+                'id': post['id'],
+                'title': post['title'],
+                'author': post['author'],
+                'created_at': post['created_at'],
+                'data': post['data'],
+                'comments': [_comment_json(comment) for comment in comments],
+            }, cls=DjangoJSONEncoder) + '\n'
+            for post, comments in batch
+        )
+
+
+class _Echo:
+    # csv.writer target that hands the formatted line back instead of storing it
+    def write(self, value):
+        return value
+
+
+def csv_lines(community_id, chunk_size=CHUNK_SIZE):
+    # A 'post' row followed by one 'comment' row per comment; data is JSON
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for batch in post_batches(community_id, chunk_size):
+        rows = []
+        for post, comments in batch:
+            rows.append(writer.writerow([
+                'post', post['id'], post['id'], post['title'], post['author'],
+                post['created_at'].isoformat(), json.dumps(post['data'], cls=DjangoJSONEncoder), '', '',
+            ]))
+            for comment in comments:
+                rows.append(writer.writerow([
+                    'comment', comment['id'], comment['post_id'], '', comment['author'],
+                    comment['created_at'].isoformat(), '', comment['content'], comment['parent_id'] or '',
+                ]))
+        yield ''.join(rows)
+
+
+def export_lines(community_id, file_format, chunk_size=CHUNK_SIZE):
+    if file_format == 'csv':
+        return csv_lines(community_id, chunk_size)
+    return jsonl_lines(community_id, chunk_size)
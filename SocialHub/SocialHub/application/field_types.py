@@ -0,0 +1,268 @@
+import threading
+from collections import OrderedDict
+from datetime import date, time
+from django import forms
+
+# FIELD TYPE REGISTRY
+# Each template field type defines, in one place, the form field(s) it
+# renders, how a cleaned value is stored in Post.data and how a stored value
+# is turned back into form initial data
+
+
+class FieldType:
+    name = None
+    label = None
+    # PostFieldValue column this type is indexed into for filtering (None = not filterable)
+    value_column = None
+
+    def form_fields(self, field_name):
+        return {field_name: self.form_field()}
+
+    def form_field(self):
+        raise NotImplementedError
+
+    def serialize(self, field_name, cleaned_data):
+        # Returns the keys to merge into Post.data
+        return {field_name: self.to_json(cleaned_data.get(field_name))}
+
+    def to_json(self, value):
+        return value
+
+    def deserialize(self, field_name, data):
+        # Returns form initial data for a stored Post.data
+        return {field_name: self.from_json(data.get(field_name))}
+
+    def from_json(self, value):
+        return value
+
+    def typed_value(self, value):
+        # Stored Post.data value -> PostFieldValue column value
+        return self.from_json(value)
+
+
+class TextType(FieldType):
+    name, label = 'text', 'Text'
+    value_column = 'text_value'
+
+    def form_field(self):
+        return forms.CharField(widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Enter text'}))
+
+
+class TextAreaType(FieldType):
+    name, label = 'textArea', 'Text Area'
+
+    def form_field(self):
+        return forms.CharField(widget=forms.Textarea(attrs={'class': 'form-control', 'placeholder': 'Write here'}))
+
+
+class NumberType(FieldType):
+    name, label = 'number', 'Number'
+    value_column = 'number_value'
+
+    def form_field(self):
+        return forms.IntegerField(widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'Enter number'}))
+
+
+class FloatType(FieldType):
+    name, label = 'float', 'Float'
+    value_column = 'number_value'
+
+    def form_field(self):
+        return forms.FloatField(widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'Enter number'}))
+
+
+class DateType(FieldType):
+    name, label = 'date', 'Date'
+    value_column = 'date_value'
+
+    def form_field(self):
+        return forms.DateField(widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'date'}))
+
+    def to_json(self, value):
+        return value.isoformat() if value else value
+
+    def from_json(self, value):
+        return date.fromisoformat(value) if value else value
+
+
+class TimeType(DateType):
+    name, label = 'time', 'Time'
+    value_column = 'time_value'
+
+    def form_field(self):
+        return forms.TimeField(widget=forms.TimeInput(attrs={'class': 'form-control', 'type': 'time'}))
+
+    def from_json(self, value):
+        return time.fromisoformat(value) if value else value
+
+
+class ImageType(FieldType):
+    name, label = 'image', 'Image'
+
+    def form_field(self):
+        return forms.ImageField(widget=forms.FileInput(attrs={'class': 'form-control-file', 'type': 'file'}))
+
+    def serialize(self, field_name, cleaned_data):
+        from .images import stage_upload
+
+        value = cleaned_data.get(field_name)
+        if not value:
+            return {field_name: value}
+        # Only staged locally here; the process_images worker stores the
+        # resized variants and fills in both keys. view_post.html renders the
+        # image from the 'image' key
+        return {'image': None, field_name: None, '_images': {field_name: stage_upload(value)}}
+
+
+class ColorType(FieldType):
+    name, label = 'color', 'Color Picker'
+    value_column = 'text_value'
+
+    def form_field(self):
+        return forms.CharField(widget=forms.TextInput(attrs={'type': 'color', 'class': 'form-control'}))
+
+    def serialize(self, field_name, cleaned_data):
+        value = cleaned_data.get(field_name)
+        if not value:
+            return {field_name: value}
+        # view_post.html renders the swatch from the 'color' key
+        return {'color': value, field_name: value}
+
+
+class URLType(FieldType):
+    name, label = 'url', 'URL'
+    value_column = 'text_value'
+
+    def form_field(self):
+        return forms.URLField(widget=forms.URLInput(attrs={'class': 'form-control', 'placeholder': 'Enter URL'}))
+
+
+class EmailType(FieldType):
+    name, label = 'email', 'Email'
+    value_column = 'text_value'
+
+    def form_field(self):
+        return forms.EmailField(widget=forms.EmailInput(attrs={'class': 'form-control', 'placeholder': 'Enter email'}))
+
+
+class PhoneType(FieldType):
+    name, label = 'phone', 'Phone Number'
+    value_column = 'text_value'
+
+    def form_field(self):
+        return forms.CharField(widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Enter phone number'}))
+
+
+class GeolocationType(FieldType):
+    name, label = 'geolocation', 'Geolocation'
+
+    def form_fields(self, field_name):
+        return {
+            field_name + '_latitude': forms.DecimalField(
+                widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'Latitude'}),
+                max_digits=9,
+                decimal_places=6
+            ),
+            field_name + '_longitude': forms.DecimalField(
+                widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'Longitude'}),
+                max_digits=9,
+                decimal_places=6
+            ),
+        }
+
+    def serialize(self, field_name, cleaned_data):
+        latitude = cleaned_data.get(field_name + '_latitude')
+        longitude = cleaned_data.get(field_name + '_longitude')
+        return {field_name: {
+            'latitude': float(latitude) if latitude else None,
+            'longitude': float(longitude) if longitude else None
+        }}
+
+    def deserialize(self, field_name, data):
+        value = data.get(field_name) or {}
+        return {
+            field_name + '_latitude': value.get('latitude'),
+            field_name + '_longitude': value.get('longitude'),
+        }
+
+
+FIELD_TYPES = OrderedDict((field_type.name, field_type) for field_type in (
+    TextType(), TextAreaType(), NumberType(), FloatType(), DateType(), TimeType(),
+    ImageType(), ColorType(), URLType(), EmailType(), PhoneType(), GeolocationType(),
+))
+
+FIELD_TYPE_CHOICES = [(field_type.name, field_type.label) for field_type in FIELD_TYPES.values()]
+
+
+def get_field_type(name):
+    # Unknown types (e.g. rows created by hand in the admin) behave like text
+    return FIELD_TYPES.get(name, FIELD_TYPES['text'])
+
+
+# COMPILED TEMPLATES
+# Form class and field list per (Template.id, cache_version), kept per
+# process. TemplateField changes bump Template.cache_version (see
+# application.signals), so a stale entry is simply never looked up again
+
+MAX_COMPILED_TEMPLATES = 512
+
+
+class CompiledTemplate:
+    def __init__(self, form_class, fields):
+        self.form_class = form_class
+        self.fields = fields  # [(field_name, field_type), ...]
+
+    def serialize(self, cleaned_data):
+        data = {}
+        for field_name, field_type in self.fields:
+            for key, value in get_field_type(field_type).serialize(field_name, cleaned_data).items():
+                # Private bookkeeping keys ('_images', ...) are shared by every field of a type
+                if key.startswith('_') and isinstance(value, dict):
+                    data.setdefault(key, {}).update(value)
+                else:
+                    data[key] = value
+        return data
+
+    def deserialize(self, data):
+        initial = {}
+        for field_name, field_type in self.fields:
+            initial.update(get_field_type(field_type).deserialize(field_name, data or {}))
+        return initial
+
+
+_compiled = OrderedDict()
+_lock = threading.Lock()
+
+
+def build_form_class(base, fields, name='DynamicPostForm'):
+    attrs = {}
+    for field_name, field_type in fields:
+        attrs.update(get_field_type(field_type).form_fields(field_name))
+    return type(name, (base,), attrs)
+
+
+def compile_template(template):
+    from .forms import DynamicPostForm
+
+    key = (template.pk, template.cache_version)
+    with _lock:
+        compiled = _compiled.get(key)
+        if compiled is not None:
+            _compiled.move_to_end(key)
+            return compiled
+    fields = list(template.fields.order_by('id').values_list('field_name', 'field_type'))
+    compiled = CompiledTemplate(build_form_class(DynamicPostForm, fields, f'Template{template.pk}PostForm'), fields)
+    with _lock:
+        forget_template(template.pk, locked=True)
+        _compiled[key] = compiled
+        while len(_compiled) > MAX_COMPILED_TEMPLATES:
+            _compiled.popitem(last=False)
+    return compiled
+
+
+def forget_template(template_id, locked=False):
+    if not locked:
+        with _lock:
+            return forget_template(template_id, locked=True)
+    for key in [key for key in _compiled if key[0] == template_id]:
+        del _compiled[key]
@@ -0,0 +1,140 @@
+from django.core.exceptions import ValidationError
+from . import sharding
+from .field_types import get_field_type
+from .models import Post, PostFieldValue, TemplateField
+
+BATCH_SIZE = 1000
+TEXT_VALUE_LENGTH = 255
+
+# Operator in the query string -> ORM lookup on the typed column
+OPERATORS = {
+    'eq': 'exact',
+    'gt': 'gt',
+    'gte': 'gte',
+    'lt': 'lt',
+    'lte': 'lte',
+    'between': 'range',
+}
+TEXT_OPERATORS = ('eq',)
+
+
+def _column_value(field_type, value):
+    try:
+        typed = field_type.typed_value(value)
+    except (TypeError, ValueError):
+        return None
+    if field_type.value_column == 'number_value':
+        return float(typed) if isinstance(typed, (int, float)) and not isinstance(typed, bool) else None
+    if field_type.value_column == 'text_value':
+        return typed[:TEXT_VALUE_LENGTH] if isinstance(typed, str) and typed else None
+    return typed
+
+
+def field_value_rows(post, fields):
+    # PostFieldValue rows for the filterable fields of one post
+    rows = []
+    for field_name, type_name in fields:
+        field_type = get_field_type(type_name)
+        if field_type.value_column is None:
+            continue
+        value = _column_value(field_type, (post.data or {}).get(field_name))
+        if value is None:
+            continue
+        rows.append(PostFieldValue(
+            post_id=post.id, community_id=post.community_id,
+            field_name=field_name, field_type=field_type.name,
+            **{field_type.value_column: value},
+        ))
+    return rows
+
+
+def index_field_values(post, fields):
+    # fields: [(field_name, field_type), ...] of the template the post was made from
+    with sharding.atomic():
+        PostFieldValue.objects.filter(post_id=post.id).delete()
+        PostFieldValue.objects.bulk_create(field_value_rows(post, fields))
+
+
+def community_field_types(community_id):
+    # Posts don't keep their template, so a field's type is taken from the
+    # community's templates by name (first definition wins)
+    types = {}
+    for field_name, field_type in (TemplateField.objects.filter(template__community_id=community_id)
+                                   .order_by('id').values_list('field_name', 'field_type')):
+        types.setdefault(field_name, field_type)
+    return types
+
+
+def filterable_fields(community_id):
+    return [
+        (field_name, field_type)
+        for field_name, field_type in community_field_types(community_id).items()
+        if get_field_type(field_type).value_column is not None
+    ]
+
+
+def reindex(batch_size=BATCH_SIZE):
+    # Rebuilds PostFieldValue from Post.data for every post; returns rows written
+    written = 0
+    types_by_community = {}
+    batch = []
+    posts = Post.objects.only('id', 'community_id', 'data').order_by('community_id', 'id')
+    for post in posts.iterator(chunk_size=batch_size):
+        if post.community_id not in types_by_community:
+            types_by_community[post.community_id] = list(community_field_types(post.community_id).items())
+        batch.append(post)
+        if len(batch) >= batch_size:
+            written += _reindex_batch(batch, types_by_community)
+            batch = []
+    if batch:
+        written += _reindex_batch(batch, types_by_community)
+    return written
+
+
+def _reindex_batch(posts, types_by_community):
+    rows = []
+    for post in posts:
+        rows.extend(field_value_rows(post, types_by_community[post.community_id]))
+    with sharding.atomic():
+        PostFieldValue.objects.filter(post_id__in=[post.id for post in posts]).delete()
+        PostFieldValue.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+    return len(rows)
+
+
+def filter_posts(posts, field_name, field_type, operator, value, value_to=None):
+    # Query API: posts whose typed field value matches, answered from the
+    # (community, field_name, <column>) indexes. Values are already typed
+    # (int/float, date, time or str)
+    field_type = get_field_type(field_type)
+    if field_type.value_column is None:
+        raise ValueError(f'{field_type.name} fields cannot be filtered')
+    if operator not in OPERATORS or (field_type.value_column == 'text_value' and operator not in TEXT_OPERATORS):
+        raise ValueError(f'Unsupported operator {operator!r} for {field_type.name} fields')
+    lookup = OPERATORS[operator]
+    target = (value, value_to) if lookup == 'range' else value
+    return posts.filter(**{
+        'field_values__field_name': field_name,
+        f'field_values__{field_type.value_column}__{lookup}': target,
+    })
+
+
+def filter_from_query(posts, fields, querydict):
+    # Applies ?field=&op=&value=[&value_to=] from community_content; fields
+    # comes from filterable_fields(). Returns (posts, active filter or None,
+    # error message or None)
+    field_name = querydict.get('field')
+    if not field_name:
+        return posts, None, None
+    types = dict(fields)
+    if field_name not in types:
+        return posts, None, 'Unknown field.'
+    operator = querydict.get('op', 'eq')
+    form_field = get_field_type(types[field_name]).form_field()
+    try:
+        value = form_field.clean(querydict.get('value'))
+        value_to = form_field.clean(querydict.get('value_to')) if operator == 'between' else None
+        posts = filter_posts(posts, field_name, types[field_name], operator, value, value_to)
+    except (ValidationError, ValueError) as error:
+        message = '; '.join(error.messages) if isinstance(error, ValidationError) else str(error)
+        return posts, None, message
+    return posts, {'field': field_name, 'op': operator, 'value': querydict.get('value'), 'value_to': querydict.get('value_to')}, None
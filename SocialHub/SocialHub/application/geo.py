@@ -0,0 +1,181 @@
+import math
+from django.db.models import FloatField, Q, Value
+from django.db.models.functions import ASin, Cos, Least, Power, Radians, Sin, Sqrt
+from . import sharding
+from .models import Post, PostLocation, TemplateField
+
+BATCH_SIZE = 1000
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+
+# Fixed lat/lng grid: cell = row * CELLS_PER_ROW + column. A box that spans
+# up to MAX_CELLS cells is looked up as an IN list on (community, cell);
+# bigger boxes fall back to the (community, latitude, longitude) index
+CELL_SIZE = 0.1  # degrees, roughly 11 km
+CELLS_PER_ROW = int(360 / CELL_SIZE)
+MAX_CELLS = 400
+
+# k-nearest search starts with this radius and doubles it until it has k hits
+NEAREST_START_KM = 5
+MAX_NEAREST = 100
+
+
+def cell_for(latitude, longitude):
+    row = min(int((latitude + 90) / CELL_SIZE), int(180 / CELL_SIZE) - 1)
+    column = min(int((longitude + 180) / CELL_SIZE), CELLS_PER_ROW - 1)
+    return row * CELLS_PER_ROW + column
+
+
+def valid_point(latitude, longitude):
+    return -90 <= latitude <= 90 and -180 <= longitude <= 180
+
+
+# INDEXING
+
+def _point(value):
+    # Stored geolocation value -> (latitude, longitude) or None
+    if not isinstance(value, dict):
+        return None
+    try:
+        latitude, longitude = float(value['latitude']), float(value['longitude'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (latitude, longitude) if valid_point(latitude, longitude) else None
+
+
+def location_rows(post, fields):
+    rows = []
+    for field_name, field_type in fields:
+        if field_type != 'geolocation':
+            continue
+        point = _point((post.data or {}).get(field_name))
+        if point is None:
+            continue
+        rows.append(PostLocation(
+            post_id=post.id, community_id=post.community_id, field_name=field_name,
+            latitude=point[0], longitude=point[1], cell=cell_for(*point),
+        ))
+    return rows
+
+
+def index_locations(post, fields):
+    # fields: [(field_name, field_type), ...] of the template the post was made from
+    with sharding.atomic():
+        PostLocation.objects.filter(post_id=post.id).delete()
+        PostLocation.objects.bulk_create(location_rows(post, fields))
+
+
+def community_geo_fields(community_id):
+    names = (TemplateField.objects.filter(template__community_id=community_id, field_type='geolocation')
+             .values_list('field_name', flat=True).distinct())
+    return [(name, 'geolocation') for name in names]
+
+
+def reindex(batch_size=BATCH_SIZE):
+    # Rebuilds PostLocation from Post.data for every post; returns rows written
+    written = 0
+    fields_by_community = {}
+    batch = []
+    posts = Post.objects.only('id', 'community_id', 'data').order_by('community_id', 'id')
+    for post in posts.iterator(chunk_size=batch_size):
+        if post.community_id not in fields_by_community:
+            fields_by_community[post.community_id] = community_geo_fields(post.community_id)
+        batch.append(post)
+        if len(batch) >= batch_size:
+            written += _reindex_batch(batch, fields_by_community)
+            batch = []
+    if batch:
+        written += _reindex_batch(batch, fields_by_community)
+    return written
+
+
+def _reindex_batch(posts, fields_by_community):
+    rows = []
+    for post in posts:
+        rows.extend(location_rows(post, fields_by_community[post.community_id]))
+    with sharding.atomic():
+        PostLocation.objects.filter(post_id__in=[post.id for post in posts]).delete()
+        PostLocation.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+    return len(rows)
+
+
+# QUERIES
+
+def _cells(south, west, north, east):
+    # Grid cells covering a box that doesn't cross the antimeridian, or None
+    # when there are too many to list
+    first_row, last_row = cell_for(south, 0) // CELLS_PER_ROW, cell_for(north, 0) // CELLS_PER_ROW
+    first_column, last_column = cell_for(0, west) % CELLS_PER_ROW, cell_for(0, east) % CELLS_PER_ROW
+    if (last_row - first_row + 1) * (last_column - first_column + 1) > MAX_CELLS:
+        return None
+    return [row * CELLS_PER_ROW + column
+            for row in range(first_row, last_row + 1)
+            for column in range(first_column, last_column + 1)]
+
+
+def _box_condition(south, west, north, east):
+    condition = Q(latitude__gte=south, latitude__lte=north, longitude__gte=west, longitude__lte=east)
+    cells = _cells(south, west, north, east)
+    return condition & Q(cell__in=cells) if cells is not None else condition
+
+
+def in_bbox(community_id, south, west, north, east):
+    # Locations inside the box; west > east means the box crosses the antimeridian
+    south, north = max(south, -90), min(north, 90)
+    if west <= east:
+        condition = _box_condition(south, west, north, east)
+    else:
+        condition = _box_condition(south, west, north, 180) | _box_condition(south, -180, north, east)
+    return PostLocation.objects.filter(condition, community_id=community_id)
+
+
+def _radius_bbox(latitude, longitude, radius_km):
+    dlat = radius_km / KM_PER_DEGREE
+    south, north = latitude - dlat, latitude + dlat
+    cos_lat = math.cos(math.radians(max(abs(south), abs(north))))
+    if south <= -90 or north >= 90 or cos_lat <= 0:
+        return max(south, -90), -180, min(north, 90), 180
+    dlng = radius_km / (KM_PER_DEGREE * cos_lat)
+    if dlng >= 180:
+        return south, -180, north, 180
+    west, east = longitude - dlng, longitude + dlng
+    # Wrap into [-180, 180]; in_bbox handles west > east
+    west = west + 360 if west < -180 else west
+    east = east - 360 if east > 180 else east
+    return south, west, north, east
+
+
+def distance_km(latitude, longitude):
+    # Haversine distance from the given point as a database expression
+    lat, lng = math.radians(latitude), math.radians(longitude)
+    half_dlat = (Radians('latitude') - Value(lat)) / 2
+    half_dlng = (Radians('longitude') - Value(lng)) / 2
+    a = Power(Sin(half_dlat), 2) + Value(math.cos(lat)) * Cos(Radians('latitude')) * Power(Sin(half_dlng), 2)
+    return Value(2 * EARTH_RADIUS_KM) * ASin(Sqrt(Least(a, Value(1.0))), output_field=FloatField())
+
+
+def within_radius(community_id, latitude, longitude, radius_km):
+    # Locations within radius_km, nearest first, annotated with distance_km.
+    # The bounding box is the index lookup; the exact great-circle distance
+    # is then only computed for the rows inside it
+    return (in_bbox(community_id, *_radius_bbox(latitude, longitude, radius_km))
+            .annotate(distance_km=distance_km(latitude, longitude))
+            .filter(distance_km__lte=radius_km)
+            .order_by('distance_km', 'id'))
+
+
+def after_distance(locations, distance, location_id):
+    # Keyset continuation for a within_radius() queryset
+    return locations.filter(Q(distance_km__gt=distance) | Q(distance_km=distance, id__gt=location_id))
+
+
+def nearest(community_id, latitude, longitude, k=10):
+    # Every point within the searched radius is found, so once k hits are in
+    # hand they are the k nearest overall
+    k = min(k, MAX_NEAREST)
+    radius = NEAREST_START_KM
+    while True:
+        hits = list(within_radius(community_id, latitude, longitude, radius).select_related('post')[:k])
+        if len(hits) >= k or radius >= math.pi * EARTH_RADIUS_KM:
+            return hits
+        radius *= 4 if not hits else 2
@@ -0,0 +1,199 @@
+import io
+import os
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+from PIL import Image, ImageOps
+from . import sharding
+from .models import ImageJob, Post
+
+# IMAGE PIPELINE
+# create_post only writes the upload to a local staging directory and queues
+# an ImageJob. The process_images worker strips EXIF, renders every width in
+# VARIANT_WIDTHS as WebP and JPEG in a process pool, stores them and records
+# them in Post.data['_images'][field_name]
+
+VARIANT_WIDTHS = (320, 640, 1280)
+# (Pillow format, extension, save options)
+VARIANT_FORMATS = (
+    ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+MAX_ATTEMPTS = 3
+# A job left in 'processing' this long belonged to a worker that died
+STALE_AFTER = timedelta(minutes=10)
+# view_post.html shows images at most this wide
+DISPLAY_WIDTH = 200
+
+
+def staging_storage():
+    return FileSystemStorage(location=settings.IMAGE_STAGING_ROOT)
+
+
+def stage_upload(uploaded_file):
+    # Returns the pending '_images' entry for the field
+    name, extension = os.path.splitext(get_valid_filename(uploaded_file.name))
+    staged_name = staging_storage().save(f'{uuid.uuid4().hex}{extension.lower()}', uploaded_file)
+    return {'status': ImageJob.PENDING, 'name': name, 'staged': staged_name}
+
+
+def queue_images(post):
+    # Creates the ImageJobs for a post saved with staged uploads
+    jobs = [
+        ImageJob(post=post, field_name=field_name, staged_name=entry['staged'])
+        for field_name, entry in ((post.data or {}).get('_images') or {}).items()
+        if entry.get('status') == ImageJob.PENDING and entry.get('staged')
+    ]
+    ImageJob.objects.bulk_create(jobs)
+    return jobs
+
+
+# WORKER SIDE
+
+def render_variants(path, widths=VARIANT_WIDTHS):
+    # Runs in a pool process: returns the original size and
+    # [(width, height, extension, bytes), ...]. Re-encoding without the exif
+    # argument drops EXIF (GPS position, camera serial...) after it has been
+    # used to rotate the pixels upright
+    with Image.open(path) as original:
+        image = ImageOps.exif_transpose(original)
+        icc_profile = original.info.get('icc_profile')
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+        opaque = image
+        if image.mode == 'RGBA':
+            opaque = Image.new('RGB', image.size, 'white')
+            opaque.paste(image, mask=image.getchannel('A'))
+        variants = []
+        for width in sorted({min(width, image.width) for width in widths}):
+            height = max(round(image.height * width / image.width), 1)
+            for format_name, extension, options in VARIANT_FORMATS:
+                source = image if format_name == 'WEBP' else opaque
+                resized = source if width == image.width else source.resize((width, height), Image.LANCZOS)
+                buffer = io.BytesIO()
+                if icc_profile:
+                    options = dict(options, icc_profile=icc_profile)
+                resized.save(buffer, format_name, **options)
+                variants.append((width, height, extension, buffer.getvalue()))
+        return image.width, image.height, variants
+
+
+def claim_jobs(limit):
+    # Marks up to `limit` pending jobs as processing; concurrent workers skip
+    # each other's rows on PostgreSQL
+    with sharding.atomic():
+        ids = list(ImageJob.objects.select_for_update(skip_locked=True)
+                   .filter(status=ImageJob.PENDING).order_by('id')
+                   .values_list('id', flat=True)[:limit])
+        ImageJob.objects.filter(id__in=ids).update(status=ImageJob.PROCESSING, updated_at=timezone.now())
+    return list(ImageJob.objects.filter(id__in=ids).order_by('id'))
+
+
+def requeue_stale_jobs(now=None):
+    cutoff = (now or timezone.now()) - STALE_AFTER
+    return ImageJob.objects.filter(status=ImageJob.PROCESSING, updated_at__lt=cutoff).update(status=ImageJob.PENDING)
+
+
+def _update_entry(job, entry, image_path=None):
+    # Rewrites the post's '_images' entry (and the src keys) under a row lock;
+    # False when the post is gone
+    with sharding.atomic():
+        post = Post.objects.select_for_update().filter(pk=job.post_id).first()
+        if post is None:
+            return False
+        data = dict(post.data or {})
+        images = dict(data.get('_images') or {})
+        images[job.field_name] = entry
+        data['_images'] = images
+        if image_path is not None:
+            data[job.field_name] = image_path
+            # As before, 'image' shows the template's last image field
+            if job.field_name == list(images)[-1]:
+                data['image'] = image_path
+        post.data = data
+        post.save(update_fields=['data'])
+    return True
+
+
+def complete_job(job, result):
+    width, height, rendered = result
+    entry = (Post.objects.filter(pk=job.post_id).values_list('data', flat=True).first() or {}).get('_images', {}).get(job.field_name, {})
+    stem = get_valid_filename(entry.get('name') or 'image')
+    variants = []
+    for variant_width, variant_height, extension, content in rendered:
+        path = default_storage.save(f'media/images/{stem}-{variant_width}w.{extension}', ContentFile(content))
+        variants.append({'width': variant_width, 'height': variant_height, 'format': extension, 'path': path})
+    # The largest JPEG is the plain src for browsers without srcset support
+    fallback = max((variant for variant in variants if variant['format'] == 'jpg'), key=lambda variant: variant['width'])
+    if not _update_entry(job, {'status': ImageJob.DONE, 'width': width, 'height': height, 'variants': variants}, fallback['path']):
+        # The post was deleted while its images were rendered
+        release_variants([variant['path'] for variant in variants])
+    staging_storage().delete(job.staged_name)
+    ImageJob.objects.filter(pk=job.pk).update(status=ImageJob.DONE, attempts=job.attempts + 1, error='', updated_at=timezone.now())
+
+
+def fail_job(job, error):
+    attempts = job.attempts + 1
+    status = ImageJob.FAILED if attempts >= MAX_ATTEMPTS else ImageJob.PENDING
+    if status == ImageJob.FAILED:
+        _update_entry(job, {'status': ImageJob.FAILED})
+        staging_storage().delete(job.staged_name)
+    ImageJob.objects.filter(pk=job.pk).update(status=status, attempts=attempts, error=str(error)[:1000], updated_at=timezone.now())
+    return status
+
+
+# STORED VARIANTS
+
+def variant_paths(data):
+    # The image variants a post's data refers to, one per default_storage.save()
+    # that stored them: the references the post holds (see application.storage)
+    if not isinstance(data, dict):
+        return []
+    return [
+        variant['path']
+        for entry in (data.get('_images') or {}).values() if isinstance(entry, dict)
+        for variant in entry.get('variants') or ()
+    ]
+
+
+def release_variants(paths):
+    # Gives the references back; an object is deleted with its last one
+    for path in paths:
+        default_storage.delete(path)
+
+
+# DISPLAY
+
+def _srcset(variants, extension):
+    return ', '.join(
+        f"{settings.MEDIA_URL}{variant['path']} {variant['width']}w"
+        for variant in variants if variant['format'] == extension
+    )
+
+
+def display_image(data):
+    # What view_post.html needs for the post's 'image' key: the srcsets of the
+    # field it was copied from, or its processing status
+    if not isinstance(data, dict):
+        return None
+    images = data.get('_images') or {}
+    if not images:
+        return None
+    # 'image' is copied from the last image field (see _update_entry)
+    entry = next((images[field_name] for field_name in reversed(list(images)) if data.get(field_name) == data.get('image')),
+                 list(images.values())[-1])
+    if entry.get('status') != ImageJob.DONE:
+        return {'status': entry.get('status')}
+    height = round(entry['height'] * min(DISPLAY_WIDTH, entry['width']) / entry['width'])
+    return {
+        'status': ImageJob.DONE,
+        'webp_srcset': _srcset(entry['variants'], 'webp'),
+        'jpeg_srcset': _srcset(entry['variants'], 'jpg'),
+        'sizes': f'{DISPLAY_WIDTH}px',
+        'width': min(DISPLAY_WIDTH, entry['width']),
+        'height': height,
+    }
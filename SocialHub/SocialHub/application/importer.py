@@ -0,0 +1,201 @@
+import copy
+import csv
+import io
+import json
+import os
+from django import forms
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+from . import sharding
+from .counters import bump
+from .field_types import compile_template, get_field_type
+from .filtering import field_value_rows
+from .geo import location_rows
+from .live import posts_imported_event
+from .models import Community, Post, PostFieldValue, PostLocation
+from .ranking import hot_score
+from .search import index_posts
+from .timeline import fan_out_posts
+
+User = get_user_model()
+
+# BULK IMPORT
+# Rows are read one at a time, validated with the template's compiled form
+# (same rules and serialization as create_post) and written BATCH_SIZE at a
+# time, each batch in its own transaction. bulk_create skips the Post
+# signals, so each batch also writes what they and create_post would have:
+# search documents, typed field values, locations, counters and timelines,
+# plus one live update for the whole batch. Files from the exporter import
+# as they are: field values may come in a 'data' object (a JSON column in
+# CSV), and comment records are skipped
+
+BATCH_SIZE = 500
+FORMATS = ('jsonl', 'csv')
+
+
+class ImportResult:
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        # Whether rows past max_rows were left unread
+        self.truncated = False
+
+
+def detect_format(filename):
+    extension = os.path.splitext(filename or '')[1].lower().lstrip('.')
+    if extension in ('jsonl', 'ndjson', 'json'):
+        return 'jsonl'
+    if extension == 'csv':
+        return 'csv'
+    return None
+
+
+def read_rows(fileobj, file_format):
+    # Yields (line number, row dict or None, error or None)
+    text = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+    if file_format == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row, None
+        return
+    for number, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield number, None, f'Invalid JSON: {error}'
+            continue
+        if isinstance(row, dict):
+            yield number, row, None
+        else:
+            yield number, None, 'Each line must be a JSON object.'
+
+
+def _post_row(row):
+    # An exported post's fields are under 'data'; columns given at the top
+    # level win. None for the exporter's comment records
+    if row.get('record', 'post') != 'post':
+        return None
+    data = row.get('data')
+    if isinstance(data, str):
+        data = json.loads(data) if data else {}
+    if not isinstance(data, dict):
+        return row
+    return dict(data, **{key: value for key, value in row.items() if key != 'data' and value not in (None, '')})
+
+
+def _form_keys(fields):
+    # [(field_name, field_type, form data keys), ...]
+    return [
+        (field_name, field_type, list(get_field_type(field_type).form_fields(field_name)))
+        for field_name, field_type in fields
+    ]
+
+
+def _form_data(row, form_keys):
+    # Row -> create_post form data. A JSONL geolocation may be given as
+    # {"latitude": .., "longitude": ..} instead of the two form keys
+    data = {'title': row.get('title')}
+    for field_name, field_type, keys in form_keys:
+        value = row.get(field_name)
+        if field_type == 'geolocation' and isinstance(value, dict):
+            data[f'{field_name}_latitude'] = value.get('latitude')
+            data[f'{field_name}_longitude'] = value.get('longitude')
+            continue
+        for key in keys:
+            if row.get(key) not in (None, ''):
+                data[key] = row[key]
+    return data
+
+
+def _validator(compiled):
+    # Cleans a row with the compiled form's fields, like form.is_valid() but
+    # without building (and deep-copying) a form instance per row
+    fields = {}
+    for name, field in compiled.form_class.base_fields.items():
+        if isinstance(field, forms.ImageField):
+            field = copy.deepcopy(field)
+            field.required = False
+        fields[name] = field
+
+    def clean(data):
+        cleaned, errors = {}, []
+        for name, field in fields.items():
+            try:
+                cleaned[name] = field.clean(field.widget.value_from_datadict(data, {}, name))
+            except ValidationError as error:
+                errors.append(f"{name}: {' '.join(error.messages)}")
+        return cleaned, '; '.join(errors)
+    return clean
+
+
+def import_posts(template, fileobj, file_format, author, batch_size=BATCH_SIZE, on_error=None,
+                 authors=False, max_rows=None):
+    # author creates every post. With authors (the import_posts command, not
+    # the web upload) a row may name another user in 'author' instead;
+    # otherwise the column is ignored. Reading stops after max_rows rows.
+    # Image fields can't be imported and are left empty
+    compiled = compile_template(template)
+    clean = _validator(compiled)
+    form_keys = _form_keys(compiled.fields)
+    result = ImportResult()
+    batch = []
+
+    def report(number, message):
+        result.failed += 1
+        if on_error is not None:
+            on_error(number, message)
+
+    for read, (number, row, error) in enumerate(read_rows(fileobj, file_format)):
+        if max_rows is not None and read >= max_rows:
+            result.truncated = True
+            break
+        if error:
+            report(number, error)
+            continue
+        try:
+            row = _post_row(row)
+        except ValueError as error:
+            report(number, f'data: Invalid JSON: {error}')
+            continue
+        if row is None:
+            continue
+        cleaned_data, errors = clean(_form_data(row, form_keys))
+        if errors:
+            report(number, errors)
+            continue
+        batch.append((number, cleaned_data['title'], compiled.serialize(cleaned_data),
+                      (row.get('author') or None) if authors else None))
+        if len(batch) >= batch_size:
+            _write_batch(template, compiled, batch, author, result, report)
+            batch = []
+    if batch:
+        _write_batch(template, compiled, batch, author, result, report)
+    return result
+
+
+def _write_batch(template, compiled, batch, author, result, report):
+    usernames = {username for number, title, data, username in batch if username}
+    author_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'id')) if usernames else {}
+    posts = []
+    score = hot_score(0, timezone.now())
+    for number, title, data, username in batch:
+        if username and username not in author_ids:
+            report(number, f'author: Unknown user {username!r}.')
+            continue
+        created_by_id = author_ids[username] if username else author.id
+        posts.append(Post(community_id=template.community_id, title=title, data=data,
+                          created_by_id=created_by_id, hot_score=score))
+    if not posts:
+        return
+    with sharding.atomic():
+        Post.objects.bulk_create(posts)
+        index_posts(posts)
+        PostFieldValue.objects.bulk_create([row for post in posts for row in field_value_rows(post, compiled.fields)])
+        PostLocation.objects.bulk_create([row for post in posts for row in location_rows(post, compiled.fields)])
+        bump(Community, template.community_id, post_count=len(posts), cache_version=1)
+        fan_out_posts(posts)
+        posts_imported_event(template.community_id, len(posts))
+    result.imported += len(posts)
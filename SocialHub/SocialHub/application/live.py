@@ -0,0 +1,175 @@
+import asyncio
+import json
+import logging
+import threading
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.module_loading import import_string
+from . import sharding
+
+logger = logging.getLogger(__name__)
+
+# LIVE UPDATES
+# Write paths publish small JSON events on a channel per post and per
+# community once their transaction commits; the server-sent events views
+# (served by the ASGI app) relay them to the open pages. The broker class is
+# settings.LIVE_BROKER: InProcessBroker only reaches subscribers in the same
+# process (tests, runserver), RedisBroker reaches every process
+
+# Events waiting for a slow client; older ones are dropped when it's full
+QUEUE_SIZE = 100
+
+
+def post_channel(post_id):
+    return f'post:{post_id}'
+
+
+def community_channel(community_id):
+    return f'community:{community_id}'
+
+
+class Subscription:
+    def __init__(self, channel):
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    def deliver(self, message):
+        # Runs on the subscriber's event loop
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+    async def get(self, timeout):
+        # The next message, or None after timeout seconds without one
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class InProcessBroker:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def publish(self, channel, message):
+        # Safe to call from any thread
+        self._deliver(channel, message)
+
+    def _deliver(self, channel, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.deliver, message)
+
+    async def subscribe(self, channel):
+        subscription = Subscription(channel)
+        with self._lock:
+            subscriptions = self._subscriptions.setdefault(channel, set())
+            first = not subscriptions
+            subscriptions.add(subscription)
+        if first:
+            await self._channel_opened(channel)
+        return subscription
+
+    async def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            last = not subscriptions
+            if last:
+                self._subscriptions.pop(subscription.channel, None)
+        if last:
+            await self._channel_closed(subscription.channel)
+
+    async def _channel_opened(self, channel):
+        pass
+
+    async def _channel_closed(self, channel):
+        pass
+
+
+class RedisBroker(InProcessBroker):
+    # Publishes through Redis pub/sub. Each process holds one subscriber
+    # connection for all its open streams and hands messages to them locally
+
+    def __init__(self, url=None):
+        super().__init__()
+        import redis
+
+        self.url = url or settings.LIVE_REDIS_URL
+        self._client = redis.Redis.from_url(self.url)
+        self._pubsub = None
+        self._listener = None
+
+    def publish(self, channel, message):
+        self._client.publish(channel, message)
+
+    async def _channel_opened(self, channel):
+        import redis.asyncio
+
+        if self._pubsub is None:
+            self._pubsub = redis.asyncio.Redis.from_url(self.url).pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(channel)
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.get_running_loop().create_task(self._listen())
+
+    async def _channel_closed(self, channel):
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe(channel)
+
+    async def _listen(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(timeout=1.0)
+            except Exception:
+                logger.exception('Live update listener lost its Redis connection')
+                await asyncio.sleep(1)
+                continue
+            if message is not None and message['type'] == 'message':
+                self._deliver(message['channel'].decode(), message['data'].decode())
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(settings.LIVE_BROKER)()
+    return _broker
+
+
+def publish(channel, event_type, **data):
+    # Sent once the current transaction on the current shard commits (right
+    # away outside one), so nobody hears about a row that was rolled back
+    message = json.dumps(dict(data, type=event_type), cls=DjangoJSONEncoder)
+
+    def send():
+        try:
+            get_broker().publish(channel, message)
+        except Exception:
+            # Live updates are best effort; the write itself already succeeded
+            logger.exception('Could not publish live update on %s', channel)
+    transaction.on_commit(send, using=sharding.current())
+
+
+def comment_event(comment):
+    publish(post_channel(comment.post_id), 'comment',
+            id=comment.id, parent_id=comment.parent_id, depth=comment.depth,
+            user=comment.user.username, content=comment.content, created_at=comment.created_at)
+
+
+def post_event(post):
+    publish(community_channel(post.community_id), 'post',
+            id=post.id, title=post.title, author=post.created_by.username, created_at=post.created_at)
+
+
+def posts_imported_event(community_id, count):
+    publish(community_channel(community_id), 'posts', count=count)
@@ -0,0 +1,80 @@
+import json
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from application.benchmark import compare, over_budget, run_routes, uncovered_url_names
+from application.query_budgets import unbudgeted_url_names
+from application.seeding import SCALES, seed, throwaway_database
+
+
+class Command(BaseCommand):
+    help = ('Seeds a throwaway test database at each scale and reports latency percentiles and query counts '
+            'for every view, optionally against a stored baseline')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='small', help=f"Comma-separated, from {', '.join(SCALES)}")
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--route', action='append', dest='routes', help='Only this route label (repeatable)')
+        parser.add_argument('--baseline', help='JSON file from an earlier --save to compare with')
+        parser.add_argument('--save', help='Write the results to this JSON file (a new baseline)')
+        parser.add_argument('--tolerance', type=float, default=0.5, help='Allowed p90 slowdown as a fraction of the baseline')
+        parser.add_argument('--fail-on-regression', action='store_true', help='Exit with an error when anything regressed')
+        parser.add_argument('--check-budgets', action='store_true',
+                            help='Exit with an error when a view runs more queries than its budget (application.query_budgets)')
+
+    def handle(self, *args, **options):
+        scales = [scale.strip() for scale in options['scales'].split(',') if scale.strip()]
+        unknown = [scale for scale in scales if scale not in SCALES]
+        if unknown:
+            raise CommandError(f"Unknown scale(s): {', '.join(unknown)}")
+        missing = uncovered_url_names()
+        if missing:
+            self.stderr.write(f"Not benchmarked (add them to application.benchmark.ROUTES): {', '.join(missing)}")
+        unbudgeted = unbudgeted_url_names()
+        if unbudgeted:
+            self.stderr.write(f"No query budget (add them to application.query_budgets.QUERY_BUDGETS): {', '.join(unbudgeted)}")
+        baseline = {}
+        if options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        results = {}
+        with throwaway_database():
+            for scale in scales:
+                call_command('flush', interactive=False, verbosity=0)
+                self.stdout.write(f'Seeding {scale}...')
+                seed(seed=options['seed'], **SCALES[scale])
+                results[scale] = run_routes(options['iterations'], options['warmup'], options['routes'])
+                self.report(scale, results[scale], baseline.get(scale, {}))
+
+        if options['save']:
+            with open(options['save'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+            self.stdout.write(f"Results saved to {options['save']}")
+        regressions = [(scale, label, message) for scale in results
+                       for label, message in compare(results[scale], baseline.get(scale, {}), options['tolerance'])]
+        for scale, label, message in regressions:
+            self.stdout.write(self.style.ERROR(f'REGRESSION [{scale}] {label}: {message}'))
+        if baseline and not regressions:
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
+        exceeded = [(scale, label, queries, budget) for scale in results
+                    for label, queries, budget in over_budget(results[scale])]
+        for scale, label, queries, budget in exceeded:
+            self.stdout.write(self.style.ERROR(f'OVER BUDGET [{scale}] {label}: {queries} queries, budget {budget}'))
+        if regressions and options['fail_on_regression']:
+            raise CommandError(f'{len(regressions)} regression(s)')
+        if options['check_budgets']:
+            if exceeded or unbudgeted:
+                raise CommandError(f'{len(exceeded)} route(s) over their query budget, {len(unbudgeted)} view(s) without one')
+            self.stdout.write(self.style.SUCCESS('Every view is within its query budget'))
+
+    def report(self, scale, results, baseline):
+        self.stdout.write(f"\n[{scale}] {'route':28} {'status':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'queries':>8} {'cold':>5}")
+        for label, result in results.items():
+            before = baseline.get(label)
+            change = f"  (was {before['queries']} / {before['p90']}ms)" if before else ''
+            self.stdout.write(
+                f"{'':{len(scale) + 3}}{label:28} {result['status']:6} {result['p50']:8.1f} {result['p90']:8.1f} "
+                f"{result['p99']:8.1f} {result['queries']:8} {result['cold_queries']:5}{change}"
+            )
@@ -0,0 +1,61 @@
+import json
+import os
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from application import query_plans
+from application.seeding import SCALES, seed, throwaway_database
+
+SNAPSHOT = os.path.join(os.path.dirname(query_plans.__file__), 'query_plans.json')
+
+
+class Command(BaseCommand):
+    help = ('Seeds a throwaway test database, explains the busiest querysets (application.query_plans) and fails '
+            'when a table they read through an index in the snapshot is now read in full')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', default='medium', choices=list(SCALES),
+                            help='Small tables are read in full whatever their indexes, so use medium or large')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--snapshot', default=SNAPSHOT)
+        parser.add_argument('--update', action='store_true', help="Write the captured plans as this database's snapshot")
+        parser.add_argument('--show-plans', action='store_true', help='Print every plan, not only the regressed ones')
+
+    def handle(self, *args, **options):
+        snapshots = {}
+        if os.path.exists(options['snapshot']):
+            with open(options['snapshot']) as snapshot_file:
+                snapshots = json.load(snapshot_file)
+        vendor = connection.vendor
+
+        with throwaway_database():
+            self.stdout.write(f"Seeding {options['scale']}...")
+            seed(seed=options['seed'], **SCALES[options['scale']])
+            plans = query_plans.capture()
+
+        snapshot = snapshots.get(vendor, {})
+        for label, captured in plans.items():
+            scans = ', '.join(f'{table} {kind}' for table, kind in sorted(captured['scans'].items()))
+            self.stdout.write(f'{label:26} {scans}')
+            if options['show_plans']:
+                self.stdout.write(captured['plan'] + '\n')
+
+        if options['update']:
+            snapshots[vendor] = {label: captured['scans'] for label, captured in plans.items()}
+            with open(options['snapshot'], 'w') as output:
+                json.dump(snapshots, output, indent=2, sort_keys=True)
+                output.write('\n')
+            self.stdout.write(self.style.SUCCESS(f"{vendor} snapshot written to {options['snapshot']}"))
+            return
+        if not snapshot:
+            raise CommandError(f'No {vendor} snapshot in {options["snapshot"]}; run with --update to take one')
+
+        missing = [label for label in plans if label not in snapshot]
+        if missing:
+            self.stderr.write(f"Not in the snapshot (run with --update): {', '.join(missing)}")
+        regressed = query_plans.regressions(plans, snapshot)
+        for label, table in regressed:
+            self.stdout.write(self.style.ERROR(f'REGRESSION {label}: {table} was read through an index, now in full'))
+            self.stdout.write(plans[label]['plan'])
+        if regressed:
+            raise CommandError(f'{len(regressed)} plan regression(s)')
+        self.stdout.write(self.style.SUCCESS('No plan regressions against the snapshot'))
@@ -0,0 +1,28 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+from application.media_gc import GRACE, collect
+
+
+class Command(BaseCommand):
+    help = 'Deletes stored media that no post refers to any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+        parser.add_argument('--grace-hours', type=float, default=GRACE.total_seconds() / 3600,
+                            help='Leave objects younger than this alone')
+        parser.add_argument('--every', type=int, default=0, metavar='SECONDS',
+                            help='Keep running, collecting once per interval')
+
+    def handle(self, *args, **options):
+        grace = timedelta(hours=options['grace_hours'])
+        while True:
+            deleted, reclaimed, kept = collect(dry_run=options['dry_run'], grace=grace)
+            verb = 'Would delete' if options['dry_run'] else 'Deleted'
+            self.stdout.write(self.style.SUCCESS(
+                f'{verb} {deleted} orphaned objects ({filesizeformat(reclaimed)} reclaimed), kept {kept}'
+            ))
+            if not options['every']:
+                break
+            time.sleep(options['every'])
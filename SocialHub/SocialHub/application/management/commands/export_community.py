@@ -0,0 +1,24 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from application.exporter import CHUNK_SIZE, FORMATS, export_lines
+from application.models import Community
+
+
+class Command(BaseCommand):
+    help = "Streams a community's posts and comments as JSONL or CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument('community', type=int)
+        parser.add_argument('--format', choices=FORMATS, default='jsonl')
+        parser.add_argument('--output', help='File to write (default: stdout)')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        if not Community.objects.filter(pk=options['community']).exists():
+            raise CommandError(f"Community {options['community']} does not exist")
+        lines = export_lines(options['community'], options['format'], options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(lines)
+        else:
+            sys.stdout.writelines(lines)
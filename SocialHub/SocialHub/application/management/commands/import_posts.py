@@ -0,0 +1,34 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from application import sharding
+from application.importer import BATCH_SIZE, FORMATS, detect_format, import_posts
+from application.models import Template
+
+
+class Command(BaseCommand):
+    help = 'Streams posts from a JSONL or CSV file into a community through one of its templates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--template', type=int, required=True, help='Template id; posts go to its community')
+        parser.add_argument('--user', required=True, help='Username of the author for rows without an "author" column')
+        parser.add_argument('--format', choices=FORMATS, help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        template = sharding.find(Template.objects.all(), pk=options['template'])
+        if template is None:
+            raise CommandError(f"Template {options['template']} does not exist")
+        author = get_user_model().objects.filter(username=options['user']).first()
+        if author is None:
+            raise CommandError(f"User {options['user']!r} does not exist")
+        file_format = options['format'] or detect_format(options['path'])
+        if file_format is None:
+            raise CommandError('Cannot tell the format from the file name; pass --format')
+
+        def on_error(number, message):
+            self.stderr.write(f'line {number}: {message}')
+
+        with open(options['path'], 'rb') as fileobj, sharding.in_shard(template._state.db):
+            result = import_posts(template, fileobj, file_format, author, options['batch_size'], on_error, authors=True)
+        self.stdout.write(self.style.SUCCESS(f'Imported {result.imported} posts, {result.failed} rows failed'))
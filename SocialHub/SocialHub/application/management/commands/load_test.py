@@ -0,0 +1,86 @@
+import http.cookiejar
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+
+DEFAULT_PATHS = ['/', '/community/', '/search/?searched=the']
+
+
+def percentile(durations, fraction):
+    ordered = sorted(durations)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Command(BaseCommand):
+    help = ('Sends concurrent requests to a running deployment and reports requests per second and latency '
+            'per path, e.g. to compare the sync gunicorn and the uvicorn (docker-compose.asgi.yml) profiles')
+
+    def add_arguments(self, parser):
+        parser.add_argument('base_url', help='e.g. http://localhost:8000')
+        parser.add_argument('--path', action='append', dest='paths',
+                            help=f"Path to request; repeat for several (default: {' '.join(DEFAULT_PATHS)})")
+        parser.add_argument('--requests', type=int, default=500, help='Requests per path')
+        parser.add_argument('--concurrency', type=int, default=20)
+        parser.add_argument('--warmup', type=int, default=20, help='Unmeasured requests per path first')
+        parser.add_argument('--username')
+        parser.add_argument('--password')
+
+    def handle(self, *args, **options):
+        base_url = options['base_url'].rstrip('/')
+        cookie = self.login(base_url, options['username'], options['password']) if options['username'] else ''
+        total_requests = 0
+        total_seconds = 0.0
+        self.stdout.write(f"{'path':40} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for path in options['paths'] or DEFAULT_PATHS:
+            url = base_url + path
+            self.run(url, cookie, options['warmup'], options['concurrency'])
+            started = time.perf_counter()
+            results = self.run(url, cookie, options['requests'], options['concurrency'])
+            elapsed = time.perf_counter() - started
+            durations = [duration for ok, duration in results if ok]
+            errors = len(results) - len(durations)
+            if durations:
+                self.stdout.write(
+                    f'{path[:40]:40} {len(results) / elapsed:8.1f} {percentile(durations, 0.5) * 1000:8.1f} '
+                    f'{percentile(durations, 0.9) * 1000:8.1f} {percentile(durations, 0.99) * 1000:8.1f} {errors:7}'
+                )
+            else:
+                self.stdout.write(f'{path[:40]:40} every request failed')
+            total_requests += len(results)
+            total_seconds += elapsed
+        if total_seconds:
+            self.stdout.write(self.style.SUCCESS(f'{total_requests / total_seconds:.1f} requests per second overall'))
+
+    def login(self, base_url, username, password):
+        # Logs in through the login form; returns the Cookie header to send
+        cookies = http.cookiejar.CookieJar()
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cookies))
+        login_url = f'{base_url}/users/login_user'
+        opener.open(login_url).read()
+        csrftoken = next((cookie.value for cookie in cookies if cookie.name == 'csrftoken'), '')
+        data = urllib.parse.urlencode({'username': username, 'password': password, 'csrfmiddlewaretoken': csrftoken}).encode()
+        opener.open(urllib.request.Request(login_url, data=data, headers={'Referer': login_url})).read()
+        session = next((cookie.value for cookie in cookies if cookie.name == 'sessionid'), None)
+        if session is None:
+            raise CommandError('Login failed')
+        return f'sessionid={session}'
+
+    def run(self, url, cookie, count, concurrency):
+        # [(succeeded, seconds), ...]
+        headers = {'Cookie': cookie} if cookie else {}
+
+        def fetch(_):
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+                    response.read()
+                    ok = response.status == 200
+            except (urllib.error.URLError, OSError):
+                ok = False
+            return ok, time.perf_counter() - started
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(fetch, range(count)))
@@ -0,0 +1,57 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+from application import sharding
+from application.models import Community
+
+
+class Command(BaseCommand):
+    help = ("Moves a community's templates, posts and comments to another shard (settings.DATABASE_SHARDS), "
+            "e.g. a big community to a shard of its own. Its pages stay readable meanwhile; writes to it get a 503")
+
+    def add_arguments(self, parser):
+        parser.add_argument('community', type=int)
+        parser.add_argument('shard', help='Database alias to move to')
+        parser.add_argument('--grace', type=float, default=30,
+                            help='Seconds to wait for requests that were already writing to the community')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        target = options['shard']
+        if target not in settings.DATABASE_SHARDS:
+            raise CommandError(f"{target!r} is not one of the shards: {', '.join(settings.DATABASE_SHARDS)}")
+        community = Community.objects.filter(pk=options['community']).first()
+        if community is None:
+            raise CommandError(f"Community {options['community']} does not exist")
+        source = community.shard
+        if source == target:
+            raise CommandError(f'{community} is already on {target}')
+        if community.moving_to and community.moving_to != target:
+            raise CommandError(f'{community} is being moved to {community.moving_to}')
+
+        # 1. Writes are turned away from here on (ShardMiddleware); the ones
+        # already past that check get the grace period to finish
+        Community.objects.filter(pk=community.pk).update(moving_to=target)
+        self.stdout.write(f'Moving {community} from {source} to {target}; waiting {options["grace"]:g}s for writes in flight')
+        time.sleep(options['grace'])
+
+        # 2. Copy. Rows left on the target by an earlier attempt go first, so
+        # an interrupted move can simply be run again
+        try:
+            sharding.purge_community(community.pk, target)
+            copied = sharding.copy_community(community.pk, source, target, options['batch_size'], log=self.stdout.write)
+        except Exception:
+            sharding.purge_community(community.pk, target)
+            Community.objects.filter(pk=community.pk).update(moving_to='')
+            raise
+
+        # 3. Switch over; new requests use the target from now on. The cache
+        # version bump drops fragments rendered from the old shard
+        Community.objects.filter(pk=community.pk).update(shard=target, moving_to='', cache_version=F('cache_version') + 1)
+
+        # 4. The source's copy is no longer read by anything
+        sharding.purge_community(community.pk, source)
+        self.stdout.write(self.style.SUCCESS(
+            f'Moved {community} to {target}: ' + ', '.join(f'{count} {name}' for name, count in copied.items())
+        ))
@@ -0,0 +1,49 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from application import images, sharding
+
+
+class Command(BaseCommand):
+    help = 'Turns staged image uploads into stored, EXIF-free WebP/JPEG variants'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--batch-size', type=int, default=20)
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty')
+        parser.add_argument('--sleep', type=float, default=2.0, help='Seconds to wait when the queue is empty')
+
+    def handle(self, *args, **options):
+        # Pool processes only run Pillow; the database and storage calls stay here
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            while True:
+                # A batch from each shard's queue in turn
+                processed = 0
+                for alias in settings.DATABASE_SHARDS:
+                    with sharding.in_shard(alias):
+                        processed += self.process_batch(pool, options['batch_size'])
+                if not processed:
+                    if options['once']:
+                        break
+                    time.sleep(options['sleep'])
+
+    def process_batch(self, pool, batch_size):
+        requeued = images.requeue_stale_jobs()
+        if requeued:
+            self.stdout.write(f'Requeued {requeued} stale jobs')
+        jobs = images.claim_jobs(batch_size)
+        storage = images.staging_storage()
+        futures = [(job, pool.submit(images.render_variants, storage.path(job.staged_name))) for job in jobs]
+        for job, future in futures:
+            try:
+                images.complete_job(job, future.result())
+            except Exception as error:
+                status = images.fail_job(job, error)
+                self.stderr.write(f'Image job {job.id} failed ({status}): {error}')
+            else:
+                self.stdout.write(f'Processed image job {job.id}')
+        return len(jobs)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth import get_user_model
+from application.timeline import rebuild_timelines, BACKFILL_LIMIT
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the materialized home timelines from the follow graph'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='usernames', help='Only rebuild the timeline of this username (repeatable)')
+        parser.add_argument('--limit', type=int, default=BACKFILL_LIMIT, help='Posts copied per followed user')
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+        rebuilt = rebuild_timelines(users, limit=options['limit'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rebuilt} timelines'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from application.counters import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored member/post/comment counters and repairs any drift'
+
+    def handle(self, *args, **options):
+        for counter, fixed in reconcile().items():
+            self.stdout.write(f'{counter}: {fixed} rows repaired')
+        self.stdout.write(self.style.SUCCESS('Counters reconciled'))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from application.ranking import refresh_scores
+
+
+class Command(BaseCommand):
+    help = 'Incrementally refreshes community trending scores and post hot scores (run periodically, e.g. every 10 minutes)'
+
+    def handle(self, *args, **options):
+        communities, posts = refresh_scores()
+        self.stdout.write(self.style.SUCCESS(f'Refreshed {communities} trending communities and {posts} hot posts'))
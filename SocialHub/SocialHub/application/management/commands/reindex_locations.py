@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from application import sharding
+from application.geo import reindex
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the PostLocation rows used for map and "posts near here" queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # Every shard, in parallel
+        written = sum(sharding.fan_out(lambda: reindex(batch_size=options['batch_size'])))
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} locations'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from application import sharding
+from application.search import reindex
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the post search documents (title and template field text)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # Every shard, in parallel
+        indexed = sum(sharding.fan_out(lambda: reindex(batch_size=options['batch_size'])))
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} posts'))
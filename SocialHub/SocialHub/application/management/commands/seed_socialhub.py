@@ -0,0 +1,31 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from application.seeding import SCALES, seed
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Fills the database with reproducible synthetic users, communities, posts and comments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=SCALES, default='small', help='Preset sizes; the options below override them')
+        for name in SCALES['small']:
+            parser.add_argument(f'--{name}', type=int, help=f'Number of {name}' if name not in ('follows', 'memberships', 'templates')
+                                else f'Number of {name} per ' + ('community' if name == 'templates' else 'user'))
+        parser.add_argument('--seed', type=int, default=0, help='Random seed; the same seed gives the same data')
+        parser.add_argument('--prefix', default='seed', help='Username and community name prefix')
+
+    def handle(self, *args, **options):
+        sizes = dict(SCALES[options['scale']])
+        for name in sizes:
+            if options[name] is not None:
+                sizes[name] = options[name]
+        if User.objects.filter(username=f"{options['prefix']}0").exists():
+            raise CommandError(f"Users prefixed {options['prefix']!r} already exist; pass another --prefix")
+        # Seeded communities stay on the default database; spread them over
+        # the shards afterwards with move_community
+        with override_settings(DATABASE_SHARDS=['default']):
+            created = seed(seed=options['seed'], prefix=options['prefix'], log=self.stdout.write, **sizes)
+        self.stdout.write(self.style.SUCCESS('Seeded ' + ', '.join(f'{count} {name}' for name, count in created.items())))
@@ -0,0 +1,123 @@
+from datetime import timedelta
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from . import sharding
+from .models import JobCheckpoint, MediaBlob, Post
+from .storage import ContentAddressedMixin, is_blob
+
+# ORPHANED MEDIA COLLECTION
+# Lists every object under MEDIA_PREFIX, streams the keys still referenced
+# from Post.data, and deletes the rest in batches. Objects younger than GRACE
+# are left alone: their post (or image job) may not have been saved yet.
+# Content-addressed blobs also need a reference count of 0 (or no MediaBlob
+# row at all): one still counted is held by a save the posts don't show yet
+
+MEDIA_PREFIX = 'media/'
+GRACE = timedelta(hours=6)
+DELETE_BATCH_SIZE = 1000  # S3 DeleteObjects takes at most 1000 keys
+POST_BATCH_SIZE = 2000
+CHECKPOINT = 'collect_media'
+
+
+def referenced_keys(data, keys=None):
+    # Every media key in a Post.data value: 'image', the image fields and the
+    # '_images' variants
+    keys = set() if keys is None else keys
+    if isinstance(data, dict):
+        for value in data.values():
+            referenced_keys(value, keys)
+    elif isinstance(data, list):
+        for value in data:
+            referenced_keys(value, keys)
+    elif isinstance(data, str) and data.startswith(MEDIA_PREFIX):
+        keys.add(data)
+    return keys
+
+
+def _shard_referenced_keys():
+    keys = set()
+    for data in Post.objects.values_list('data', flat=True).iterator(chunk_size=POST_BATCH_SIZE):
+        referenced_keys(data, keys)
+    return keys
+
+
+def all_referenced_keys():
+    # The posts of every shard share the media storage
+    return set().union(*sharding.fan_out(_shard_referenced_keys))
+
+
+def _walk(storage, path):
+    directories, files = storage.listdir(path)
+    for name in files:
+        yield f'{path}{name}'
+    for directory in directories:
+        yield from _walk(storage, f'{path}{directory}/')
+
+
+def list_media(storage, prefix=MEDIA_PREFIX):
+    # (name, size, modified) for every stored object under prefix; S3 is
+    # listed 1000 keys per request instead of one call per "directory"
+    bucket = getattr(storage, 'bucket', None)
+    if bucket is not None:
+        for obj in bucket.objects.filter(Prefix=prefix):
+            yield obj.key, obj.size, obj.last_modified
+        return
+    for name in _walk(storage, prefix):
+        yield name, storage.size(name), storage.get_modified_time(name)
+
+
+def _delete_objects(storage, names):
+    # Returns the names that could not be deleted
+    bucket = getattr(storage, 'bucket', None)
+    if bucket is not None:
+        response = bucket.delete_objects(Delete={'Objects': [{'Key': name} for name in names], 'Quiet': True})
+        return {error['Key'] for error in response.get('Errors', [])}
+    if isinstance(storage, ContentAddressedMixin):
+        for name in names:
+            storage.purge(name)
+    else:
+        for name in names:
+            storage.delete(name)
+    return set()
+
+
+def _delete_batch(storage, batch):
+    # Blobs are locked and dropped with their rows; one that was saved again
+    # since the listing (its refcount went up) is kept
+    with transaction.atomic():
+        locked = dict(MediaBlob.objects.select_for_update()
+                      .filter(pk__in=[name for name, size in batch if is_blob(name)])
+                      .values_list('name', 'refcount'))
+        doomed = [(name, size) for name, size in batch if not locked.get(name)]
+        if not doomed:
+            return []
+        failed = _delete_objects(storage, [name for name, size in doomed])
+        doomed = [(name, size) for name, size in doomed if name not in failed]
+        MediaBlob.objects.filter(pk__in=[name for name, size in doomed if name in locked]).delete()
+    return doomed
+
+
+def collect(storage=None, dry_run=False, now=None, grace=GRACE):
+    # Returns (objects deleted, bytes reclaimed, objects kept)
+    storage = storage or default_storage
+    cutoff = (now or timezone.now()) - grace
+    # Listing first, references second: a post saved meanwhile is still seen
+    candidates = [(name, size) for name, size, modified in list_media(storage) if modified < cutoff]
+    blob_names = [name for name, size in candidates if is_blob(name)]
+    blob_refcounts = {}
+    for start in range(0, len(blob_names), DELETE_BATCH_SIZE):
+        blob_refcounts.update(MediaBlob.objects.filter(pk__in=blob_names[start:start + DELETE_BATCH_SIZE])
+                              .values_list('name', 'refcount'))
+    referenced = all_referenced_keys()
+    orphans = [(name, size) for name, size in candidates if name not in referenced and not blob_refcounts.get(name)]
+    kept = len(candidates) - len(orphans)
+    if dry_run:
+        return len(orphans), sum(size for name, size in orphans), kept
+    deleted = reclaimed = 0
+    for start in range(0, len(orphans), DELETE_BATCH_SIZE):
+        done = _delete_batch(storage, orphans[start:start + DELETE_BATCH_SIZE])
+        deleted += len(done)
+        reclaimed += sum(size for name, size in done)
+    JobCheckpoint.objects.update_or_create(name=CHECKPOINT, defaults={'last_run_at': now or timezone.now()})
+    return deleted, reclaimed, kept + len(orphans) - deleted
@@ -0,0 +1,291 @@
+import contextvars
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates
+from .query_budgets import QueryCounter
+
+logger = logging.getLogger(__name__)
+
+# REQUEST METRICS
+# MetricsMiddleware times every request and, within it, the SQL queries, the
+# template rendering and the default_storage calls, labelled with the URL
+# name of the view. Each process aggregates them in memory; with
+# settings.METRICS_DIR set, every process (gunicorn worker) also writes its
+# totals to a file there, and the /metrics view adds up all the files, so a
+# scrape sees the whole server whichever worker answers it. Clear the
+# directory when the server starts, as files of exited workers are kept
+# (their counts still belong in the totals)
+
+# Upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name: (type, help)
+METRICS = {
+    'socialhub_requests_total': ('counter', 'Requests by view, method and status code'),
+    'socialhub_request_duration_seconds': ('histogram', 'Time until the view returned its response'),
+    'socialhub_sql_queries_total': ('counter', 'SQL queries run by requests'),
+    'socialhub_sql_duration_seconds': ('histogram', 'Time spent in SQL queries per request'),
+    'socialhub_template_render_seconds': ('histogram', 'Time spent rendering templates per request'),
+    'socialhub_storage_calls_total': ('counter', 'default_storage calls by operation'),
+    'socialhub_storage_duration_seconds': ('histogram', 'Time spent in default_storage calls per request'),
+}
+
+# Views that weren't resolved (404s, static files) share one label
+UNRESOLVED = 'unresolved'
+
+
+class Registry:
+    # Counters and histograms keyed by (name, labels), labels being a tuple
+    # of (label, value) pairs. A histogram is [count per bucket..., +Inf
+    # count, sum]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            self.counters[name, labels] = self.counters.get((name, labels), 0) + amount
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[name, labels] = [0] * (len(BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(BUCKETS)] += 1
+            histogram[-1] += value
+
+    def dump(self):
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(labels), list(values)] for (name, labels), values in self.histograms.items()],
+            }
+
+    def merge(self, data):
+        # Adds a dump() of another registry into this one
+        with self._lock:
+            for name, labels, value in data['counters']:
+                key = name, tuple(tuple(pair) for pair in labels)
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, values in data['histograms']:
+                key = name, tuple(tuple(pair) for pair in labels)
+                histogram = self.histograms.setdefault(key, [0] * (len(BUCKETS) + 1) + [0.0])
+                for i, value in enumerate(values):
+                    histogram[i] += value
+
+
+registry = Registry()
+
+# This process's file in METRICS_DIR (pids are reused, so they get a suffix)
+_process_file = f'metrics-{os.getpid()}-{uuid.uuid4().hex[:8]}.json'
+_last_flush = 0.0
+
+
+def flush(force=False):
+    # Writes this process's totals to METRICS_DIR, at most every
+    # METRICS_FLUSH_SECONDS unless forced
+    global _last_flush
+    if not settings.METRICS_DIR:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < settings.METRICS_FLUSH_SECONDS:
+        return
+    _last_flush = now
+    path = os.path.join(settings.METRICS_DIR, _process_file)
+    try:
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        with open(path + '.tmp', 'w') as output:
+            json.dump(registry.dump(), output)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        logger.exception('Could not write metrics to %s', path)
+
+
+def collect():
+    # The registry to report: this process's, or every process's added up
+    if not settings.METRICS_DIR:
+        return registry
+    flush(force=True)
+    total = Registry()
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, 'metrics-*.json')):
+        try:
+            with open(path) as metrics_file:
+                total.merge(json.load(metrics_file))
+        except (OSError, ValueError):
+            logger.exception('Could not read metrics from %s', path)
+    return total
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{label}="{_escape(value)}"' for label, value in pairs) + '}'
+
+
+def render(source):
+    # Prometheus text exposition format
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        if metric_type == 'counter':
+            for (metric, labels), value in sorted(source.counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{_labels(labels)} {value}')
+            continue
+        for (metric, labels), values in sorted(source.histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS, values):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(labels + (("le", bound),))} {cumulative}')
+            count = cumulative + values[len(BUCKETS)]
+            lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{_labels(labels)} {values[-1]}')
+            lines.append(f'{name}_count{_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+# PER-REQUEST TIMINGS
+# Set by MetricsMiddleware for the duration of a request. sync_to_async
+# copies the context, so the async views' sync parts add to the same object
+
+class RequestTimings:
+
+    def __init__(self):
+        self.sql = QueryTimer()
+        self.template_seconds = 0.0
+        self.storage_seconds = 0.0
+        self.storage_calls = {}
+        self._active = set()
+
+
+class QueryTimer(QueryCounter):
+    # Counts the queries run through it and the time they took
+
+    def __init__(self):
+        super().__init__()
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return super().__call__(execute, sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+_current = contextvars.ContextVar('request_timings', default=None)
+
+
+def start_request():
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def finish_request(token, timings, view, method, status, seconds):
+    _current.reset(token)
+    labels = (('view', view),)
+    registry.inc('socialhub_requests_total', labels + (('method', method), ('status', str(status))))
+    registry.observe('socialhub_request_duration_seconds', labels + (('method', method),), seconds)
+    registry.inc('socialhub_sql_queries_total', labels, timings.sql.count)
+    registry.observe('socialhub_sql_duration_seconds', labels, timings.sql.seconds)
+    registry.observe('socialhub_template_render_seconds', labels, timings.template_seconds)
+    if timings.storage_calls:
+        for operation, count in timings.storage_calls.items():
+            registry.inc('socialhub_storage_calls_total', labels + (('operation', operation),), count)
+        registry.observe('socialhub_storage_duration_seconds', labels, timings.storage_seconds)
+    flush()
+
+
+@contextmanager
+def timed(kind, operation=None):
+    # Adds the time of the block to the current request's template or
+    # storage time. Calls nested in one being timed (an include rendering
+    # another template, save() calling exists()) aren't counted again
+    timings = _current.get()
+    if timings is None or kind in timings._active:
+        yield
+        return
+    timings._active.add(kind)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        timings._active.discard(kind)
+        if kind == 'template':
+            timings.template_seconds += elapsed
+        else:
+            timings.storage_seconds += elapsed
+            timings.storage_calls[operation] = timings.storage_calls.get(operation, 0) + 1
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    # The Django template backend, with render() timed (settings.TEMPLATES)
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+class TimedTemplate:
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        with timed('template'):
+            return self.template.render(context, request)
+
+
+class TimedStorageMixin:
+    # Times the storage operations that go over the network
+
+    def save(self, name, content, max_length=None):
+        with timed('storage', 'save'):
+            return super().save(name, content, max_length=max_length)
+
+    def open(self, name, mode='rb'):
+        with timed('storage', 'open'):
+            return super().open(name, mode)
+
+    def delete(self, name):
+        with timed('storage', 'delete'):
+            return super().delete(name)
+
+    def exists(self, name):
+        with timed('storage', 'exists'):
+            return super().exists(name)
+
+    def size(self, name):
+        with timed('storage', 'size'):
+            return super().size(name)
+
+    def listdir(self, path):
+        with timed('storage', 'listdir'):
+            return super().listdir(path)
@@ -0,0 +1,262 @@
+import time
+from contextlib import contextmanager
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import HttpResponse
+from . import metrics
+from . import query_budgets
+from . import replicas
+from . import sharding
+from .slow_queries import SlowQueryLog
+from .viewer import ViewerContext
+
+
+# Execute wrappers go on every database connection (the primary, its read
+# replicas and the shards), so the queries of a view reading from a replica
+# or a shard count too
+
+def add_execute_wrapper(wrapper):
+    for connection in connections.all():
+        connection.execute_wrappers.append(wrapper)
+
+
+def remove_execute_wrapper(wrapper):
+    for connection in connections.all():
+        connection.execute_wrappers.remove(wrapper)
+
+
+@contextmanager
+def execute_wrapper(wrapper):
+    add_execute_wrapper(wrapper)
+    try:
+        yield
+    finally:
+        remove_execute_wrapper(wrapper)
+
+
+class ViewerContextMiddleware:
+    # Attaches a ViewerContext to request.viewer and request.user.viewer so the
+    # model helpers, views and templates can answer membership/role/follow
+    # checks from preloaded ID sets instead of one query per check
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        self.attach(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        # Loading request.user (session and user queries) is sync-only; it
+        # happens here, once, so async views can read request.user directly
+        await sync_to_async(self.attach)(request)
+        return await self.get_response(request)
+
+    def attach(self, request):
+        viewer = ViewerContext(request.user)
+        request.viewer = viewer
+        request.user.viewer = viewer
+
+
+class QueryBudgetMiddleware:
+    # Counts the SQL queries of each request and checks them against its
+    # view's budget (application.query_budgets); the count is also sent back
+    # in an X-Query-Count header. Meant for staging: with QUERY_BUDGET_MODE
+    # 'off' (the default) it removes itself from the stack
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if settings.QUERY_BUDGET_MODE == 'off':
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        counter = query_budgets.QueryCounter()
+        with execute_wrapper(counter):
+            response = self.get_response(request)
+        return self.finish(request, response, counter.count)
+
+    async def __acall__(self, request):
+        # The async views and middleware query through sync_to_async, on the
+        # request's own thread and connections, so the counter is installed
+        # (and removed) there rather than on this context's connections
+        counter = query_budgets.QueryCounter()
+        await sync_to_async(add_execute_wrapper)(counter)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(remove_execute_wrapper)(counter)
+        return self.finish(request, response, counter.count)
+
+    def finish(self, request, response, count):
+        response['X-Query-Count'] = str(count)
+        if request.resolver_match is not None:
+            query_budgets.check(request.resolver_match.url_name, request.path, count, request.method)
+        return response
+
+
+class MetricsMiddleware:
+    # Records each request's duration, SQL queries and time, template render
+    # time and storage time by view (application.metrics). Streaming
+    # responses are timed until the view returns, not until the last chunk
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings, token = metrics.start_request()
+        started = time.perf_counter()
+        with execute_wrapper(timings.sql):
+            response = self.get_response(request)
+        self.finish(request, response, token, timings, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        # As in QueryBudgetMiddleware, the SQL timer goes on the connections
+        # of the request's sync_to_async thread
+        timings, token = metrics.start_request()
+        started = time.perf_counter()
+        await sync_to_async(add_execute_wrapper)(timings.sql)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(remove_execute_wrapper)(timings.sql)
+        self.finish(request, response, token, timings, time.perf_counter() - started)
+        return response
+
+    def finish(self, request, response, token, timings, seconds):
+        match = request.resolver_match
+        view = match.url_name or match.view_name if match is not None else metrics.UNRESOLVED
+        metrics.finish_request(token, timings, view, request.method, response.status_code, seconds)
+
+
+class SlowQueryMiddleware:
+    # Logs the slow queries of the views in settings.SLOW_QUERY_VIEWS with
+    # their plans (application.slow_queries); SLOW_QUERY_MS = 0 turns it off
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.SLOW_QUERY_MS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with execute_wrapper(SlowQueryLog(request)):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        slow_query_log = SlowQueryLog(request)
+        await sync_to_async(add_execute_wrapper)(slow_query_log)
+        try:
+            return await self.get_response(request)
+        finally:
+            await sync_to_async(remove_execute_wrapper)(slow_query_log)
+
+
+class ReplicaMiddleware:
+    # Lets the views marked @read_from_replica read from a replica, and pins
+    # a session that wrote to the primary for REPLICA_STICKY_SECONDS
+    # (application.replicas). Not used without DATABASE_REPLICAS
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = replicas.start_request(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = replicas.finish_request(token)
+        return self.finish(request, response, wrote)
+
+    async def __acall__(self, request):
+        token = replicas.start_request(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            wrote = replicas.finish_request(token)
+        return self.finish(request, response, wrote)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        replicas.use_replica_for(request, view_func)
+
+    def finish(self, request, response, wrote):
+        # Only a write pins: a POST that just reads (the search form) leaves
+        # the session on the replicas
+        if wrote:
+            response.set_cookie(replicas.PIN_COOKIE, '1', max_age=settings.REPLICA_STICKY_SECONDS,
+                                httponly=True, samesite='Lax')
+        return response
+
+
+class ShardMiddleware:
+    # Sends the content queries of views with a community_id argument to the
+    # community's shard (application.sharding). While move_community copies
+    # the community, its pages stay readable but writes are turned away.
+    # Not used with a single shard
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not sharding.enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = sharding.start_request()
+        try:
+            return self.get_response(request)
+        finally:
+            sharding.finish_request(token)
+
+    async def __acall__(self, request):
+        token = sharding.start_request()
+        try:
+            return await self.get_response(request)
+        finally:
+            sharding.finish_request(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        found = sharding.use_shard_for(view_kwargs)
+        if found is not None and found[1] and request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            response = HttpResponse('This community is being moved. Please try again in a minute.', status=503)
+            response['Retry-After'] = '60'
+            return response
@@ -0,0 +1,16 @@
+from django.db import migrations
+
+
+def postgres_only(sql, reverse_sql):
+    # Raw DDL that only makes sense on PostgreSQL (GIN/trigram indexes,
+    # extensions). It is skipped on other backends such as the SQLite
+    # databases used in tests.
+    def forwards(apps, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.execute(sql)
+
+    def backwards(apps, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.execute(reverse_sql)
+
+    return migrations.RunPython(forwards, backwards)
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.11 on 2026-10-18 18:08
+
+import django.contrib.postgres.search
+from django.db import migrations, models
+import django.db.models.deletion
+from application.migration_utils import postgres_only
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0023_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('post', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='application.post')),
+                ('title', models.TextField()),
+                ('body', models.TextField(blank=True, default='')),
+                ('search_vector', django.contrib.postgres.search.SearchVectorField(null=True)),
+                ('community', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='application.community')),
+            ],
+        ),
+        postgres_only(
+            'CREATE INDEX application_searchdocument_vector_gin ON application_searchdocument USING gin (search_vector)',
+            'DROP INDEX IF EXISTS application_searchdocument_vector_gin',
+        ),
+    ]
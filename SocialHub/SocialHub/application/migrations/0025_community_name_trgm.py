@@ -0,0 +1,18 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+from application.migration_utils import postgres_only
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0024_searchdocument'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        postgres_only(
+            'CREATE INDEX application_community_name_trgm ON application_community USING gin ((UPPER(name::text)) gin_trgm_ops)',
+            'DROP INDEX IF EXISTS application_community_name_trgm',
+        ),
+    ]
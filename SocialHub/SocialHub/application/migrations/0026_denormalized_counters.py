@@ -0,0 +1,53 @@
+# Generated by Django 4.2.11 on 2026-10-18 18:11
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_existing_rows(apps, schema_editor):
+    Community = apps.get_model('application', 'Community')
+    CommunityMembership = apps.get_model('application', 'CommunityMembership')
+    Post = apps.get_model('application', 'Post')
+    Comment = apps.get_model('application', 'Comment')
+
+    def count_of(model, fk):
+        return Coalesce(Subquery(
+            model.objects.filter(**{fk: OuterRef('pk')}).order_by().values(fk).annotate(n=Count('pk')).values('n')
+        ), 0)
+
+    Community.objects.update(
+        member_count=count_of(CommunityMembership, 'community'),
+        post_count=count_of(Post, 'community'),
+    )
+    Post.objects.update(comment_count=count_of(Comment, 'post'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0025_community_name_trgm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='community',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='community',
+            name='post_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='community',
+            index=models.Index(fields=['-member_count', 'id'], name='community_popular_idx'),
+        ),
+        migrations.RunPython(count_existing_rows, migrations.RunPython.noop),
+    ]
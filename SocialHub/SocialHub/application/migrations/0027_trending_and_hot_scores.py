@@ -0,0 +1,57 @@
+# Generated by Django 4.2.11 on 2026-10-18 18:12
+
+import math
+from django.db import migrations, models
+
+
+def score_existing_posts(apps, schema_editor):
+    # Same formula as application.ranking.hot_score at the time of writing
+    Post = apps.get_model('application', 'Post')
+    for post in Post.objects.only('id', 'comment_count', 'created_at').iterator():
+        score = round(math.log10(max(post.comment_count, 1)) + post.created_at.timestamp() / 45000, 7)
+        Post.objects.filter(pk=post.pk).update(hot_score=score)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0026_denormalized_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('last_run_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='community',
+            name='trending_score',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='hot_score',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['created_at'], name='comment_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='community',
+            index=models.Index(fields=['-trending_score', 'id'], name='community_trending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='communitymembership',
+            index=models.Index(fields=['date_joined'], name='membership_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['community', '-hot_score', '-id'], name='post_community_hot_idx'),
+        ),
+        migrations.RunPython(score_existing_posts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.11 on 2026-10-18 18:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0027_trending_and_hot_scores'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='community',
+            name='cache_version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='cache_version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='template',
+            name='cache_version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
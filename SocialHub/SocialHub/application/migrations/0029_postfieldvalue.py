@@ -0,0 +1,38 @@
+# Generated by Django 4.2.11 on 2026-10-18 18:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+from application.migration_utils import postgres_only
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0028_fragment_cache_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostFieldValue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field_name', models.CharField(max_length=255)),
+                ('field_type', models.CharField(max_length=100)),
+                ('number_value', models.FloatField(blank=True, null=True)),
+                ('date_value', models.DateField(blank=True, null=True)),
+                ('time_value', models.TimeField(blank=True, null=True)),
+                ('text_value', models.CharField(blank=True, max_length=255, null=True)),
+                ('community', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='application.community')),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='field_values', to='application.post')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['community', 'field_name', 'number_value'], name='fieldvalue_number_idx'), models.Index(fields=['community', 'field_name', 'date_value'], name='fieldvalue_date_idx'), models.Index(fields=['community', 'field_name', 'time_value'], name='fieldvalue_time_idx'), models.Index(fields=['community', 'field_name', 'text_value'], name='fieldvalue_text_idx')],
+                'unique_together': {('post', 'field_name')},
+            },
+        ),
+        # For ad hoc containment queries (Post.objects.filter(data__contains={...})) on PostgreSQL
+        postgres_only(
+            'CREATE INDEX application_post_data_gin ON application_post USING gin (data jsonb_path_ops)',
+            'DROP INDEX IF EXISTS application_post_data_gin',
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.11 on 2026-10-18 18:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0029_postfieldvalue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostLocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field_name', models.CharField(max_length=255)),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('cell', models.IntegerField()),
+                ('community', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='application.community')),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='locations', to='application.post')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['community', 'cell'], name='location_cell_idx'), models.Index(fields=['community', 'latitude', 'longitude'], name='location_latlng_idx')],
+                'unique_together': {('post', 'field_name')},
+            },
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.11 on 2026-10-18 18:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import CharField, Value
+from django.db.models.functions import Cast, LPad
+
+
+def backfill_paths(apps, schema_editor):
+    # Existing comments are all top-level: the path is the padded id
+    Comment = apps.get_model('application', 'Comment')
+    Comment.objects.update(path=LPad(Cast('id', CharField()), 10, Value('0')), depth=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0032_mediablob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='replies', to='application.comment'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='reply_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'path'], name='comment_post_path_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'depth', 'path'], name='comment_post_thread_idx'),
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+    ]
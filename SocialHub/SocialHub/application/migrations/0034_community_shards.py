@@ -0,0 +1,66 @@
+# Generated by Django 4.2.11 on 2026-10-18 19:39
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('application', '0033_comment_threads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='community',
+            name='moving_to',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='community',
+            name='shard',
+            field=models.CharField(default='default', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='comment',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='community',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='posts', to='application.community'),
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='created_by',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='postfieldvalue',
+            name='community',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='application.community'),
+        ),
+        migrations.AlterField(
+            model_name='postlocation',
+            name='community',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='application.community'),
+        ),
+        migrations.AlterField(
+            model_name='searchdocument',
+            name='community',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='application.community'),
+        ),
+        migrations.AlterField(
+            model_name='template',
+            name='community',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='templates', to='application.community'),
+        ),
+        migrations.AlterField(
+            model_name='timelineentry',
+            name='post',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='timeline_entries', to='application.post'),
+        ),
+    ]
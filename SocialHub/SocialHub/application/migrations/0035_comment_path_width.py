@@ -0,0 +1,49 @@
+from django.db import migrations
+
+# threads.SEGMENT_WIDTH when this migration was written
+SEGMENT_WIDTH = 19
+BATCH_SIZE = 1000
+
+
+def repad_paths(apps, schema_editor):
+    # Rebuilds every path from the parent chain with the wider segments (ids
+    # from a shard's range didn't fit the old ones, so their paths can't be
+    # split up again), and counts the replies below each comment again
+    Comment = apps.get_model('application', 'Comment')
+    comments = Comment.objects.using(schema_editor.connection.alias)
+    post_id, paths, changed, reply_counts = None, {}, [], {}
+
+    def flush():
+        for comment in changed:
+            comment.reply_count = reply_counts.get(comment.id, 0)
+        comments.bulk_update(changed, ['path', 'reply_count'], batch_size=BATCH_SIZE)
+        changed.clear()
+        reply_counts.clear()
+
+    # Parents come before their replies: a reply is one level deeper
+    rows = comments.order_by('post_id', 'depth', 'id').only('id', 'post_id', 'parent_id', 'path', 'reply_count')
+    for comment in rows.iterator(chunk_size=BATCH_SIZE):
+        if comment.post_id != post_id:
+            # A post's whole thread is written in the same batch
+            if len(changed) >= BATCH_SIZE:
+                flush()
+            post_id, paths = comment.post_id, {}
+        parent_path = paths.get(comment.parent_id, '')
+        comment.path = parent_path + str(comment.id).zfill(SEGMENT_WIDTH)
+        paths[comment.id] = comment.path
+        for start in range(0, len(parent_path), SEGMENT_WIDTH):
+            ancestor_id = int(parent_path[start:start + SEGMENT_WIDTH])
+            reply_counts[ancestor_id] = reply_counts.get(ancestor_id, 0) + 1
+        changed.append(comment)
+    flush()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0034_community_shards'),
+    ]
+
+    operations = [
+        migrations.RunPython(repad_paths, migrations.RunPython.noop),
+    ]
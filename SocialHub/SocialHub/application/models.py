@@ -1,6 +1,7 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth import get_user_model
 from django.db.models import JSONField
+from django.contrib.postgres.search import SearchVectorField
 from django.core.exceptions import PermissionDenied
 
 User = get_user_model()
@@ -13,9 +14,43 @@ class Community(models.Model):
     invited = models.ManyToManyField(User, related_name='invited_communities')
     members = models.ManyToManyField(User, through='CommunityMembership', related_name='members')
     isPrivate = models.BooleanField(blank=True, null=True)
+    # Maintained by application.signals; repaired by the reconcile_counters command
+    member_count = models.PositiveIntegerField(default=0)
+    post_count = models.PositiveIntegerField(default=0)
+    # Time-decayed activity score, refreshed by the refresh_scores command (see application.ranking)
+    trending_score = models.FloatField(default=0)
+    # Bumped whenever something rendered in a cached fragment changes (see application.signals)
+    cache_version = models.PositiveIntegerField(default=1)
+    # Database alias holding the community's content, and the one it is being
+    # copied to by move_community (see application.sharding)
+    shard = models.CharField(max_length=100, default='default')
+    moving_to = models.CharField(max_length=100, blank=True, default='')
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-member_count', 'id'], name='community_popular_idx'),
+            models.Index(fields=['-trending_score', 'id'], name='community_trending_idx'),
+        ]
+
+    # The checks below answer from request.user.viewer (see ViewerContextMiddleware)
+    # when it is attached, and fall back to a query otherwise
     def is_member(self, user):
+        viewer = getattr(user, 'viewer', None)
+        if viewer is not None:
+            return viewer.is_member(self.id)
         return self.members.filter(id=user.id).exists()
+
+    def is_admin(self, user):
+        viewer = getattr(user, 'viewer', None)
+        if viewer is not None:
+            return viewer.is_admin(self.id)
+        return self.admin.filter(id=user.id).exists()
+
+    def is_invited(self, user):
+        viewer = getattr(user, 'viewer', None)
+        if viewer is not None:
+            return viewer.is_invited(self.id)
+        return self.invited.filter(id=user.id).exists()
     
     def make_moderator(self, user):
         self.moderator.add(user)
@@ -33,6 +68,10 @@ class CommunityMembership(models.Model):
 
     class Meta:
         unique_together = ('community', 'user')
+        indexes = [
+            models.Index(fields=['community', 'date_joined', 'id'], name='membership_community_date_idx'),
+            models.Index(fields=['date_joined'], name='membership_date_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.community.name}"
@@ -40,7 +79,10 @@ class CommunityMembership(models.Model):
 class Template(models.Model):
     title = models.CharField(max_length=255)
     description = models.TextField()
-    community = models.ForeignKey(Community, on_delete=models.CASCADE, related_name='templates', null=True)
+    # Foreign keys to the default database's tables aren't constraints, as
+    # the row may be on a shard (see application.sharding)
+    community = models.ForeignKey(Community, on_delete=models.CASCADE, related_name='templates', null=True, db_constraint=False)
+    cache_version = models.PositiveIntegerField(default=1)
 
     def __str__(self):
         return self.title
@@ -54,29 +96,185 @@ class TemplateField(models.Model):
         return f"{self.field_name} ({self.field_type})"
 
 class Post(models.Model):
-    community = models.ForeignKey(Community, on_delete=models.CASCADE, related_name='posts')
+    community = models.ForeignKey(Community, on_delete=models.CASCADE, related_name='posts', db_constraint=False)
     title = models.CharField(max_length=255)
     data = models.JSONField(default=dict)  # JSON to store dynamic field stuff
-    created_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    comment_count = models.PositiveIntegerField(default=0)
+    hot_score = models.FloatField(default=0)
+    cache_version = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['community', '-created_at', '-id'], name='post_community_recent_idx'),
+            models.Index(fields=['-created_at', '-id'], name='post_recent_idx'),
+            models.Index(fields=['community', '-hot_score', '-id'], name='post_community_hot_idx'),
+        ]
 
     def __str__(self):
         return self.title
     
     def delete(self, user, *args, **kwargs):
-        if self.created_by == user or user == self.community.admin:
-            super().delete(*args, **kwargs)
+        if self.created_by_id == user.id or user == self.community.admin:
+            # The comments go in one statement, without their delete signals:
+            # the cascade would collect them level by level and update the
+            # reply and comment counts of rows that are going away anyway
+            using = kwargs.get('using') or self._state.db
+            with transaction.atomic(using=using):
+                self.comments.using(using).all()._raw_delete(using)
+                super().delete(*args, **kwargs)
         else:
             raise PermissionDenied("You do not have permission to delete this post.")
 
     
 class Comment(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='comments')
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+    # Threading: path is the zero-padded ids from the top-level comment down
+    # to this one, so a subtree is one range scan (see application.threads)
+    parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='replies')
+    path = models.CharField(max_length=255, blank=True, default='')
+    depth = models.PositiveSmallIntegerField(default=0)
+    reply_count = models.PositiveIntegerField(default=0)  # all descendants, not just direct replies
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['post', 'created_at', 'id'], name='comment_post_created_idx'),
+            models.Index(fields=['created_at'], name='comment_created_idx'),
+            models.Index(fields=['post', 'path'], name='comment_post_path_idx'),
+            models.Index(fields=['post', 'depth', 'path'], name='comment_post_thread_idx'),
+        ]
 
     def __str__(self):
         return f'Comment by {self.user.username} on {self.post.title}'
-    
 
+class TimelineEntry(models.Model):
+    # Fan-out-on-write home timeline: one row per (follower, post)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='timeline_entries')
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='timeline_entries', db_constraint=False)
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField()  # copy of post.created_at so the page is read from one index
+
+    class Meta:
+        unique_together = ('user', 'post')
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id'], name='timeline_user_recent_idx'),
+            models.Index(fields=['user', 'author'], name='timeline_user_author_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.post.title} in timeline of {self.user.username}"
+
+class SearchDocument(models.Model):
+    # Denormalized search text for a post: its title plus the text values of
+    # its template fields. search_vector is maintained on PostgreSQL and has a
+    # GIN index created in migration 0024 (see application.search)
+    post = models.OneToOneField(Post, on_delete=models.CASCADE, primary_key=True, related_name='search_document')
+    community = models.ForeignKey(Community, on_delete=models.CASCADE, related_name='+', db_constraint=False)
+    title = models.TextField()
+    body = models.TextField(blank=True, default='')
+    search_vector = SearchVectorField(null=True)
+
+    def __str__(self):
+        return f"Search document for {self.title}"
+
+class JobCheckpoint(models.Model):
+    # Last successful run of a periodic job, so the next run only looks at newer rows
+    name = models.CharField(max_length=100, unique=True)
+    last_run_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name} at {self.last_run_at}"
+
+class PostFieldValue(models.Model):
+    # One typed, indexed row per filterable template field of a post, mirrored
+    # from Post.data (see application.filtering)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='field_values')
+    community = models.ForeignKey(Community, on_delete=models.CASCADE, related_name='+', db_constraint=False)
+    field_name = models.CharField(max_length=255)
+    field_type = models.CharField(max_length=100)
+    number_value = models.FloatField(null=True, blank=True)
+    date_value = models.DateField(null=True, blank=True)
+    time_value = models.TimeField(null=True, blank=True)
+    text_value = models.CharField(max_length=255, null=True, blank=True)
+
+    class Meta:
+        unique_together = ('post', 'field_name')
+        indexes = [
+            models.Index(fields=['community', 'field_name', 'number_value'], name='fieldvalue_number_idx'),
+            models.Index(fields=['community', 'field_name', 'date_value'], name='fieldvalue_date_idx'),
+            models.Index(fields=['community', 'field_name', 'time_value'], name='fieldvalue_time_idx'),
+            models.Index(fields=['community', 'field_name', 'text_value'], name='fieldvalue_text_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.field_name} of post {self.post_id}"
+
+
+class PostLocation(models.Model):
+    # One row per geolocation field of a post, mirrored from Post.data with a
+    # grid cell so area queries are index range scans (see application.geo)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='locations')
+    community = models.ForeignKey(Community, on_delete=models.CASCADE, related_name='+', db_constraint=False)
+    field_name = models.CharField(max_length=255)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    cell = models.IntegerField()
+
+    class Meta:
+        unique_together = ('post', 'field_name')
+        indexes = [
+            models.Index(fields=['community', 'cell'], name='location_cell_idx'),
+            models.Index(fields=['community', 'latitude', 'longitude'], name='location_latlng_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.field_name} of post {self.post_id}"
+
+
+class ImageJob(models.Model):
+    # An uploaded image waiting in the local staging area for the
+    # process_images worker to turn it into stored variants (see application.images)
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='image_jobs')
+    field_name = models.CharField(max_length=255)
+    staged_name = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='imagejob_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.field_name} of post {self.post_id} ({self.status})"
+
+
+class MediaBlob(models.Model):
+    # One stored object of the content-addressed media storage, with the
+    # number of saves that still refer to it (see application.storage)
+    name = models.CharField(max_length=255, primary_key=True)
+    sha256 = models.CharField(max_length=64)
+    size = models.BigIntegerField()
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
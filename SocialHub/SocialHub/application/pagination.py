@@ -0,0 +1,120 @@
+import base64
+import binascii
+import datetime
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import QueryDict
+
+PAGE_SIZE = 20
+
+
+class KeysetPage:
+    # One page of a keyset-paginated list plus the query string for "load more"
+    def __init__(self, items, next_cursor, querydict=None, param='cursor'):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.querydict = querydict
+        self.param = param
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def next_querystring(self):
+        # Keeps the other lists' cursors so only this list advances
+        if self.next_cursor is None:
+            return ''
+        params = self.querydict.copy() if self.querydict is not None else QueryDict(mutable=True)
+        params[self.param] = self.next_cursor
+        return params.urlencode()
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    # DjangoJSONEncoder cuts datetimes and times down to milliseconds, and a
+    # cursor compared at that precision skips (or repeats) the rows that share
+    # its millisecond; isoformat() keeps the microseconds
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, cls=CursorEncoder).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, ValueError, UnicodeDecodeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def _keyset_filter(model, ordering, values):
+    # (a, b) after (va, vb) in the given directions, spelled out as
+    # a < va OR (a = va AND b < vb), with a <= va up front so the leading
+    # column bounds the index range
+    fields = [model._meta.get_field(name.lstrip('-')) for name in ordering]
+    values = [field.to_python(value) for field, value in zip(fields, values)]
+    condition = Q()
+    equal = Q()
+    for name, field, value in zip(ordering, fields, values):
+        op = 'lt' if name.startswith('-') else 'gt'
+        condition |= equal & Q(**{f'{field.name}__{op}': value})
+        equal &= Q(**{field.name: value})
+    first = ordering[0]
+    bound = Q(**{f"{fields[0].name}__{'lte' if first.startswith('-') else 'gte'}": values[0]})
+    return bound & condition
+
+
+def _page_query(queryset, querydict, param, ordering, page_size):
+    cursor = querydict.get(param) if querydict is not None else None
+    if cursor:
+        values = decode_cursor(cursor)
+        if values is not None and len(values) == len(ordering):
+            try:
+                queryset = queryset.filter(_keyset_filter(queryset.model, ordering, values))
+            except (ValidationError, TypeError):
+                pass  # a tampered cursor just starts from the first page
+    return queryset.order_by(*ordering)[:page_size + 1]
+
+
+def _page(rows, model, querydict, param, ordering, page_size):
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = encode_cursor([
+            getattr(last, model._meta.get_field(name.lstrip('-')).attname) for name in ordering
+        ])
+    return KeysetPage(rows, next_cursor, querydict, param)
+
+
+def paginate(queryset, request=None, param='cursor', ordering=('-created_at', '-id'), page_size=PAGE_SIZE):
+    # Keyset (cursor) pagination: each page is an index range starting after
+    # the last row of the previous one, so deep pages cost the same as the first
+    querydict = request.GET if request is not None else None
+    rows = list(_page_query(queryset, querydict, param, ordering, page_size))
+    return _page(rows, queryset.model, querydict, param, ordering, page_size)
+
+
+async def apaginate(queryset, request=None, param='cursor', ordering=('-created_at', '-id'), page_size=PAGE_SIZE):
+    # paginate() for async views
+    querydict = request.GET if request is not None else None
+    rows = [row async for row in _page_query(queryset, querydict, param, ordering, page_size)]
+    return _page(rows, queryset.model, querydict, param, ordering, page_size)
@@ -0,0 +1,116 @@
+import logging
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# QUERY BUDGETS
+# The most SQL queries one request to each view may run, by URL name, for
+# every URL of application/urls.py and users/urls.py. They include the
+# session, user and viewer context queries of the middleware, and they must
+# hold at any amount of data: a view whose count grows with its rows (an N+1)
+# goes over sooner or later. QueryBudgetMiddleware reports requests over
+# budget (settings.QUERY_BUDGET_MODE) and `benchmark_views --check-budgets`
+# fails on them at a seeded scale
+QUERY_BUDGETS = {
+    # application/urls.py
+    'home': 9,
+    'search': 6,
+    'typeahead': 4,
+    'create_community': 18,  # the POST: community, roles, membership, default template
+    'community_content': 13,
+    'community_locations': 5,
+    'community_events': 5,  # under ASGI, turning away a private community's outsider
+    'join_community': 9,
+    'leave_community': 7,
+    'list_communities': 7,
+    'manage_community': 4,
+    'import_posts': 6,  # the upload form; see UNBOUNDED for the import
+    'export_community': 7,
+    'create_template': 4,
+    'create_post': 21,  # the POST: the post, its search document, field values, locations, counters and timelines
+    'view_post': 10,
+    'comment_replies': 7,
+    'post_events': 6,  # as community_events, plus the post
+    'edit_post': 12,  # the POST
+    'delete_post': 15,  # the POST: the post and everything indexed from it
+    'invite_users': 4,
+    'add_moderator': 9,
+    'remove_moderator': 8,
+    'view_user': 7,
+    'delete_user': 4,  # the confirmation page; see UNBOUNDED for the delete itself
+    'follow_user': 7,
+    'unfollow_user': 6,
+    'conduct': 3,
+    'metrics': 3,
+    # users/urls.py
+    'login': 3,
+    'logout': 5,
+    'register_user': 3,
+    'view_profile': 3,
+}
+
+# (URL name, method) of the requests exempt from their view's budget.
+# Deleting an account cascades to every post, comment and membership the
+# user has, each deleted with its signal receivers (counters, threads,
+# timelines, media references), so its queries grow with what the user wrote
+# by design; it is one request in an account's life. An import writes its
+# rows in batches of importer.BATCH_SIZE, up to views.IMPORT_MAX_ROWS rows
+UNBOUNDED = {('delete_user', 'POST'), ('import_posts', 'POST')}
+
+# With community shards (application.sharding) the budgets above grow by a
+# fixed allowance plus one per shard, for the views whose queries go to
+# every shard. The default allowance is the community's shard lookup; the
+# prefetches that replace joins across databases add the rest
+SHARDED_ALLOWANCES = {
+    'home': (3, 2),  # the page and the timeline's posts, on each shard
+    'search': (1, 1),
+    'community_content': (2, 0),
+    'view_post': (2, 0),
+}
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryCounter:
+    # A connection.execute_wrapper that counts the queries run through it
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def budget_for(url_name, method='GET'):
+    # None when the request has no budget
+    if (url_name, method) in UNBOUNDED:
+        return None
+    budget = QUERY_BUDGETS.get(url_name)
+    if budget is not None and len(settings.DATABASE_SHARDS) > 1:
+        fixed, per_shard = SHARDED_ALLOWANCES.get(url_name, (1, 0))
+        budget += fixed + per_shard * len(settings.DATABASE_SHARDS)
+    return budget
+
+
+def unbudgeted_url_names():
+    # URL names of application/urls.py and users/urls.py missing from QUERY_BUDGETS
+    from application import urls as application_urls
+    from users import urls as users_urls
+
+    names = {pattern.name for module in (application_urls, users_urls) for pattern in module.urlpatterns if pattern.name}
+    return sorted(names - set(QUERY_BUDGETS))
+
+
+def check(url_name, path, count, method='GET'):
+    # Reports a request that ran more queries than its view's budget, the
+    # way settings.QUERY_BUDGET_MODE says: 'warn' logs it, 'raise' raises
+    budget = budget_for(url_name, method)
+    if budget is None or count <= budget:
+        return
+    message = f'{path} ({url_name}) ran {count} queries, over its budget of {budget}'
+    if settings.QUERY_BUDGET_MODE == 'raise':
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
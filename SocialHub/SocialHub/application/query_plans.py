@@ -0,0 +1,113 @@
+import re
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.http import QueryDict
+from . import geo
+from . import threads
+from .benchmark import benchmark_context
+from .models import Comment, Community, CommunityMembership, Post, PostFieldValue, TimelineEntry
+from .pagination import PAGE_SIZE, _page_query, encode_cursor
+from .search import search_posts
+
+User = get_user_model()
+
+# QUERY PLAN SNAPSHOTS
+# The querysets the busiest pages run, built the way the views build them,
+# against seeded data (see the check_query_plans command). For each one the
+# snapshot keeps how every table is read: 'index' (an index or primary key
+# lookup/scan) or 'seq' (the whole table). A table that was read through an
+# index and is now read in full is a plan regression, e.g. a dropped index or
+# a filter the index doesn't cover any more
+
+
+def _page(queryset, ordering, cursor_row=None):
+    # The first page, or the page after cursor_row, as paginate() queries it
+    querydict = QueryDict(mutable=True)
+    if cursor_row is not None:
+        querydict['cursor'] = encode_cursor([getattr(cursor_row, field.lstrip('-')) for field in ordering])
+    return _page_query(queryset, querydict, 'cursor', ordering, PAGE_SIZE)
+
+
+def _field_filter(c):
+    value = PostFieldValue.objects.filter(community=c['community'], number_value__isnull=False).first()
+    if value is None:
+        return PostFieldValue.objects.none()
+    return (PostFieldValue.objects.filter(community=c['community'], field_name=value.field_name, number_value__gte=value.number_value)
+            .values('post_id'))
+
+
+def _replies(c):
+    comment = c['comment']
+    return (Comment.objects.filter(post_id=comment.post_id, path__gt=comment.path, path__lt=threads.subtree_upper_bound(comment.path))
+            .select_related('user').order_by('path')[:threads.REPLIES_PER_PAGE + 1])
+
+
+Follow = User.following.through
+RECENT = ('-created_at', '-id')
+
+# (label, how to build the queryset from benchmark_context())
+QUERIES = [
+    ('home posts', lambda c: _page(Post.objects.select_related('community', 'created_by'), RECENT)),
+    ('home posts, later page', lambda c: _page(Post.objects.select_related('community', 'created_by'), RECENT, c['post'])),
+    ('home timeline', lambda c: _page(TimelineEntry.objects.filter(user=c['user']).select_related('post', 'post__community', 'post__created_by'), RECENT)),
+    ('popular communities', lambda c: Community.objects.exclude(isPrivate=True).order_by('-member_count', 'id')[:10]),
+    ('viewer memberships', lambda c: CommunityMembership.objects.filter(user_id=c['user'].id).values_list('community_id', flat=True)),
+    ('viewer admin roles', lambda c: Community.admin.through.objects.filter(socialhubuser_id=c['user'].id).values_list('community_id', flat=True)),
+    ('viewer follows', lambda c: Follow.objects.filter(from_socialhubuser_id=c['user'].id).values_list('to_socialhubuser_id', flat=True)),
+    ('community posts', lambda c: _page(c['community'].posts.select_related('created_by'), RECENT)),
+    ('community posts, hot', lambda c: _page(c['community'].posts.select_related('created_by'), ('-hot_score', '-id'))),
+    ('community members', lambda c: _page(CommunityMembership.objects.filter(community=c['community']).select_related('user'), ('date_joined', 'id'))),
+    ('community admins', lambda c: c['community'].admin.values_list('id', flat=True)),
+    ('community field filter', _field_filter),
+    ('community locations', lambda c: geo.in_bbox(c['community'].id, 36, 26, 38, 30)),
+    ('search posts', lambda c: search_posts(c['word'])[:PAGE_SIZE + 1]),
+    ('post comments', lambda c: _page(Comment.objects.filter(post=c['post'], depth=0).select_related('user'), ('path',))),
+    ('comment replies', _replies),
+    ('user followers', lambda c: _page(Follow.objects.filter(to_socialhubuser_id=c['member'].id).select_related('from_socialhubuser'), ('-id',))),
+    ('user posts', lambda c: Post.objects.filter(created_by=c['member']).order_by(*RECENT)[:PAGE_SIZE]),
+]
+
+# PostgreSQL: "Seq Scan on t", "Index Scan [Backward] using i on t",
+# "Index Only Scan using i on t", "Bitmap Heap Scan on t" (not the "Bitmap
+# Index Scan on i" under it)
+POSTGRES_SCAN = re.compile(r'(?<!Bitmap )(Seq Scan|Index Scan|Index Only Scan|Bitmap Heap Scan)(?: Backward)?(?: using \S+)? on (\S+)')
+# SQLite: "SCAN t", "SCAN t USING [COVERING] INDEX i", "SEARCH t USING ..."
+SQLITE_SCAN = re.compile(r'\b(SCAN|SEARCH) (\S+)( USING)?')
+
+
+def scans(plan):
+    # {table: 'index' or 'seq'}; a table read both ways counts as 'seq'
+    found = {}
+    if connection.vendor == 'postgresql':
+        matches = [(table, 'seq' if kind == 'Seq Scan' else 'index') for kind, table in POSTGRES_SCAN.findall(plan)]
+    else:
+        matches = [(table, 'index' if kind == 'SEARCH' or using else 'seq') for kind, table, using in SQLITE_SCAN.findall(plan)]
+    for table, kind in matches:
+        if found.get(table) != 'seq':
+            found[table] = kind
+    return found
+
+
+def capture():
+    # {label: {'scans': {table: kind}, 'plan': text}} for the seeded database
+    context = benchmark_context()
+    if context is None or context['post'] is None or context['comment'] is None:
+        raise ValueError('Nothing to explain: seed the database first')
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')  # fresh planner statistics for the seeded rows
+    plans = {}
+    for label, build in QUERIES:
+        plan = build(context).explain()
+        plans[label] = {'scans': scans(plan), 'plan': plan}
+    return plans
+
+
+def regressions(plans, snapshot):
+    # [(label, table), ...] read in full now but through an index in the snapshot
+    found = []
+    for label, captured in plans.items():
+        before = snapshot.get(label, {})
+        for table, kind in captured['scans'].items():
+            if kind == 'seq' and before.get(table) == 'index':
+                found.append((label, table))
+    return found
@@ -0,0 +1,87 @@
+import math
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+from . import sharding
+from .models import Comment, Community, CommunityMembership, JobCheckpoint, Post
+
+# TRENDING COMMUNITIES
+# score = sum of event weights, halved every TRENDING_HALF_LIFE
+TRENDING_HALF_LIFE = timedelta(hours=24)
+JOIN_WEIGHT = 1.0
+POST_WEIGHT = 2.0
+COMMENT_WEIGHT = 0.5
+# Scores below this are snapped to zero so old communities drop out of the decay update
+MIN_TRENDING_SCORE = 0.01
+# How far back the very first refresh looks
+FIRST_RUN_WINDOW = timedelta(days=7)
+
+# HOT POSTS
+# log10(comments) + age bonus: a post needs 10x the comments to outrank one
+# created HOT_GRAVITY seconds later. Anchored at creation time, so a post's
+# score only changes when its comment count does
+HOT_GRAVITY = 45000
+
+CHECKPOINT = 'refresh_scores'
+# Posts per bulk UPDATE of their hot scores
+BATCH_SIZE = 1000
+
+
+def hot_score(comment_count, created_at):
+    return round(math.log10(max(comment_count, 1)) + created_at.timestamp() / HOT_GRAVITY, 7)
+
+
+def _events_by_community(queryset, community_field, since, until, time_field):
+    return dict(
+        queryset.filter(**{f'{time_field}__gt': since, f'{time_field}__lte': until})
+        .order_by().values_list(community_field).annotate(n=Count('pk'))
+    )
+
+
+def refresh_trending(since, now):
+    decay = 0.5 ** ((now - since) / TRENDING_HALF_LIFE)
+    Community.objects.filter(trending_score__gt=0).update(trending_score=F('trending_score') * decay)
+    Community.objects.filter(trending_score__gt=0, trending_score__lt=MIN_TRENDING_SCORE).update(trending_score=0)
+
+    gained = {}
+    # Posts and comments are counted on every shard
+    for weight, events in (
+        (JOIN_WEIGHT, [_events_by_community(CommunityMembership.objects, 'community_id', since, now, 'date_joined')]),
+        (POST_WEIGHT, sharding.fan_out(lambda: _events_by_community(Post.objects, 'community_id', since, now, 'created_at'))),
+        (COMMENT_WEIGHT, sharding.fan_out(lambda: _events_by_community(Comment.objects, 'post__community_id', since, now, 'created_at'))),
+    ):
+        for shard_events in events:
+            for community_id, count in shard_events.items():
+                gained[community_id] = gained.get(community_id, 0) + weight * count
+    for community_id, score in gained.items():
+        Community.objects.filter(pk=community_id).update(trending_score=F('trending_score') + score)
+    return len(gained)
+
+
+def refresh_hot(since, now):
+    # Only posts that got comments (or were created) since the last run can have moved
+    touched = (Post.objects.filter(Q(created_at__gt=since, created_at__lte=now) | Q(id__in=Comment.objects.filter(created_at__gt=since, created_at__lte=now).values('post_id')))
+               .values_list('id', 'comment_count', 'created_at'))
+    updated, batch = 0, []
+    for post_id, comment_count, created_at in touched.iterator(chunk_size=BATCH_SIZE):
+        batch.append(Post(pk=post_id, hot_score=hot_score(comment_count, created_at)))
+        if len(batch) >= BATCH_SIZE:
+            updated += Post.objects.bulk_update(batch, ['hot_score'])
+            batch = []
+    if batch:
+        updated += Post.objects.bulk_update(batch, ['hot_score'])
+    return updated
+
+
+def refresh_scores(now=None):
+    # Incremental refresh: decays the stored trending scores by the time since
+    # the last run and adds only the events that happened in between
+    now = now or timezone.now()
+    with transaction.atomic():
+        checkpoint = JobCheckpoint.objects.select_for_update().filter(name=CHECKPOINT).first()
+        since = checkpoint.last_run_at if checkpoint else now - FIRST_RUN_WINDOW
+        communities = refresh_trending(since, now)
+        posts = sum(sharding.fan_out(lambda: refresh_hot(since, now)))
+        JobCheckpoint.objects.update_or_create(name=CHECKPOINT, defaults={'last_run_at': now})
+    return communities, posts
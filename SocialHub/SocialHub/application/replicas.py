@@ -0,0 +1,90 @@
+import contextvars
+import random
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# READ REPLICAS
+# settings.DATABASE_REPLICAS are streaming copies of the default (primary)
+# database. Views marked with @read_from_replica read from one of them on
+# GET/HEAD requests; everything else, and every write, uses the primary.
+# Once a request writes, the rest of it reads from the primary, and
+# ReplicaMiddleware pins the browser session to the primary for
+# REPLICA_STICKY_SECONDS with a cookie, so the page it is redirected to
+# already shows the new post, membership or comment even if the replicas
+# lag behind
+
+# Set when a session wrote; reads go to the primary while it lasts
+PIN_COOKIE = 'replica_pin'
+# Sessions and the like are read where they were just written (django_cache
+# is the database cache backend's table)
+PRIMARY_ONLY_APPS = {'sessions', 'contenttypes', 'auth', 'admin', 'django_cache'}
+
+
+def read_from_replica(view):
+    # Marks a read-only view whose GET/HEAD requests may read from a replica
+    view.read_from_replica = True
+    return view
+
+
+class ReplicaState:
+    # What the router knows about the current request
+
+    def __init__(self, pinned):
+        self.pinned = pinned
+        self.replica = None
+        self.wrote = False
+
+
+_current = contextvars.ContextVar('replica_state', default=None)
+
+
+def start_request(request):
+    return _current.set(ReplicaState(pinned=PIN_COOKIE in request.COOKIES))
+
+
+def use_replica_for(request, view):
+    # Called once the view is known (ReplicaMiddleware.process_view)
+    state = _current.get()
+    if (state is not None and not state.pinned and request.method in ('GET', 'HEAD')
+            and getattr(view, 'read_from_replica', False)):
+        # One replica per request, so its reads are consistent with each other
+        state.replica = random.choice(settings.DATABASE_REPLICAS)
+
+
+def finish_request(token):
+    # True when the request wrote to the primary
+    state = _current.get()
+    _current.reset(token)
+    return state is not None and state.wrote
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = _current.get()
+        if state is None:
+            # Outside a request (commands, shell). Not None, which would read
+            # from the database the hinted instance came from, e.g. a shard
+            return DEFAULT_DB_ALIAS
+        if (state.replica is None or state.wrote or model._meta.app_label in PRIMARY_ONLY_APPS
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        # Always the primary, even for an instance that was read from a replica
+        # Filling the database cache isn't a write the session needs to see
+        state = _current.get()
+        if state is not None and model._meta.app_label != 'django_cache':
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema through replication
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
@@ -0,0 +1,170 @@
+import asyncio
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connections, router
+from django.db.models import F, Q, prefetch_related_objects
+from . import sharding
+from .models import Community, Post, SearchDocument
+from .pagination import KeysetPage
+from .typeahead import matching
+
+User = get_user_model()
+
+SEARCH_CONFIG = 'english'
+RESULTS_PER_PAGE = 10
+# Keys create_post duplicates next to the real field (see view_post.html)
+DUPLICATE_KEYS = ('image', 'color')
+
+
+def _uses_postgres(model):
+    return connections[router.db_for_read(model)].vendor == 'postgresql'
+
+
+def document_body(data):
+    # Text values of a post's template fields, in field order
+    if not isinstance(data, dict):
+        return ''
+    skipped = {data.get(key) for key in DUPLICATE_KEYS if data.get(key)}
+    parts = []
+    for key, value in data.items():
+        if key in DUPLICATE_KEYS or key.startswith('_'):
+            continue
+        if isinstance(value, str) and value and value not in skipped:
+            parts.append(value)
+    return '\n'.join(parts)
+
+
+def _search_vector():
+    return (SearchVector('title', weight='A', config=SEARCH_CONFIG)
+            + SearchVector('body', weight='B', config=SEARCH_CONFIG))
+
+
+def index_post(post):
+    SearchDocument.objects.update_or_create(
+        post_id=post.id,
+        defaults={'community_id': post.community_id, 'title': post.title, 'body': document_body(post.data)},
+    )
+    if _uses_postgres(SearchDocument):
+        SearchDocument.objects.filter(pk=post.id).update(search_vector=_search_vector())
+
+
+def reindex(batch_size=1000):
+    # Rebuilds every search document; returns the number of posts indexed
+    indexed = 0
+    batch = []
+    for post in Post.objects.only('id', 'community_id', 'title', 'data').iterator(chunk_size=batch_size):
+        batch.append(post)
+        if len(batch) >= batch_size:
+            indexed += index_posts(batch)
+            batch = []
+    if batch:
+        indexed += index_posts(batch)
+    return indexed
+
+
+def index_posts(posts):
+    # index_post for many posts at once (reindex, bulk import)
+    documents = [
+        SearchDocument(post_id=post.id, community_id=post.community_id, title=post.title, body=document_body(post.data))
+        for post in posts
+    ]
+    SearchDocument.objects.bulk_create(
+        documents, update_conflicts=True, unique_fields=['post'], update_fields=['community', 'title', 'body'],
+    )
+    if _uses_postgres(SearchDocument):
+        SearchDocument.objects.filter(pk__in=[doc.post_id for doc in documents]).update(search_vector=_search_vector())
+    return len(documents)
+
+
+def _page_number(request, param):
+    try:
+        return max(int(request.GET.get(param, 1)), 1)
+    except ValueError:
+        return 1
+
+
+def _offset_page(rows, number, querydict, param):
+    next_page = str(number + 1) if len(rows) > RESULTS_PER_PAGE else None
+    return KeysetPage(rows[:RESULTS_PER_PAGE], next_page, querydict, param)
+
+
+def page_of(queryset, request, param, querydict):
+    # Offset pages are fine here: results are ranked and people rarely go deep
+    number = _page_number(request, param)
+    start = (number - 1) * RESULTS_PER_PAGE
+    rows = list(queryset[start:start + RESULTS_PER_PAGE + 1])
+    return _offset_page(rows, number, querydict, param)
+
+
+async def apage_of(queryset, request, param, querydict):
+    number = _page_number(request, param)
+    start = (number - 1) * RESULTS_PER_PAGE
+    rows = [row async for row in queryset[start:start + RESULTS_PER_PAGE + 1]]
+    return _offset_page(rows, number, querydict, param)
+
+
+def _documents(term):
+    documents = SearchDocument.objects.select_related('post')
+    if _uses_postgres(SearchDocument):
+        query = SearchQuery(term, search_type='websearch', config=SEARCH_CONFIG)
+        documents = (documents.filter(search_vector=query)
+                     .annotate(rank=SearchRank(F('search_vector'), query))
+                     .order_by('-rank', '-post_id'))
+    else:
+        documents = documents.filter(Q(title__icontains=term) | Q(body__icontains=term)).order_by('-post_id')
+    return documents
+
+
+def search_posts(term):
+    return sharding.related(_documents(term), 'post__community', 'post__created_by')
+
+
+def posts_page(term, request, querydict, param='posts_page'):
+    # page_of(search_posts(term)) over every shard: each one's best results
+    # up to the end of the page, merged by rank (PostgreSQL) and id. The
+    # authors and communities are loaded once, for the page's posts
+    if not sharding.enabled():
+        return page_of(search_posts(term), request, param, querydict)
+    number = _page_number(request, param)
+    end = number * RESULTS_PER_PAGE + 1
+    rows = [row for rows in sharding.fan_out(lambda: list(_documents(term)[:end])) for row in rows]
+    rows.sort(key=lambda document: (getattr(document, 'rank', 0), document.post_id), reverse=True)
+    rows = rows[(number - 1) * RESULTS_PER_PAGE:end]
+    prefetch_related_objects([document.post for document in rows], 'community', 'created_by')
+    return _offset_page(rows, number, querydict, param)
+
+
+def search_communities(term):
+    return matching(Community, 'name', term).order_by('name', 'id')
+
+
+def search_users(term):
+    return matching(User, 'username', term).order_by('username', 'id')
+
+
+def search(request, term):
+    # One page per result type; each type pages independently
+    querydict = request.GET.copy()
+    querydict['searched'] = term
+    documents = posts_page(term, request, querydict)
+    documents.items = [document.post for document in documents.items]
+    return {
+        'posts': documents,
+        'communities': page_of(search_communities(term), request, 'communities_page', querydict),
+        'users': page_of(search_users(term), request, 'users_page', querydict),
+    }
+
+
+async def asearch(request, term):
+    # search() for async views; the three result types are queried together
+    querydict = request.GET.copy()
+    querydict['searched'] = term
+    documents, communities, users = await asyncio.gather(
+        sync_to_async(posts_page)(term, request, querydict) if sharding.enabled()
+        else apage_of(search_posts(term), request, 'posts_page', querydict),
+        apage_of(search_communities(term), request, 'communities_page', querydict),
+        apage_of(search_users(term), request, 'users_page', querydict),
+    )
+    documents.items = [document.post for document in documents.items]
+    return {'posts': documents, 'communities': communities, 'users': users}
@@ -0,0 +1,265 @@
+import random
+from contextlib import contextmanager
+from datetime import date, time, timedelta
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from .counters import reconcile
+from .field_types import FIELD_TYPES, get_field_type
+from .filtering import field_value_rows
+from .geo import location_rows
+from .models import Comment, Community, CommunityMembership, Post, PostFieldValue, PostLocation, Template, TemplateField
+from .ranking import hot_score
+from .search import index_posts
+from .threads import MAX_DEPTH, ancestor_ids, segment
+from .timeline import rebuild_timelines
+
+User = get_user_model()
+
+# SYNTHETIC DATA
+# Fills the database with users, follows, communities, memberships,
+# templates, posts and comments drawn from one random.Random(seed), so the
+# same options always give the same rows. Everything is bulk inserted and the
+# derived tables (search documents, field values, locations, comment paths,
+# counters, timelines) are then built the way the reindex commands build them
+
+BATCH_SIZE = 1000
+PASSWORD = 'password'  # every seeded user's password
+PRIVATE_RATIO = 0.2
+REPLY_RATIO = 0.3
+# Replies inserted per batch (see _seed_comments)
+REPLY_BATCH_SIZE = 100
+POSTS_SPAN = timedelta(days=90)
+
+SCALES = {
+    'small': {'users': 50, 'follows': 5, 'communities': 5, 'memberships': 3, 'templates': 2, 'posts': 500, 'comments': 1500},
+    'medium': {'users': 500, 'follows': 20, 'communities': 25, 'memberships': 5, 'templates': 3, 'posts': 10000, 'comments': 30000},
+    'large': {'users': 5000, 'follows': 50, 'communities': 100, 'memberships': 8, 'templates': 3, 'posts': 100000, 'comments': 300000},
+}
+
+WORDS = ('river', 'stone', 'garden', 'signal', 'orbit', 'maple', 'harbor', 'lantern', 'meadow', 'copper',
+         'violet', 'summit', 'canyon', 'ember', 'willow', 'falcon', 'quartz', 'tundra', 'velvet', 'zephyr')
+# Everything but image: seeded posts have no media
+SEED_FIELD_TYPES = [name for name in FIELD_TYPES if name != 'image']
+
+
+def _words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def _cleaned_value(rng, field_name, field_type):
+    # What the create_post form would have cleaned for this field
+    if field_type == 'number':
+        return {field_name: rng.randint(0, 10000)}
+    if field_type == 'float':
+        return {field_name: round(rng.uniform(0, 1000), 2)}
+    if field_type == 'date':
+        return {field_name: date(2020, 1, 1) + timedelta(days=rng.randint(0, 2000))}
+    if field_type == 'time':
+        return {field_name: time(rng.randint(0, 23), rng.choice((0, 15, 30, 45)))}
+    if field_type == 'color':
+        return {field_name: f'#{rng.randint(0, 0xFFFFFF):06x}'}
+    if field_type == 'url':
+        return {field_name: f'https://example.com/{rng.choice(WORDS)}/{rng.randint(1, 999)}'}
+    if field_type == 'email':
+        return {field_name: f'{rng.choice(WORDS)}{rng.randint(1, 999)}@example.com'}
+    if field_type == 'phone':
+        return {field_name: f'+90 5{rng.randint(10, 99)} {rng.randint(100, 999)} {rng.randint(1000, 9999)}'}
+    if field_type == 'geolocation':
+        return {
+            f'{field_name}_latitude': Decimal(f'{rng.uniform(36, 42):.6f}'),
+            f'{field_name}_longitude': Decimal(f'{rng.uniform(26, 45):.6f}'),
+        }
+    if field_type == 'textArea':
+        return {field_name: _words(rng, rng.randint(10, 40))}
+    return {field_name: _words(rng, rng.randint(1, 4))}
+
+
+def _post_data(rng, fields):
+    data = {}
+    for field_name, field_type in fields:
+        data.update(get_field_type(field_type).serialize(field_name, _cleaned_value(rng, field_name, field_type)))
+    return data
+
+
+def _batches(rows, size=BATCH_SIZE):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def seed(users=50, follows=5, communities=5, memberships=3, templates=2, posts=500, comments=1500,
+         seed=0, prefix='seed', log=None):
+    # Returns the number of rows created per model
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+    now = timezone.now()
+    created = {}
+
+    with transaction.atomic():
+        password = make_password(PASSWORD)
+        user_rows = User.objects.bulk_create(
+            [User(username=f'{prefix}{i}', password=password, first_name=rng.choice(WORDS).title()) for i in range(users)],
+            batch_size=BATCH_SIZE,
+        )
+        user_ids = [user.id for user in user_rows]
+        created['users'] = len(user_ids)
+        log(f'{len(user_ids)} users')
+
+        Follow = User.following.through
+        edges = []
+        for user_id in user_ids:
+            followed = [other for other in rng.sample(user_ids, min(follows + 1, len(user_ids))) if other != user_id]
+            edges.extend((user_id, followed_id) for followed_id in followed[:follows])
+        Follow.objects.bulk_create([Follow(from_socialhubuser_id=a, to_socialhubuser_id=b) for a, b in edges], batch_size=BATCH_SIZE)
+        created['follows'] = len(edges)
+        log(f'{len(edges)} follows')
+
+        community_rows = Community.objects.bulk_create([
+            Community(name=f'{prefix} {_words(rng, 2)} {i}', description=_words(rng, 12), isPrivate=rng.random() < PRIVATE_RATIO)
+            for i in range(communities)
+        ], batch_size=BATCH_SIZE)
+        community_ids = [community.id for community in community_rows]
+        created['communities'] = len(community_ids)
+
+        # Each community's first member is its admin and a moderator, like create_community
+        members = {community_id: [] for community_id in community_ids}
+        admins = {community_id: rng.choice(user_ids) for community_id in community_ids}
+        for community_id, admin_id in admins.items():
+            members[community_id].append(admin_id)
+        for user_id in user_ids:
+            for community_id in rng.sample(community_ids, min(memberships, len(community_ids))):
+                if user_id not in members[community_id]:
+                    members[community_id].append(user_id)
+        Community.admin.through.objects.bulk_create(
+            [Community.admin.through(community_id=c, socialhubuser_id=u) for c, u in admins.items()])
+        Community.moderator.through.objects.bulk_create(
+            [Community.moderator.through(community_id=c, socialhubuser_id=u) for c, u in admins.items()])
+        membership_rows = [CommunityMembership(community_id=c, user_id=u) for c, member_ids in members.items() for u in member_ids]
+        CommunityMembership.objects.bulk_create(membership_rows, batch_size=BATCH_SIZE)
+        created['memberships'] = len(membership_rows)
+        log(f'{len(community_ids)} communities, {len(membership_rows)} memberships')
+
+        fields_by_community = {}
+        template_rows = []
+        template_fields = []
+        for community_id in community_ids:
+            for i in range(templates):
+                template_rows.append(Template(title=f'{_words(rng, 2).title()} template', description=_words(rng, 8), community_id=community_id))
+                # A field name always has the same type within a community,
+                # as the filters and maps expect
+                field_types = rng.sample(SEED_FIELD_TYPES, rng.randint(2, 5))
+                template_fields.append([('Description', 'textArea')] + [(field_type.title(), field_type) for field_type in field_types])
+        Template.objects.bulk_create(template_rows, batch_size=BATCH_SIZE)
+        TemplateField.objects.bulk_create([
+            TemplateField(template_id=template.id, field_name=field_name, field_type=field_type)
+            for template, fields in zip(template_rows, template_fields) for field_name, field_type in fields
+        ], batch_size=BATCH_SIZE)
+        for template, fields in zip(template_rows, template_fields):
+            fields_by_community.setdefault(template.community_id, []).append(fields)
+        created['templates'] = len(template_rows)
+
+        post_rows = []
+        post_fields = []
+        for i in range(posts):
+            community_id = rng.choice(community_ids)
+            fields = rng.choice(fields_by_community[community_id]) if fields_by_community.get(community_id) else []
+            post_rows.append(Post(
+                community_id=community_id, title=_words(rng, rng.randint(2, 6)).capitalize(),
+                created_by_id=rng.choice(members[community_id]), data=_post_data(rng, fields),
+            ))
+            post_fields.append(fields)
+        for batch in _batches(post_rows):
+            Post.objects.bulk_create(batch)
+        # created_at is auto_now_add, so the spread over POSTS_SPAN is written afterwards
+        for post in post_rows:
+            post.created_at = now - POSTS_SPAN * rng.random()
+            post.hot_score = hot_score(0, post.created_at)
+        Post.objects.bulk_update(post_rows, ['created_at', 'hot_score'], batch_size=BATCH_SIZE)
+        for batch in _batches(list(zip(post_rows, post_fields))):
+            index_posts([post for post, fields in batch])
+            PostFieldValue.objects.bulk_create([row for post, fields in batch for row in field_value_rows(post, fields)])
+            PostLocation.objects.bulk_create([row for post, fields in batch for row in location_rows(post, fields)])
+        created['posts'] = len(post_rows)
+        log(f'{len(template_rows)} templates, {len(post_rows)} posts')
+
+        created['comments'] = _seed_comments(rng, comments, post_rows, members, now) if post_rows else 0
+        log(f"{created['comments']} comments")
+
+        reconcile()
+    rebuild_timelines(User.objects.filter(id__in=user_ids))
+    log('counters and timelines rebuilt')
+    return created
+
+
+def _seed_comments(rng, count, post_rows, members, now):
+    # Top-level comments first, then replies to random earlier comments on
+    # the same post; paths, depths and reply counts are filled in as
+    # threads.assign_path would have
+    top_level = int(count * (1 - REPLY_RATIO)) or count
+    community_of = {post.id: post.community_id for post in post_rows}
+    comments = []
+    times = []  # created_at is auto_now_add, so the drawn times are written at the end
+    for i in range(top_level):
+        post = rng.choice(post_rows)
+        comments.append(Comment(post_id=post.id, user_id=rng.choice(members[post.community_id]),
+                                content=_words(rng, rng.randint(3, 20)), depth=0))
+        times.append(post.created_at + (now - post.created_at) * rng.random())
+    for batch in _batches(comments):
+        Comment.objects.bulk_create(batch)
+    for comment, created_at in zip(comments, times):
+        comment.path = segment(comment.id)
+        comment.created_at = created_at
+
+    # A reply's path needs its own id, so replies are inserted a batch at a
+    # time and only saved ones are picked as parents
+    by_id = {comment.id: comment for comment in comments}
+    pending = []
+    for i in range(count - top_level):
+        parent = rng.choice(comments)
+        if parent.depth >= MAX_DEPTH:
+            parent = by_id[parent.parent_id]
+        reply = Comment(post_id=parent.post_id, user_id=rng.choice(members[community_of[parent.post_id]]),
+                        content=_words(rng, rng.randint(3, 20)), parent_id=parent.id, depth=parent.depth + 1)
+        reply.drawn_at = parent.created_at + (now - parent.created_at) * rng.random()
+        pending.append(reply)
+        if len(pending) >= REPLY_BATCH_SIZE or i == count - top_level - 1:
+            Comment.objects.bulk_create(pending)
+            for reply in pending:
+                reply.path = by_id[reply.parent_id].path + segment(reply.id)
+                reply.created_at = reply.drawn_at
+                by_id[reply.id] = reply
+            comments.extend(pending)
+            pending = []
+
+    reply_counts = {}
+    for comment in comments:
+        for ancestor_id in ancestor_ids(comment.path):
+            reply_counts[ancestor_id] = reply_counts.get(ancestor_id, 0) + 1
+    for comment in comments:
+        comment.reply_count = reply_counts.get(comment.id, 0)
+    Comment.objects.bulk_update(comments, ['path', 'depth', 'reply_count', 'created_at'], batch_size=BATCH_SIZE)
+    return len(comments)
+
+
+@contextmanager
+def throwaway_database():
+    # A new, migrated test database for the block (as the test runner makes
+    # one); the configured database is back in use afterwards
+    try:
+        setup_test_environment()
+        own_environment = True
+    except RuntimeError:
+        own_environment = False  # already set up, e.g. when called from a test
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        # Only the default database is swapped, so it is the only shard
+        with override_settings(DATABASE_SHARDS=['default']):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        if own_environment:
+            teardown_test_environment()
@@ -0,0 +1,383 @@
+import contextvars
+import threading
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections, transaction
+from django.db.models import Sum, prefetch_related_objects
+from .models import (Comment, Community, ImageJob, Post, PostFieldValue, PostLocation, SearchDocument, Template,
+                     TemplateField)
+from .pagination import PAGE_SIZE, _page, _page_query
+
+# COMMUNITY SHARDS
+# A community's content (its templates, posts, comments and their search,
+# field value, location and image job rows) lives on one database of
+# settings.DATABASE_SHARDS, named by Community.shard. Users, communities,
+# memberships and timelines stay on the default database, since every page
+# reads them across communities. ShardRouter sends the content models to the
+# shard of the community the current request is about (ShardMiddleware reads
+# it from the community_id URL argument), to the database an instance came
+# from, or, outside a request, to the shard picked with in_shard(). Pages that
+# list content from every community (home, search) ask each shard in parallel
+# with fan_out() and merge the results.
+#
+# Ids are unique across shards: every shard's id sequences start at its own
+# multiple of SHARD_ID_SPAN (reserve_id_ranges), so timelines and search can
+# refer to a post by id alone, and move_community copies rows with their ids.
+# Joins between a shard and the default database can't happen in SQL, so
+# related() prefetches what select_related() would join on one database
+
+SHARDED_MODELS = {'post', 'comment', 'template', 'templatefield', 'postfieldvalue', 'postlocation', 'searchdocument', 'imagejob'}
+SHARD_ID_SPAN = 2 ** 40
+
+# What a community moves with, in an order its rows can be inserted in
+# (move_community); deleted in the reverse order
+COMMUNITY_ROWS = [
+    (Template, 'community_id'),
+    (TemplateField, 'template__community_id'),
+    (Post, 'community_id'),
+    (Comment, 'post__community_id'),
+    (SearchDocument, 'community_id'),
+    (PostFieldValue, 'community_id'),
+    (PostLocation, 'community_id'),
+    (ImageJob, 'post__community_id'),
+]
+
+
+def enabled():
+    return len(settings.DATABASE_SHARDS) > 1
+
+
+def is_sharded(model):
+    return model._meta.app_label == 'application' and model._meta.model_name in SHARDED_MODELS
+
+
+class ShardState:
+    # The shard the content models use, and the shards of the communities
+    # looked up so far (shared by the in_shard() blocks of one request)
+
+    def __init__(self, alias=None, shards=None):
+        self.alias = alias
+        self.shards = {} if shards is None else shards
+
+
+_current = contextvars.ContextVar('shard_state', default=None)
+
+
+def current():
+    state = _current.get()
+    return state.alias if state is not None and state.alias else DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def in_shard(alias):
+    # Content models use the given shard inside the block
+    if alias in settings.DATABASE_REPLICAS:
+        alias = DEFAULT_DB_ALIAS
+    parent = _current.get()
+    token = _current.set(ShardState(alias, parent.shards if parent is not None else None))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def atomic():
+    # transaction.atomic() on the current shard
+    return transaction.atomic(using=current())
+
+
+def shard_of(community_id):
+    # Read from the primary: a replica may still name the shard a community
+    # has just left
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    state = _current.get()
+    shards = state.shards if state is not None else {}
+    if community_id not in shards:
+        shards[community_id] = (Community.objects.using(DEFAULT_DB_ALIAS).filter(pk=community_id)
+                                .values_list('shard', flat=True).first() or DEFAULT_DB_ALIAS)
+    return shards[community_id]
+
+
+def start_request():
+    return _current.set(ShardState())
+
+
+def use_shard_for(view_kwargs):
+    # Called once the view is known (ShardMiddleware.process_view); returns
+    # the community's (shard, shard it is moving to) or None
+    community_id = view_kwargs.get('community_id')
+    if community_id is None:
+        return None
+    found = (Community.objects.using(DEFAULT_DB_ALIAS).filter(pk=community_id)
+             .values_list('shard', 'moving_to').first())
+    if found is None:
+        return None  # the view answers 404
+    state = _current.get()
+    state.alias = state.shards[community_id] = found[0]
+    return found
+
+
+def finish_request(token):
+    _current.reset(token)
+
+
+def on_instance_shard(receiver):
+    # For signal receivers of content models: the queries they run go to
+    # the shard the instance was saved to or deleted from
+    @wraps(receiver)
+    def wrapper(sender, instance, **kwargs):
+        if is_sharded(sender) and instance._state.db:
+            with in_shard(instance._state.db):
+                return receiver(sender, instance, **kwargs)
+        return receiver(sender, instance, **kwargs)
+    return wrapper
+
+
+def pick_shard():
+    # For a new community: the shard with the fewest posts among
+    # settings.SHARDS_FOR_NEW_COMMUNITIES (a shard left out of it keeps
+    # the big communities moved there to themselves)
+    candidates = list(settings.SHARDS_FOR_NEW_COMMUNITIES)
+    load = dict(Community.objects.using(DEFAULT_DB_ALIAS).filter(shard__in=candidates)
+                .order_by().values_list('shard').annotate(posts=Sum('post_count')))
+    return min(candidates, key=lambda alias: (load.get(alias) or 0, candidates.index(alias)))
+
+
+class ShardRouter:
+    # Goes before ReplicaRouter; None leaves the default database's models
+    # (and content on the default shard) to it
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints)
+
+    def _shard(self, model, hints):
+        if not is_sharded(model):
+            return None
+        alias = self._from_instance(hints.get('instance')) or current()
+        if alias == DEFAULT_DB_ALIAS or alias in settings.DATABASE_REPLICAS:
+            return None
+        return alias
+
+    def _from_instance(self, instance):
+        if instance is None:
+            return None
+        if isinstance(instance, Community):
+            return instance.shard  # its posts and templates
+        if not is_sharded(instance.__class__):
+            return None
+        if instance._state.db:
+            return instance._state.db
+        # A new row: where its post, template or community is
+        for field in instance._meta.concrete_fields:
+            if field.is_relation and field.is_cached(instance):
+                related = field.get_cached_value(instance)
+                if isinstance(related, Community):
+                    return related.shard
+                if related is not None and is_sharded(related.__class__) and related._state.db:
+                    return related._state.db
+        community_id = getattr(instance, 'community_id', None)
+        return shard_of(community_id) if community_id else None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Every shard gets the whole schema, so its tables match the default's
+        return None
+
+
+# RELATED ROWS AND FAN-OUT
+
+def related(queryset, *fields):
+    # select_related(*fields), or prefetch_related(*fields) when the related
+    # rows may be on another database
+    if enabled():
+        return queryset.prefetch_related(*fields)
+    return queryset.select_related(*fields)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.SHARD_FANOUT_WORKERS, thread_name_prefix='shard')
+    return _executor
+
+
+def _run_on_shard(alias, function, execute_wrappers):
+    # In a pool thread: its own connections, with the caller's execute
+    # wrappers on them so query budgets, metrics and the slow query log
+    # see these queries too
+    close_old_connections()
+    for name, wrappers in execute_wrappers.items():
+        connections[name].execute_wrappers = list(wrappers)
+    try:
+        with in_shard(alias):
+            return function()
+    finally:
+        for name in execute_wrappers:
+            connections[name].execute_wrappers = []
+        close_old_connections()
+
+
+def fan_out(function, aliases=None):
+    # [function() on each shard], run in parallel. Sequential when there is
+    # one shard, inside a transaction (the pool threads wouldn't see its
+    # rows) or when already on a shard
+    aliases = list(settings.DATABASE_SHARDS if aliases is None else aliases)
+    state = _current.get()
+    if (len(aliases) == 1 or (state is not None and state.alias)
+            or any(connections[alias].in_atomic_block for alias in connections)):
+        results = []
+        for alias in aliases:
+            with in_shard(alias):
+                results.append(function())
+        return results
+    execute_wrappers = {alias: list(connections[alias].execute_wrappers) for alias in connections}
+    futures = [
+        # Each task gets a copy of this context (replica and metrics state)
+        _get_executor().submit(contextvars.copy_context().run, _run_on_shard, alias, function, execute_wrappers)
+        for alias in aliases
+    ]
+    return [future.result() for future in futures]
+
+
+def merged(rows, model, ordering):
+    # Rows from several shards in the given order
+    for name in reversed(ordering):
+        attname = model._meta.get_field(name.lstrip('-')).attname
+        rows.sort(key=lambda row: getattr(row, attname), reverse=name.startswith('-'))
+    return rows
+
+
+def paginate(queryset, request=None, param='cursor', ordering=('-created_at', '-id'), page_size=PAGE_SIZE, related_fields=()):
+    # pagination.paginate() over every shard: the same page is read from
+    # each one and the first page_size + 1 rows of the merge are kept, so
+    # the cursor works as on one database. The related rows are loaded for
+    # the kept rows only
+    querydict = request.GET if request is not None else None
+    if not enabled():
+        rows = list(_page_query(related(queryset, *related_fields), querydict, param, ordering, page_size))
+        return _page(rows, queryset.model, querydict, param, ordering, page_size)
+    pages = fan_out(lambda: list(_page_query(queryset.all(), querydict, param, ordering, page_size)))
+    rows = merged([row for page in pages for row in page], queryset.model, ordering)[:page_size + 1]
+    prefetch_related_objects(rows, *related_fields)
+    return _page(rows, queryset.model, querydict, param, ordering, page_size)
+
+
+def in_bulk(queryset, ids):
+    # {id: row} for ids on any shard
+    found = {}
+    for rows in fan_out(lambda: queryset.all().in_bulk(ids)):
+        found.update(rows)
+    return found
+
+
+def find(queryset, **lookup):
+    # The first row matching lookup on any shard, or None, e.g. a template
+    # given by id alone
+    for alias in settings.DATABASE_SHARDS:
+        with in_shard(alias):
+            row = queryset.filter(**lookup).first()
+        if row is not None:
+            return row
+    return None
+
+
+# ID RANGES
+
+def _sequence_tables():
+    return [model._meta.db_table for model in (Template, TemplateField, Post, Comment, PostFieldValue, PostLocation, ImageJob)]
+
+
+def reserve_id_ranges(using, **kwargs):
+    # post_migrate: shard n hands out ids from n * SHARD_ID_SPAN up
+    if using not in settings.DATABASE_SHARDS:
+        return
+    start = settings.DATABASE_SHARDS.index(using) * SHARD_ID_SPAN
+    if not start:
+        return
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        for table in _sequence_tables():
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    f"SELECT setval(pg_get_serial_sequence(%s, 'id'), GREATEST(%s, (SELECT COALESCE(MAX(id), 0) FROM {connection.ops.quote_name(table)})))",
+                    [table, start],
+                )
+            elif connection.vendor == 'sqlite':
+                cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s AND seq < %s', [start, table, start])
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) SELECT %s, %s WHERE NOT EXISTS '
+                               '(SELECT 1 FROM sqlite_sequence WHERE name = %s)', [table, start, table])
+
+
+def id_counters(alias):
+    # SQLite moves its AUTOINCREMENT counter up to any id inserted by hand,
+    # so a copy of rows from a later shard's range would make this shard
+    # hand out that shard's ids; PostgreSQL sequences don't move
+    connection = connections[alias]
+    if connection.vendor != 'sqlite':
+        return {}
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT name, seq FROM sqlite_sequence')
+        return dict(cursor.fetchall())
+
+
+def restore_id_counters(alias, counters):
+    if not counters:
+        return
+    with connections[alias].cursor() as cursor:
+        for table in _sequence_tables():
+            if table in counters:
+                cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [counters[table], table])
+
+
+# MOVING A COMMUNITY (see the move_community command)
+
+def _insert(model, rows, alias):
+    with transaction.atomic(using=alias):
+        model._base_manager.using(alias)._insert(rows, fields=model._meta.local_concrete_fields, using=alias, raw=True)
+    return len(rows)
+
+
+def copy_community(community_id, source, target, batch_size=1000, log=None):
+    # Copies the community's rows from source to target as they are: same
+    # ids, and raw inserts (as loaddata does) so auto_now fields and the
+    # save signals leave them alone. Returns {model name: rows copied}
+    counters = id_counters(target)
+    copied = {}
+    try:
+        for model, lookup in COMMUNITY_ROWS:
+            rows = (model.objects.using(source).filter(**{lookup: community_id}).order_by('pk')
+                    .iterator(chunk_size=batch_size))
+            copied[model.__name__] = 0
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    copied[model.__name__] += _insert(model, batch, target)
+                    batch = []
+            if batch:
+                copied[model.__name__] += _insert(model, batch, target)
+            if log is not None:
+                log(f'{model.__name__}: {copied[model.__name__]} rows copied')
+    finally:
+        restore_id_counters(target, counters)
+    return copied
+
+
+def purge_community(community_id, alias):
+    # Deletes the community's rows from one database without the delete
+    # signals: the rows live on elsewhere, so counters and timelines stay
+    with transaction.atomic(using=alias):
+        for model, lookup in reversed(COMMUNITY_ROWS):
+            queryset = model.objects.using(alias).filter(**{lookup: community_id})
+            queryset._raw_delete(alias)
@@ -0,0 +1,181 @@
+from collections import Counter
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+from . import sharding
+from .counters import bump
+from .live import comment_event, post_event
+from .field_types import forget_template
+from .filtering import community_field_types, index_field_values
+from .geo import index_locations
+from .images import release_variants, variant_paths
+from .models import Comment, Community, CommunityMembership, Post, Template, TemplateField, TimelineEntry
+from .ranking import hot_score
+from .search import index_post
+from .threads import assign_path, forget_reply
+
+User = get_user_model()
+
+
+@receiver(pre_save, sender=Post)
+def post_scored(sender, instance, raw=False, **kwargs):
+    # Written by the INSERT; later changes come from the periodic
+    # refresh_scores job. created_at (auto_now_add) is only filled in by the
+    # save itself, a moment after this
+    if instance._state.adding and not raw:
+        instance.hot_score = hot_score(0, timezone.now())
+
+
+@receiver(post_save, sender=Post)
+@sharding.on_instance_shard
+def post_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    index_post(instance)
+    if created:
+        bump(Community, instance.community_id, post_count=1, cache_version=1)
+        post_event(instance)
+    else:
+        bump(Post, instance.pk, cache_version=1)
+        bump(Community, instance.community_id, cache_version=1)
+        if getattr(instance, '_data_changed', False):
+            # create_post and the importer index new posts with their
+            # template's fields; an edit goes by the community's
+            fields = list(community_field_types(instance.community_id).items())
+            index_field_values(instance, fields)
+            index_locations(instance, fields)
+    dropped = getattr(instance, '_dropped_variants', None)
+    if dropped:
+        transaction.on_commit(lambda: release_variants(dropped), using=sharding.current())
+
+
+@receiver(post_delete, sender=Post)
+@sharding.on_instance_shard
+def post_deleted(sender, instance, **kwargs):
+    bump(Community, instance.community_id, post_count=-1, cache_version=1)
+    variants = variant_paths(instance.data)
+    if variants:
+        transaction.on_commit(lambda: release_variants(variants), using=sharding.current())
+    if instance._state.db != DEFAULT_DB_ALIAS:
+        # The delete cascaded on the shard; the timelines are on the default database
+        TimelineEntry.objects.filter(post_id=instance.pk).delete()
+
+
+# MEDIA
+# A post holds a reference to each stored variant of its images
+# (application.storage). The ones an edit drops are given back once it is
+# saved, and the rest when the post is deleted (post_deleted). The stored
+# data also tells post_saved whether the edit changed it
+@receiver(pre_save, sender=Post)
+@sharding.on_instance_shard
+def post_saving(sender, instance, raw=False, update_fields=None, **kwargs):
+    instance._dropped_variants = []
+    instance._data_changed = False
+    if instance._state.adding or raw or (update_fields is not None and 'data' not in update_fields):
+        return
+    stored = Post.objects.filter(pk=instance.pk).values_list('data', flat=True).first()
+    instance._data_changed = stored != instance.data
+    instance._dropped_variants = list((Counter(variant_paths(stored)) - Counter(variant_paths(instance.data))).elements())
+
+
+# COUNTERS
+@receiver(post_save, sender=CommunityMembership)
+def membership_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        bump(Community, instance.community_id, member_count=1, cache_version=1)
+
+
+@receiver(post_delete, sender=CommunityMembership)
+def membership_deleted(sender, instance, **kwargs):
+    bump(Community, instance.community_id, member_count=-1, cache_version=1)
+
+
+@receiver(post_save, sender=Comment)
+@sharding.on_instance_shard
+def comment_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        assign_path(instance)
+        bump(Post, instance.post_id, comment_count=1, cache_version=1)
+        comment_event(instance)
+    else:
+        bump(Post, instance.post_id, cache_version=1)
+
+
+@receiver(post_delete, sender=Comment)
+@sharding.on_instance_shard
+def comment_deleted(sender, instance, **kwargs):
+    forget_reply(instance)
+    bump(Post, instance.post_id, comment_count=-1, cache_version=1)
+
+
+# FRAGMENT CACHE VERSIONS
+@receiver(post_save, sender=Community)
+def community_saved(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        bump(Community, instance.pk, cache_version=1)
+
+
+@receiver(m2m_changed, sender=Community.admin.through)
+@receiver(m2m_changed, sender=Community.moderator.through)
+def community_roles_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # Changed from the user side: instance is the user, pk_set the communities
+        community_ids = pk_set or ()
+    else:
+        community_ids = (instance.pk,)
+    Community.objects.filter(pk__in=community_ids).update(cache_version=F('cache_version') + 1)
+
+
+@receiver(post_save, sender=Template)
+@receiver(post_delete, sender=Template)
+@sharding.on_instance_shard
+def template_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    bump(Template, instance.pk, cache_version=1)
+    if instance.community_id:
+        bump(Community, instance.community_id, cache_version=1)
+
+
+@receiver(post_save, sender=TemplateField)
+@receiver(post_delete, sender=TemplateField)
+@sharding.on_instance_shard
+def template_field_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        # The version bump invalidates compiled forms in every process; drop ours right away
+        bump(Template, instance.template_id, cache_version=1)
+        forget_template(instance.template_id)
+
+
+# SHARDS
+# Deleting a community or a user only cascades on the default database;
+# their content on the other shards is deleted here first
+@receiver(pre_save, sender=Community)
+def community_placed(sender, instance, raw=False, **kwargs):
+    if instance._state.adding and not raw and sharding.enabled() and instance.shard == DEFAULT_DB_ALIAS:
+        instance.shard = sharding.pick_shard()
+
+
+@receiver(pre_delete, sender=Community)
+def community_deleting(sender, instance, **kwargs):
+    if instance.shard != DEFAULT_DB_ALIAS:
+        with sharding.in_shard(instance.shard):
+            Post.objects.filter(community_id=instance.pk).delete()
+            Template.objects.filter(community_id=instance.pk).delete()
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, **kwargs):
+    for alias in settings.DATABASE_SHARDS:
+        if alias != DEFAULT_DB_ALIAS:
+            with sharding.in_shard(alias):
+                Comment.objects.filter(user_id=instance.pk).delete()
+                Post.objects.filter(created_by_id=instance.pk).delete()
@@ -0,0 +1,60 @@
+import logging
+import time
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# SLOW QUERY LOG
+# SlowQueryMiddleware puts a SlowQueryLog on the connection for each request.
+# A SELECT that takes at least settings.SLOW_QUERY_MS, in one of the views of
+# settings.SLOW_QUERY_VIEWS, is logged with its parameters, the view and the
+# EXPLAIN of the query (plan only: PostgreSQL's ANALYZE stays off, the query
+# is not run again). settings.LOGGING sends this logger to a rotating file
+# when SLOW_QUERY_LOG is set
+
+
+def explain(connection, sql, params):
+    # The plan of sql, run on a bare backend cursor so the other execute
+    # wrappers (query budgets, metrics, this log) don't see it. Inside a
+    # transaction it runs in a savepoint, so an EXPLAIN that fails can't
+    # abort the request's transaction
+    cursor = connection.create_cursor()
+    in_transaction = not connection.get_autocommit()
+    try:
+        if in_transaction:
+            cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            cursor.execute(f'{connection.ops.explain_query_prefix()} {sql}', params)
+            # PostgreSQL returns one line per row, SQLite the detail last
+            return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+        finally:
+            if in_transaction:
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+    except connection.Database.Error as e:
+        return f'(no plan: {e})'
+    finally:
+        cursor.close()
+
+
+class SlowQueryLog:
+    # A connection.execute_wrapper for one request
+
+    def __init__(self, request):
+        self.request = request
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        result = execute(sql, params, many, context)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if elapsed_ms >= settings.SLOW_QUERY_MS and not many and sql.lstrip()[:6].upper().startswith(('SELECT', 'WITH')):
+            match = self.request.resolver_match
+            if match is not None and match.url_name in settings.SLOW_QUERY_VIEWS:
+                self.log(context['connection'], sql, params, match.url_name, elapsed_ms)
+        return result
+
+    def log(self, connection, sql, params, view, elapsed_ms):
+        logger.warning(
+            'Slow query in %s (%s): %.1f ms\nSQL: %s\nParams: %r\nPlan:\n%s',
+            view, self.request.path, elapsed_ms, sql, params, explain(connection, sql, params),
+        )
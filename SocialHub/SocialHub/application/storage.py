@@ -0,0 +1,116 @@
+import hashlib
+import os
+import threading
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from storages.backends.s3boto3 import S3Boto3Storage
+from .metrics import TimedStorageMixin
+
+# CONTENT-ADDRESSED MEDIA
+# Files are stored under the SHA-256 of their contents, so the same bytes are
+# only ever uploaded once. MediaBlob counts the saves that refer to each
+# object; delete() only removes the object when the last one is released
+
+BLOB_PREFIX = 'media/blobs'
+CHUNK_SIZE = 64 * 1024
+
+
+def content_name(name, digest):
+    extension = os.path.splitext(name or '')[1].lower()
+    return f'{BLOB_PREFIX}/{digest[:2]}/{digest[2:4]}/{digest}{extension}'
+
+
+def is_blob(name):
+    return name.startswith(BLOB_PREFIX + '/')
+
+
+def digest_of(content):
+    # One streaming pass over the file; the content is rewound for the upload
+    sha256 = hashlib.sha256()
+    size = 0
+    for chunk in content.chunks(CHUNK_SIZE):
+        sha256.update(chunk)
+        size += len(chunk)
+    content.seek(0)
+    return sha256.hexdigest(), size
+
+
+class ContentAddressedMixin:
+
+    def save(self, name, content, max_length=None):
+        from .models import MediaBlob
+        from .counters import bump
+
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        digest, size = digest_of(content)
+        key = content_name(name, digest)
+        try:
+            with transaction.atomic():
+                # The row lock keeps a concurrent delete() of the same object
+                # from running between the existence check and the new reference
+                blob = MediaBlob.objects.select_for_update().filter(pk=key).first()
+                if blob is not None:
+                    bump(MediaBlob, key, refcount=1)
+                    return key
+                if not self.exists(key):
+                    self._store(key, content)
+                MediaBlob.objects.create(name=key, sha256=digest, size=size, refcount=1)
+        except IntegrityError:
+            # Someone stored the same bytes at the same moment
+            bump(MediaBlob, key, refcount=1)
+        return key
+
+    def _store(self, key, content):
+        saved = self._save(key, content)
+        if saved != key:
+            # Lost a race on the local filesystem; the other copy has the same bytes
+            super().delete(saved)
+
+    def delete(self, name):
+        from .models import MediaBlob
+        from .counters import bump
+
+        if not is_blob(name):
+            return super().delete(name)
+        with transaction.atomic():
+            blob = MediaBlob.objects.select_for_update().filter(pk=name).first()
+            if blob is not None and blob.refcount > 1:
+                bump(MediaBlob, name, refcount=-1)
+                return
+            if blob is not None:
+                blob.delete()
+            super().delete(name)
+
+    def purge(self, name):
+        # Removes the object whatever its reference count (used by collect_media)
+        from .models import MediaBlob
+
+        with transaction.atomic():
+            MediaBlob.objects.filter(pk=name).delete()
+            super().delete(name)
+
+
+class ContentAddressedFileSystemStorage(TimedStorageMixin, ContentAddressedMixin, FileSystemStorage):
+    pass
+
+
+# boto3 resources per thread, shared by every storage instance with the same
+# connection settings, so their HTTP connection pools are reused
+_s3_connections = threading.local()
+
+
+class ContentAddressedS3Storage(TimedStorageMixin, ContentAddressedMixin, S3Boto3Storage):
+
+    @property
+    def connection(self):
+        resources = getattr(_s3_connections, 'resources', None)
+        if resources is None:
+            resources = _s3_connections.resources = {}
+        key = (self.access_key, self.session_profile, self.region_name, self.endpoint_url, self.use_ssl, self.verify)
+        if key not in resources:
+            resources[key] = S3Boto3Storage.connection.fget(self)
+        return resources[key]
@@ -1,8 +1,1462 @@
+import asyncio
+import contextlib
+import csv
+import importlib
+import json
+import os
+import tempfile
+import threading
+from datetime import date, time, timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+import pytest
+from PIL import Image
 from django.test import TestCase
+from django.urls import clear_url_caches, resolve, reverse
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import connections
+from django.db.models import Model, QuerySet
+from django.forms import BaseForm
+from django.test import AsyncClient, Client, RequestFactory, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from asgiref.sync import sync_to_async
+from .models import (Comment, Community, ImageJob, MediaBlob, Post, CommunityMembership, PostFieldValue, PostLocation,
+                     SearchDocument, Template, TemplateField, TimelineEntry)
+from SocialHub import urls as project_urls
+from . import urls as application_urls
+from . import (async_views, counters, exporter, filtering, geo, images, importer, live, media_gc, metrics, query_plans,
+               ranking, replicas, search, sharding, slow_queries, storage, threads, typeahead)
+from .management.commands import check_query_plans
+from .management.commands.check_query_plans import SNAPSHOT
+from .field_types import compile_template
+from .pagination import KeysetPage, paginate
+from .timeline import fan_out_post, get_timeline
+from .viewer import ViewerContext
+from .benchmark import QueryBudgetAssertions, benchmark_context, run_routes, uncovered_url_names
+from .query_budgets import budget_for, unbudgeted_url_names
+from .seeding import SCALES, seed
 
-# Create your tests here.
-import pytest
-from django.urls import reverse
-from django.contrib.auth.models import User
-from django.test import Client
-from .models import Community, Post, CommunityMembership
+User = get_user_model()
+
+# Run with pytest (pytest.ini points it at SocialHub.test_settings), or with
+# `python manage.py test application --settings=SocialHub.test_settings`
+
+
+def make_user(username):
+    return User.objects.create_user(username, password='password')
+
+
+def make_community(name, *members):
+    community = Community.objects.create(name=name, description=f'About {name}')
+    for user in members:
+        CommunityMembership.objects.create(community=community, user=user)
+    return community
+
+
+def make_post(community, user, title='A post', **data):
+    # save() rather than objects.create(), so the router puts it on the
+    # community's shard
+    post = Post(community=community, created_by=user, title=title, data=data or {'Description': title})
+    post.save()
+    return post
+
+
+def make_template(community, **fields):
+    # fields: field name -> field type
+    template = Template(community=community, title='Template', description='')
+    template.save()
+    for field_name, field_type in fields.items():
+        TemplateField(template=template, field_name=field_name, field_type=field_type).save()
+    return template
+
+
+def make_comment(post, user, content='Hi', parent=None, **kwargs):
+    comment = Comment(post=post, user=user, content=content, parent=parent, **kwargs)
+    comment.save()
+    return comment
+
+
+def logged_in(user):
+    client = Client()
+    client.force_login(user)
+    return client
+
+
+# KEYSET PAGINATION
+
+class PaginationTests(TestCase):
+
+    def setUp(self):
+        user = make_user('alice')
+        community = make_community('Rivers', user)
+        self.posts = [make_post(community, user, title=f'Post {n}') for n in range(26)]
+        # All within one millisecond, some on the same microsecond
+        base = timezone.now().replace(microsecond=123000)
+        for n, post in enumerate(self.posts):
+            Post.objects.filter(pk=post.pk).update(created_at=base + timedelta(microseconds=n // 2))
+        self.factory = RequestFactory()
+
+    def page_through(self, ordering):
+        seen, cursor = [], None
+        # A cursor that repeats its own row would page forever
+        for _ in range(len(self.posts)):
+            request = self.factory.get('/', {'cursor': cursor} if cursor else {})
+            page = paginate(Post.objects.all(), request, ordering=ordering, page_size=4)
+            seen += [post.id for post in page]
+            if not page.has_next:
+                return seen
+            cursor = page.next_cursor
+        return seen
+
+    def test_rows_sharing_a_millisecond_are_each_seen_once(self):
+        rows = list(Post.objects.order_by('created_at', 'id').values_list('id', flat=True))
+        self.assertEqual(self.page_through(('created_at', 'id')), rows)
+        self.assertEqual(self.page_through(('-created_at', '-id')), rows[::-1])
+
+
+# BULK IMPORT
+
+class ImportTests(TestCase):
+
+    def setUp(self):
+        self.admin = make_user('alice')
+        self.other = make_user('bob')
+        self.community = make_community('Rivers', self.admin)
+        self.community.admin.add(self.admin)
+        self.template = make_template(self.community, Description='text', Rating='number')
+
+    def upload(self, content, name='posts.jsonl'):
+        return logged_in(self.admin).post(reverse('import_posts', args=[self.community.id]), {
+            'template': self.template.id, 'file': ContentFile(content.encode(), name=name),
+        })
+
+    def test_the_author_column_is_only_for_the_command(self):
+        rows = '{"title": "Mine", "Description": "d", "Rating": 1, "author": "bob"}\n'
+        response = self.upload(rows)
+        self.assertEqual(response.context['result'].imported, 1)
+        self.assertEqual(Post.objects.get(title='Mine').created_by, self.admin)
+
+        path = os.path.join(tempfile.mkdtemp(), 'posts.jsonl')
+        with open(path, 'w') as fileobj:
+            fileobj.write(rows.replace('Mine', 'Theirs'))
+        call_command('import_posts', path, template=self.template.id, user='alice', stdout=StringIO())
+        self.assertEqual(Post.objects.get(title='Theirs').created_by, self.other)
+
+    def test_rows_and_errors(self):
+        rows = '{"title": "Good", "Description": "d", "Rating": 1}\n{"title": "Bad", "Rating": "x"}\nnot json\n'
+        response = self.upload(rows)
+        result = response.context['result']
+        self.assertEqual((result.imported, result.failed, result.truncated), (1, 2, False))
+        self.assertEqual([number for number, message in response.context['errors']], [2, 3])
+        self.community.refresh_from_db()
+        self.assertEqual(self.community.post_count, 1)
+
+    @mock.patch('application.views.IMPORT_MAX_ROWS', 2)
+    def test_uploads_stop_at_the_row_limit(self):
+        rows = ''.join(f'{{"title": "Post {n}", "Description": "d", "Rating": {n}}}\n' for n in range(3))
+        result = self.upload(rows).context['result']
+        self.assertEqual((result.imported, result.truncated), (2, True))
+
+    @mock.patch('application.views.IMPORT_MAX_BYTES', 10)
+    def test_big_uploads_are_refused(self):
+        response = self.upload('{"title": "Too big", "Description": "d", "Rating": 1}\n')
+        self.assertIn('error', response.context)
+        self.assertFalse(Post.objects.exists())
+
+
+# TIMELINES
+
+class TimelineTests(TestCase):
+
+    def setUp(self):
+        self.reader = make_user('alice')
+        self.author = make_user('bob')
+        self.community = make_community('Rivers', self.reader, self.author)
+        self.factory = RequestFactory()
+
+    def post(self, title='A post'):
+        post = make_post(self.community, self.author, title=title)
+        fan_out_post(post)  # as create_post does
+        return post
+
+    def timeline(self, **kwargs):
+        return [post.title for post in get_timeline(self.reader, **kwargs)]
+
+    def test_new_posts_reach_followers(self):
+        self.post('Before following')
+        self.reader.follow(self.author)
+        self.post('After following')
+        self.assertEqual(self.timeline(), ['After following'])
+
+    def test_following_backfills_and_unfollowing_prunes(self):
+        self.post('First')
+        self.post('Second')
+        client = logged_in(self.reader)
+        client.get(reverse('follow_user', args=[self.author.id]))
+        self.assertEqual(self.timeline(), ['Second', 'First'])
+        client.get(reverse('unfollow_user', args=[self.author.id]))
+        self.assertEqual(self.timeline(), [])
+        self.assertFalse(TimelineEntry.objects.exists())
+
+    def test_deleted_posts_leave_the_timeline(self):
+        self.reader.follow(self.author)
+        kept, deleted = self.post('Kept'), self.post('Deleted')
+        deleted.delete(self.author)
+        self.assertEqual(self.timeline(), ['Kept'])
+        self.assertEqual(TimelineEntry.objects.get().post_id, kept.id)
+
+    def test_cursor_pages(self):
+        self.reader.follow(self.author)
+        titles = [self.post(f'Post {n}').title for n in range(5)][::-1]
+        seen, cursor = [], None
+        for _ in range(3):
+            request = self.factory.get('/', {'cursor': cursor} if cursor else {})
+            page = get_timeline(self.reader, request, page_size=2)
+            seen += [post.title for post in page]
+            cursor = page.next_cursor
+        self.assertEqual(seen, titles)
+        self.assertIsNone(cursor)
+
+
+# FIELD FILTERS
+
+class FilteringTests(TestCase):
+
+    FIELDS = {
+        'Name': 'text', 'Notes': 'textArea', 'Count': 'number', 'Price': 'float', 'Day': 'date', 'At': 'time',
+        'Shade': 'color', 'Link': 'url', 'Mail': 'email', 'Phone': 'phone', 'Place': 'geolocation',
+    }
+
+    def setUp(self):
+        self.user = make_user('alice')
+        self.community = make_community('Rivers', self.user)
+        self.template = make_template(self.community, **self.FIELDS)
+        self.factory = RequestFactory()
+
+    def create(self, title, **values):
+        form = {'title': title, 'Name': 'river', 'Notes': 'long', 'Count': 3, 'Price': 2.5, 'Day': '2024-05-01',
+                'At': '10:30', 'Shade': '#336699', 'Link': 'https://example.com', 'Mail': 'a@example.com',
+                'Phone': '555', 'Place_latitude': '41.0', 'Place_longitude': '29.0'}
+        form.update(values)
+        logged_in(self.user).post(reverse('create_post', args=[self.community.id, self.template.id]), form)
+        return Post.objects.get(title=title)
+
+    def values(self, post):
+        return {
+            row.field_name: (row.field_type, row.number_value, row.date_value, row.time_value, row.text_value)
+            for row in PostFieldValue.objects.filter(post=post)
+        }
+
+    def test_each_filterable_type_is_indexed_into_its_column(self):
+        post = self.create('Typed')
+        self.assertEqual(self.values(post), {
+            'Name': ('text', None, None, None, 'river'),
+            'Count': ('number', 3.0, None, None, None),
+            'Price': ('float', 2.5, None, None, None),
+            'Day': ('date', None, date(2024, 5, 1), None, None),
+            'At': ('time', None, None, time(10, 30), None),
+            'Shade': ('color', None, None, None, '#336699'),
+            'Link': ('url', None, None, None, 'https://example.com'),
+            'Mail': ('email', None, None, None, 'a@example.com'),
+            'Phone': ('phone', None, None, None, '555'),
+        })
+
+    def test_edits_reindex(self):
+        post = self.create('Typed')
+        post.data = dict(post.data, Count=7, Name='')
+        post.save()
+        values = self.values(post)
+        self.assertEqual(values['Count'], ('number', 7.0, None, None, None))
+        self.assertNotIn('Name', values)
+        # A title edit leaves the rows alone
+        with CaptureQueriesContext(connections['default']) as queries:
+            logged_in(self.user).post(reverse('edit_post', args=[self.community.id, post.id]), {'title': 'Retitled'})
+        self.assertFalse([q for q in queries if 'application_postfieldvalue' in q['sql']])
+        self.assertEqual(self.values(post), values)
+
+    def filtered(self, **query):
+        fields = filtering.filterable_fields(self.community.id)
+        posts, active, error = filtering.filter_from_query(Post.objects.all(), fields, query)
+        return sorted(post.title for post in posts) if error is None else error
+
+    def test_range_filters(self):
+        for n in range(1, 5):
+            self.create(f'Post {n}', Count=n, Day=f'2024-05-0{n}', Name=f'name {n}')
+        self.assertEqual(self.filtered(field='Count', op='between', value='2', value_to='3'), ['Post 2', 'Post 3'])
+        self.assertEqual(self.filtered(field='Count', op='gt', value='3'), ['Post 4'])
+        self.assertEqual(self.filtered(field='Day', op='lte', value='2024-05-02'), ['Post 1', 'Post 2'])
+        self.assertEqual(self.filtered(field='Name', op='eq', value='name 2'), ['Post 2'])
+        self.assertIn('Unsupported operator', self.filtered(field='Name', op='gt', value='name 2'))
+        self.assertEqual(self.filtered(field='Notes', value='long'), 'Unknown field.')
+
+    def test_filters_page_with_the_cursor(self):
+        for n in range(7):
+            self.create(f'Post {n}', Count=n % 2)
+        fields = filtering.filterable_fields(self.community.id)
+        pages, cursor = [], None
+        for _ in range(2):
+            query = {'field': 'Count', 'value': '1', **({'cursor': cursor} if cursor else {})}
+            request = self.factory.get('/', query)
+            posts, active, error = filtering.filter_from_query(Post.objects.all(), fields, request.GET)
+            page = paginate(posts, request, page_size=2)
+            pages.append([post.title for post in page])
+            cursor = page.next_cursor
+        self.assertEqual(pages, [['Post 5', 'Post 3'], ['Post 1']])
+        self.assertIsNone(cursor)
+
+
+# LOCATIONS
+
+class GeoTests(TestCase):
+
+    def setUp(self):
+        self.user = make_user('alice')
+        self.community = make_community('Rivers', self.user)
+        self.template = make_template(self.community, Place='geolocation')
+
+    def place(self, title, latitude, longitude):
+        post = make_post(self.community, self.user, title=title, Place={'latitude': latitude, 'longitude': longitude})
+        geo.index_locations(post, [('Place', 'geolocation')])  # as create_post does
+        return post
+
+    def titles(self, locations):
+        return [location.post.title for location in locations.select_related('post')]
+
+    def box(self, south, west, north, east):
+        return sorted(self.titles(geo.in_bbox(self.community.id, south, west, north, east)))
+
+    def test_bounding_boxes(self):
+        self.place('Istanbul', 41.0, 29.0)
+        self.place('On a cell edge', 41.0, 29.1)
+        self.place('Just inside the edge', 41.0, 29.0999)
+        self.place('Fiji', -17.7, 179.5)
+        self.place('Samoa', -13.8, -179.5)
+        self.assertEqual(self.box(40.95, 29.05, 41.05, 29.1), ['Just inside the edge', 'On a cell edge'])
+        self.assertEqual(self.box(40.95, 28.95, 41.05, 29.05), ['Istanbul'])
+        # West > east: across the antimeridian
+        self.assertEqual(self.box(-20, 179, -10, -179), ['Fiji', 'Samoa'])
+        self.assertEqual(self.box(-20, -179, -10, 179), [])
+        # Too many cells to list: the latitude/longitude range alone
+        self.assertEqual(len(self.box(-90, -180, 90, 180)), 5)
+
+    def test_radius_and_nearest(self):
+        self.place('Here', 41.0, 29.0)
+        self.place('Half a degree north', 41.5, 29.0)
+        self.place('Two degrees north', 43.0, 29.0)
+        hits = list(geo.within_radius(self.community.id, 41.0, 29.0, 100).select_related('post'))
+        self.assertEqual([hit.post.title for hit in hits], ['Here', 'Half a degree north'])
+        self.assertAlmostEqual(hits[1].distance_km, 55.6, places=1)
+        self.assertEqual([hit.post.title for hit in geo.nearest(self.community.id, 41.0, 29.0, k=3)],
+                         ['Here', 'Half a degree north', 'Two degrees north'])
+
+        self.place('East of the antimeridian', 0.0, -179.9)
+        hits = geo.within_radius(self.community.id, 0.0, 179.9, 50)
+        self.assertEqual(self.titles(hits), ['East of the antimeridian'])
+
+    def test_edits_and_deletes(self):
+        logged_in(self.user).post(reverse('create_post', args=[self.community.id, self.template.id]), {
+            'title': 'Moving', 'Place_latitude': '41.0', 'Place_longitude': '29.0',
+        })
+        post = Post.objects.get(title='Moving')
+        self.assertEqual(list(PostLocation.objects.values_list('latitude', 'longitude')), [(41.0, 29.0)])
+        post.data = dict(post.data, Place={'latitude': 39.9, 'longitude': 32.85})
+        post.save()
+        location = PostLocation.objects.get()
+        self.assertEqual((location.latitude, location.longitude, location.cell), (39.9, 32.85, geo.cell_for(39.9, 32.85)))
+        post.delete(self.user)
+        self.assertFalse(PostLocation.objects.exists())
+
+
+# EXPORT
+
+class ExportTests(TestCase):
+
+    FIELDS = {'Notes': 'textArea', 'Count': 'number', 'Day': 'date', 'At': 'time', 'Shade': 'color', 'Place': 'geolocation'}
+
+    def setUp(self):
+        self.admin = make_user('alice')
+        self.other = make_user('bob')
+        self.community = make_community('Rivers', self.admin, self.other)
+        self.community.admin.add(self.admin)
+        template = make_template(self.community, **self.FIELDS)
+        for n, user in enumerate((self.admin, self.other, self.admin)):
+            logged_in(user).post(reverse('create_post', args=[self.community.id, template.id]), {
+                'title': f'Post {n}', 'Notes': f'Line one\nline "two", {n}', 'Count': n, 'Day': '2024-05-01',
+                'At': '10:30', 'Shade': '#336699', 'Place_latitude': '41.5', 'Place_longitude': '29.25',
+            })
+        for post in Post.objects.all():
+            reply = make_comment(post, self.other, content='First')
+            make_comment(post, self.admin, content='Reply', parent=reply)
+
+    def export(self, file_format):
+        response = logged_in(self.admin).get(reverse('export_community', args=[self.community.id]), {'format': file_format})
+        return b''.join(response.streaming_content)
+
+    def posts(self, community):
+        return [(post.title, post.created_by.username, post.data)
+                for post in Post.objects.filter(community=community).select_related('created_by').order_by('id')]
+
+    def test_exports_import_back(self):
+        for file_format in exporter.FORMATS:
+            community = make_community(f'Copy as {file_format}')
+            template = make_template(community, **self.FIELDS)
+            path = os.path.join(tempfile.mkdtemp(), f'export.{file_format}')
+            with open(path, 'wb') as fileobj:
+                fileobj.write(self.export(file_format))
+            errors = StringIO()
+            call_command('import_posts', path, template=template.id, user='alice', stdout=StringIO(), stderr=errors)
+            self.assertEqual(errors.getvalue(), '')
+            self.assertEqual(self.posts(community), self.posts(self.community))
+
+    def test_comments_come_with_their_post(self):
+        lines = [json.loads(line) for line in self.export('jsonl').decode().splitlines()]
+        self.assertEqual([[comment['content'] for comment in line['comments']] for line in lines], [['First', 'Reply']] * 3)
+        rows = list(csv.reader(StringIO(self.export('csv').decode())))
+        self.assertEqual(rows[0], exporter.CSV_COLUMNS)
+        self.assertEqual([row[0] for row in rows[1:]], ['post', 'comment', 'comment'] * 3)
+
+    def test_queries_per_chunk_not_per_post(self):
+        def queries(chunk_size):
+            with CaptureQueriesContext(connections['default']) as captured:
+                list(exporter.export_lines(self.community.id, 'jsonl', chunk_size))
+            return len(captured)
+        # One chunk of three posts costs what one chunk of one post does
+        # (the posts, their comments and their authors); three chunks cost
+        # the comments and authors twice more
+        self.assertEqual(queries(3), queries(1) - 4)
+        with self.assertNumQueries(queries(3)):
+            list(exporter.export_lines(self.community.id, 'csv', 3))
+
+
+# SEARCH
+# On SQLite search_posts falls back to substring matches on the documents
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.user = make_user('alice')
+        self.community = make_community('River people', self.user)
+
+    def document(self, post):
+        return SearchDocument.objects.filter(post_id=post.id).values_list('title', 'body').first()
+
+    def test_documents_follow_their_post(self):
+        post = make_post(self.community, self.user, title='Stone bridge', Notes='Old arch', Shade='#112233',
+                         color='#112233', _images={'photo': {}})
+        # Neither the swatch value nor the bookkeeping keys are text to search
+        self.assertEqual(self.document(post), ('Stone bridge', 'Old arch'))
+        post.title = 'Copper bridge'
+        post.data = dict(post.data, Notes='New arch')
+        post.save()
+        self.assertEqual(self.document(post), ('Copper bridge', 'New arch'))
+        post.delete(self.user)
+        self.assertIsNone(self.document(post))
+
+    def test_view(self):
+        for n in range(search.RESULTS_PER_PAGE + 1):
+            make_post(self.community, self.user, title=f'Post {n}', Notes='about the river')
+        make_post(self.community, self.user, title='Unrelated', Notes='mountains')
+        client = logged_in(self.user)
+        response = client.post(reverse('search'), {'searched': 'RIVER'})
+        self.assertEqual(len(response.context['posts']), search.RESULTS_PER_PAGE)
+        self.assertEqual(list(response.context['communities']), [self.community])
+        self.assertEqual(list(response.context['users']), [])
+        # Newest first, the rest on the next page
+        self.assertEqual(response.context['posts'].items[0].title, f'Post {search.RESULTS_PER_PAGE}')
+        response = client.get(reverse('search'), {'searched': 'river', 'posts_page': 2})
+        self.assertEqual([post.title for post in response.context['posts']], ['Post 0'])
+        self.assertFalse(response.context['posts'].has_next)
+
+        response = client.get(reverse('search'), {'searched': ' '})
+        self.assertEqual(response.context['error'], 'Please enter a search term.')
+
+
+# VIEWER CONTEXT
+
+class ViewerContextTests(TestCase):
+
+    def setUp(self):
+        self.user = make_user('alice')
+        self.bob = make_user('bob')
+        self.communities = [make_community(f'Community {n}') for n in range(4)]
+        member, admin, moderator, invited = self.communities
+        CommunityMembership.objects.create(community=member, user=self.user)
+        admin.admin.add(self.user)
+        moderator.moderator.add(self.user)
+        invited.invited.add(self.user)
+        self.user.follow(self.bob)
+
+    def answers(self, user):
+        return [
+            (community.is_member(user), community.is_admin(user), community.is_invited(user))
+            for community in self.communities
+        ] + [user.is_following(self.bob), self.bob.is_followed(user)]
+
+    def test_checks_answer_from_the_cached_sets(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.viewer = ViewerContext(user)
+        # One query per set, on first use
+        with self.assertNumQueries(5):
+            cached = self.answers(user)
+            self.assertTrue(user.viewer.is_moderator(self.communities[2].id))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.answers(user), cached)
+            self.assertFalse(user.viewer.is_moderator(self.communities[0].id))
+        # The same answers as the queries run without a viewer
+        self.assertEqual(cached, self.answers(User.objects.get(pk=self.user.pk)))
+        self.assertEqual(cached[:4], [(True, False, False), (False, True, False), (False, False, False), (False, False, True)])
+
+    def test_anonymous_viewers_run_no_queries(self):
+        user = AnonymousUser()
+        viewer = ViewerContext(user)
+        with self.assertNumQueries(0):
+            self.assertFalse(viewer.is_member(self.communities[0].id))
+            self.assertFalse(viewer.is_following(self.bob.id))
+
+    def test_the_middleware_attaches_one_per_request(self):
+        request = logged_in(self.user).get(reverse('conduct')).wsgi_request
+        self.assertIs(request.viewer, request.user.viewer)
+        self.assertTrue(request.viewer.is_admin(self.communities[1].id))
+
+
+# COUNTERS
+
+class CounterTests(TestCase):
+
+    def setUp(self):
+        self.user = make_user('alice')
+        self.bob = make_user('bob')
+        self.community = make_community('Rivers', self.user)
+
+    def counts(self):
+        community = Community.objects.get(pk=self.community.pk)
+        return community.member_count, community.post_count
+
+    def comment_count(self, post):
+        return Post.objects.get(pk=post.pk).comment_count
+
+    def test_joins_and_leaves(self):
+        self.assertEqual(self.counts(), (1, 0))
+        client = logged_in(self.bob)
+        client.get(reverse('join_community', args=[self.community.id]))
+        client.get(reverse('join_community', args=[self.community.id]))
+        self.assertEqual(self.counts(), (2, 0))
+        client.get(reverse('leave_community', args=[self.community.id]))
+        self.assertEqual(self.counts(), (1, 0))
+
+    def test_posts_and_comments(self):
+        post = make_post(self.community, self.user)
+        other = make_post(self.community, self.user)
+        self.assertEqual(self.counts(), (1, 2))
+        top = make_comment(post, self.user)
+        make_comment(post, self.bob, parent=top)
+        self.assertEqual(self.comment_count(post), 2)
+        top.delete()  # and its reply with it
+        self.assertEqual(self.comment_count(post), 0)
+        other.delete(self.user)
+        self.assertEqual(self.counts(), (1, 1))
+
+    def test_reconcile_repairs_drift(self):
+        post = make_post(self.community, self.user)
+        make_comment(post, self.user)
+        version = Community.objects.get(pk=self.community.pk).cache_version
+        # update() skips the signals
+        Community.objects.filter(pk=self.community.pk).update(member_count=7, post_count=0)
+        Post.objects.filter(pk=post.pk).update(comment_count=5)
+        out = StringIO()
+        call_command('reconcile_counters', stdout=out)
+        self.assertEqual(self.counts(), (1, 1))
+        self.assertEqual(self.comment_count(post), 1)
+        self.assertIn('Community.member_count: 1 rows repaired', out.getvalue())
+        self.assertIn('Post.comment_count: 1 rows repaired', out.getvalue())
+        # Repaired rows drop their cached fragments
+        self.assertGreater(Community.objects.get(pk=self.community.pk).cache_version, version)
+        self.assertEqual(counters.reconcile(), {'Community.member_count': 0, 'Community.post_count': 0, 'Post.comment_count': 0})
+
+
+# COMPILED TEMPLATES
+
+class CompiledTemplateTests(TestCase):
+
+    def setUp(self):
+        self.community = make_community('Rivers', make_user('alice'))
+        self.template = make_template(self.community, When='date', At='time', Shade='color', Where='geolocation')
+        # Each field bumped the stored cache_version
+        self.template.refresh_from_db()
+
+    def test_the_form_class_is_built_once_per_version(self):
+        compiled = compile_template(self.template)
+        with self.assertNumQueries(0):
+            self.assertIs(compile_template(self.template), compiled)
+        self.assertIs(compile_template(Template.objects.get(pk=self.template.pk)), compiled)
+
+    def test_field_changes_rebuild_it(self):
+        compiled = compile_template(self.template)
+        TemplateField(template=self.template, field_name='Depth', field_type='number').save()
+        self.template.refresh_from_db()
+        rebuilt = compile_template(self.template)
+        self.assertIsNot(rebuilt, compiled)
+        self.assertIn('Depth', rebuilt.form_class.base_fields)
+        self.assertNotIn('Depth', compiled.form_class.base_fields)
+
+    def test_a_version_bump_from_another_process_rebuilds_it(self):
+        compiled = compile_template(self.template)
+        # Another process changed the fields: only the version moved here
+        Template.objects.filter(pk=self.template.pk).update(cache_version=self.template.cache_version + 1)
+        self.template.refresh_from_db()
+        self.assertIsNot(compile_template(self.template), compiled)
+
+    def test_values_round_trip(self):
+        compiled = compile_template(self.template)
+        form = compiled.form_class({
+            'title': 'Survey', 'When': '2024-05-17', 'At': '09:30', 'Shade': '#1e90ff',
+            'Where_latitude': '41.015137', 'Where_longitude': '-28.979530',
+        })
+        self.assertTrue(form.is_valid(), form.errors)
+        # Post.data goes through JSON on its way to the database
+        data = json.loads(json.dumps(compiled.serialize(form.cleaned_data)))
+        self.assertEqual(data, {
+            'When': '2024-05-17', 'At': '09:30:00', 'color': '#1e90ff', 'Shade': '#1e90ff',
+            'Where': {'latitude': 41.015137, 'longitude': -28.97953},
+        })
+        initial = compiled.deserialize(data)
+        self.assertEqual(initial, {
+            'When': date(2024, 5, 17), 'At': time(9, 30), 'Shade': '#1e90ff',
+            'Where_latitude': 41.015137, 'Where_longitude': -28.97953,
+        })
+        # The edit form, bound to the initial data, stores the same values again
+        form = compiled.form_class(dict(initial, title='Survey'))
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(json.loads(json.dumps(compiled.serialize(form.cleaned_data))), data)
+
+
+# ASYNC VIEWS
+# urls.py picks its read views when it is imported, so the tests reload it
+# (and the project urls, whose include() holds on to its patterns) with
+# ASYNC_VIEWS on and compare each page with the sync view's
+
+def use_async_views(enabled):
+    with override_settings(ASYNC_VIEWS=enabled):
+        importlib.reload(application_urls)
+        importlib.reload(project_urls)
+    clear_url_caches()
+
+
+def comparable(value):
+    # Context values as something two renders can be compared by
+    if isinstance(value, Model):
+        return (type(value).__name__, value.pk)
+    if isinstance(value, BaseForm):
+        return (type(value).__name__, value.is_bound)
+    if isinstance(value, KeysetPage):
+        return [comparable(item) for item in value], value.next_querystring
+    if isinstance(value, (list, tuple, set, QuerySet)):
+        items = [comparable(item) for item in value]
+        return sorted(items, key=repr) if isinstance(value, set) else items
+    if isinstance(value, dict):
+        return {key: comparable(item) for key, item in value.items()}
+    return value
+
+
+class AsyncViewTests(TestCase):
+    CONTEXT_KEYS = {
+        'home': ['posts', 'following_posts', 'communities', 'trending_communities', 'followed_communities'],
+        'community_content': ['community', 'is_private', 'user_is_member', 'user_is_admin', 'user_is_invited',
+                              'templates', 'posts', 'sort', 'filter_fields', 'filter_operators', 'active_filter',
+                              'filter_error', 'memberships', 'member_admin_ids', 'member_moderator_ids'],
+        'view_post': ['community', 'post', 'comments', 'form', 'user_is_member', 'post_image'],
+    }
+
+    def setUp(self):
+        cache.clear()
+        self.user = make_user('alice')
+        author = make_user('bob')
+        self.user.following.add(author)
+        self.community = make_community('Rivers', self.user, author)
+        self.community.admin.add(author)
+        make_template(self.community, Depth='number')
+        posts = [make_post(self.community, author, title=f'Post {n}') for n in range(3)]
+        for post in posts:
+            fan_out_post(post)
+        self.post = posts[0]
+        make_comment(self.post, author, content='Reply', parent=make_comment(self.post, self.user))
+        self.urls = {
+            'home': reverse('home'),
+            'community_content': reverse('community_content', args=[self.community.id]),
+            'view_post': reverse('view_post', args=[self.community.id, self.post.id]),
+        }
+
+    def render(self, response, url_name):
+        return response.status_code, {key: comparable(response.context[key]) for key in self.CONTEXT_KEYS[url_name]}
+
+    async def test_pages_match_the_sync_views(self):
+        client = await sync_to_async(logged_in)(self.user)
+        expected = {}
+        for url_name, url in self.urls.items():
+            expected[url_name] = self.render(await sync_to_async(client.get)(url), url_name)
+
+        use_async_views(True)
+        self.addCleanup(use_async_views, False)
+        async_client = AsyncClient()
+        await sync_to_async(async_client.force_login)(self.user)
+        for url_name, url in self.urls.items():
+            self.assertIs(resolve(url).func, getattr(async_views, url_name))
+            with self.subTest(url_name):
+                self.assertEqual(self.render(await async_client.get(url), url_name), expected[url_name])
+                self.assertEqual(expected[url_name][0], 200)
+
+
+# REQUEST METRICS
+# Each test records into a registry of its own
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        patcher = mock.patch.object(metrics, 'registry', self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = make_user('alice')
+        self.community = make_community('Rivers', self.user)
+        self.post = make_post(self.community, self.user)
+
+    def test_requests_are_labelled_by_url_name(self):
+        client = logged_in(self.user)
+        client.get(reverse('view_post', args=[self.community.id, self.post.id]))
+        client.get(reverse('view_post', args=[self.community.id, self.post.id + 100]))
+        client.get('/no/such/page/')
+        labels = (('view', 'view_post'), ('method', 'GET'))
+        self.assertEqual(self.registry.counters['socialhub_requests_total', labels + (('status', '200'),)], 1)
+        # A 404 from a resolved view keeps the view's name
+        self.assertEqual(self.registry.counters['socialhub_requests_total', labels + (('status', '404'),)], 1)
+        # Both in one histogram: a count per bucket, then the sum
+        self.assertEqual(sum(self.registry.histograms['socialhub_request_duration_seconds', labels][:-1]), 2)
+        self.assertGreater(self.registry.counters['socialhub_sql_queries_total', (('view', 'view_post'),)], 0)
+        # Paths that don't resolve share one label, so they can't grow the label set
+        unresolved = (('view', metrics.UNRESOLVED), ('method', 'GET'))
+        self.assertEqual(self.registry.counters['socialhub_requests_total', unresolved + (('status', '404'),)], 1)
+        self.assertIn(unresolved, [labels for name, labels in self.registry.histograms])
+        self.assertFalse([labels for name, labels in self.registry.counters if '/no/such/page/' in str(labels)])
+
+    def test_the_endpoint_is_for_staff(self):
+        url = reverse('metrics')
+        self.assertEqual(Client().get(url).status_code, 403)
+        self.assertEqual(logged_in(self.user).get(url).status_code, 403)
+        staff = make_user('admin')
+        staff.is_staff = True
+        staff.save()
+        response = logged_in(staff).get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('socialhub_requests_total{view="metrics",method="GET",status="403"} 2', response.content.decode())
+
+    @override_settings(METRICS_TOKEN='scraper-token')
+    def test_or_for_the_scraper_token(self):
+        url = reverse('metrics')
+        self.assertEqual(Client(HTTP_AUTHORIZATION='Bearer scraper-token').get(url).status_code, 200)
+        self.assertEqual(Client(HTTP_AUTHORIZATION='Bearer wrong-token').get(url).status_code, 403)
+
+
+# SLOW QUERY LOG
+# The test settings turn it off (SLOW_QUERY_MS = 0); a Client made under
+# override_settings loads the middleware with the threshold of the test
+
+class SlowQueryTests(TestCase):
+
+    def setUp(self):
+        user = make_user('alice')
+        make_post(make_community('Rivers', user), user)
+
+    def test_slow_queries_are_logged_once_with_their_plan(self):
+        with override_settings(SLOW_QUERY_MS=0.000001):
+            client = Client()
+            with CaptureQueriesContext(connections['default']) as queries, \
+                    self.assertLogs(slow_queries.logger, 'WARNING') as logs:
+                self.assertEqual(client.get(reverse('home')).status_code, 200)
+        selects = [query['sql'] for query in queries if query['sql'].startswith(('SELECT', 'WITH'))]
+        self.assertTrue(selects)
+        # One record per query; the EXPLAIN itself isn't logged
+        self.assertEqual([record.args[3] for record in logs.records], selects)
+        for record in logs.records:
+            self.assertEqual(record.args[:2], ('home', '/'))
+            self.assertRegex(record.getMessage(), r'\nPlan:\n.*\b(SCAN|SEARCH) ')
+
+    def test_fast_queries_and_other_views_are_not_logged(self):
+        with mock.patch.object(slow_queries.logger, 'warning') as warning:
+            with override_settings(SLOW_QUERY_MS=60000):
+                self.assertEqual(Client().get(reverse('home')).status_code, 200)
+            with override_settings(SLOW_QUERY_MS=0.000001, SLOW_QUERY_VIEWS=['search']):
+                self.assertEqual(Client().get(reverse('home')).status_code, 200)
+        warning.assert_not_called()
+
+
+# QUERY PLAN SNAPSHOTS
+# check_query_plans against query_plans.json, on the test database seeded
+# here instead of a throwaway database of its own
+
+class QueryPlanTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed(**SCALES['small'])
+
+    def check(self):
+        out = StringIO()
+        with mock.patch.object(check_query_plans, 'throwaway_database', contextlib.nullcontext), \
+                mock.patch.object(check_query_plans, 'seed'):
+            try:
+                call_command('check_query_plans', stdout=out, stderr=StringIO())
+            except CommandError as e:
+                return out.getvalue(), e
+        return out.getvalue(), None
+
+    def test_the_snapshot_covers_every_query(self):
+        with open(SNAPSHOT) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        labels = sorted(label for label, build in query_plans.QUERIES)
+        for vendor in ('postgresql', 'sqlite'):
+            self.assertEqual(sorted(snapshot[vendor]), labels)
+
+    def test_the_plans_match_the_snapshot(self):
+        output, error = self.check()
+        self.assertIsNone(error, output)
+        self.assertIn('No plan regressions', output)
+
+    def test_a_dropped_index_is_reported(self):
+        with connections['default'].cursor() as cursor:
+            cursor.execute('DROP INDEX community_popular_idx')
+        output, error = self.check()
+        self.assertEqual(str(error), '1 plan regression(s)')
+        self.assertIn('REGRESSION popular communities: application_community was read through an index, now in full\n'
+                      + query_plans.capture()['popular communities']['plan'], output)
+
+
+# READ REPLICAS
+# replica1 reads the primary's test database (TEST MIRROR), so the tests
+# tell the two apart by the connection the queries ran on. Transaction test
+# cases, so the rows written on the primary are committed and visible there
+
+@override_settings(DATABASE_REPLICAS=['replica1'])
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = {'default', 'replica1'}
+
+    def setUp(self):
+        self.user = make_user('alice')
+        self.community = make_community('Rivers', self.user)
+        self.post = make_post(self.community, self.user)
+        self.client = logged_in(self.user)
+
+    def request(self, method, path, data=None):
+        # (response, queries on the primary, queries on the replica)
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica1']) as replica:
+            response = getattr(self.client, method)(path, data)
+        return response, primary.captured_queries, replica.captured_queries
+
+    def test_get_reads_from_the_replica(self):
+        response, primary, replica = self.request('get', reverse('community_content', args=[self.community.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(any('application_post' in query['sql'] for query in replica))
+        self.assertFalse(any('application_post' in query['sql'] for query in primary))
+        self.assertNotIn(replicas.PIN_COOKIE, response.cookies)
+
+    def test_writes_go_to_the_primary_and_pin_the_session(self):
+        response, primary, replica = self.request(
+            'post', reverse('view_post', args=[self.community.id, self.post.id]), {'content': 'Nice'},
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(any(query['sql'].startswith('INSERT INTO "application_comment"') for query in primary))
+        self.assertFalse(any(query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE')) for query in replica))
+        self.assertIn(replicas.PIN_COOKIE, response.cookies)
+
+        # The page it redirects to reads the new comment from the primary
+        response, primary, replica = self.request('get', response['Location'])
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Nice')
+        self.assertEqual(replica, [])
+
+    def test_a_post_that_only_reads_does_not_pin(self):
+        response, primary, replica = self.request('post', reverse('search'), {'searched': 'post'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(replicas.PIN_COOKIE, response.cookies)
+
+    def test_router_outside_a_request(self):
+        router = replicas.ReplicaRouter()
+        self.assertEqual(router.db_for_read(Post), 'default')
+        self.assertEqual(router.db_for_write(Post), 'default')
+
+
+# TYPEAHEAD
+# On SQLite the fuzzy matches are substring matches (trigrams need pg_trgm)
+
+class TypeaheadTests(TestCase):
+
+    def setUp(self):
+        self.user = make_user('alice')
+        for name in ('Maple Leaves', 'Red maple', 'Harbor', 'Maplewood'):
+            make_community(name)
+        for username in ('mapleton', 'bob'):
+            make_user(username)
+
+    def labels(self, kind, term, **kwargs):
+        return [result['label'] for result in typeahead.suggestions(kind, term, **kwargs)]
+
+    def test_prefix_matches_come_before_substring_matches(self):
+        self.assertEqual(self.labels('communities', 'MAPLE'), ['Maple Leaves', 'Maplewood', 'Red maple'])
+        self.assertEqual(self.labels('users', 'ple'), ['mapleton'])
+
+    def test_short_queries_and_the_limit(self):
+        self.assertEqual(self.labels('communities', ' m '), [])
+        self.assertEqual(self.labels('communities', 'maple', limit=2), ['Maple Leaves', 'Maplewood'])
+
+    def test_view(self):
+        client = logged_in(self.user)
+        response = client.get(reverse('typeahead'), {'type': 'communities', 'q': 'harb'})
+        community = Community.objects.get(name='Harbor')
+        self.assertEqual(response.json(), {'results': [
+            {'id': community.id, 'label': 'Harbor', 'url': reverse('community_content', args=[community.id])},
+        ]})
+        self.assertEqual(client.get(reverse('typeahead'), {'type': 'posts', 'q': 'harb'}).status_code, 400)
+
+
+# FRAGMENT CACHE
+# Post cards are cached under the post's cache_version, which the signals
+# bump on every change to the post or its comments
+
+class FragmentCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = make_user('alice')
+        self.community = make_community('Rivers', self.user)
+        self.post = make_post(self.community, self.user, title='Original title')
+        self.client = logged_in(self.user)
+
+    def page(self):
+        return self.client.get(reverse('community_content', args=[self.community.id])).content.decode()
+
+    def version(self):
+        return Post.objects.get(pk=self.post.pk).cache_version
+
+    def test_cards_are_served_from_the_cache(self):
+        self.assertIn('Original title', self.page())
+        # update() skips the signals, so the cached card stays
+        Post.objects.filter(pk=self.post.pk).update(title='Changed behind its back')
+        self.assertIn('Original title', self.page())
+
+    def test_editing_the_post_invalidates_its_card(self):
+        self.assertIn('Original title', self.page())
+        version = self.version()
+        self.post.title = 'Edited title'
+        self.post.save()
+        self.assertEqual(self.version(), version + 1)
+        page = self.page()
+        self.assertIn('Edited title', page)
+        self.assertNotIn('Original title', page)
+
+    def test_comments_invalidate_the_card(self):
+        self.assertIn('0 comments', self.page())
+        version = self.version()
+        comment = make_comment(self.post, self.user)
+        self.assertEqual(self.version(), version + 1)
+        self.assertIn('1 comments', self.page())
+
+        comment.content = 'Edited'
+        comment.save()
+        self.assertEqual(self.version(), version + 2)
+        comment.delete()
+        self.assertEqual(self.version(), version + 3)
+        self.assertIn('0 comments', self.page())
+
+
+# LIVE UPDATES
+# With the InProcessBroker of the test settings
+
+class LiveUpdateTests(TestCase):
+
+    def setUp(self):
+        self.user = make_user('alice')
+        self.community = make_community('Rivers', self.user)
+        self.post = make_post(self.community, self.user)
+
+    async def test_broker_delivers_to_subscribers(self):
+        broker = live.InProcessBroker()
+        subscription = await broker.subscribe('post:1')
+        other = await broker.subscribe('post:2')
+        # publish() may come from any thread, e.g. a sync view's
+        await asyncio.get_running_loop().run_in_executor(None, broker.publish, 'post:1', 'hello')
+        self.assertEqual(await subscription.get(1), 'hello')
+        self.assertIsNone(await other.get(0.05))
+
+        await broker.unsubscribe(subscription)
+        broker.publish('post:1', 'nobody listening')
+        self.assertIsNone(await subscription.get(0.05))
+
+    async def test_post_events_streams_new_comments(self):
+        client = AsyncClient()
+        await sync_to_async(client.force_login)(self.user)
+        response = await client.get(reverse('post_events', args=[self.community.id, self.post.id]))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = response.streaming_content
+        try:
+            # Subscribed once the first chunk is out
+            self.assertEqual(await stream.__anext__(), b'retry: 5000\n\n')
+
+            def comment():
+                with self.captureOnCommitCallbacks(execute=True):
+                    return make_comment(self.post, self.user, content='Live!')
+            created = await sync_to_async(comment)()
+            chunk = await asyncio.wait_for(stream.__anext__(), 1)
+        finally:
+            await stream.aclose()
+        self.assertTrue(chunk.startswith(b'data: '))
+        event = json.loads(chunk[len(b'data: '):])
+        self.assertEqual((event['type'], event['id'], event['content'], event['user']),
+                         ('comment', created.id, 'Live!', 'alice'))
+
+    async def test_private_communities_turn_outsiders_away(self):
+        def outsider():
+            Community.objects.filter(pk=self.community.pk).update(isPrivate=True)
+            return make_user('bob')
+        client = AsyncClient()
+        await sync_to_async(client.force_login)(await sync_to_async(outsider)())
+        response = await client.get(reverse('community_events', args=[self.community.id]))
+        self.assertEqual(response.status_code, 403)
+
+    def test_wsgi_requests_get_no_stream(self):
+        response = logged_in(self.user).get(reverse('community_events', args=[self.community.id]))
+        self.assertEqual(response.status_code, 204)
+
+
+# THREADED COMMENTS
+
+class ThreadTests(TestCase):
+
+    def setUp(self):
+        self.user = make_user('alice')
+        self.post = make_post(make_community('Rivers', self.user), self.user)
+
+    def comment(self, parent=None, **kwargs):
+        return make_comment(self.post, self.user, parent=parent, **kwargs)
+
+    def test_replies_are_counted_on_every_ancestor(self):
+        top = self.comment()
+        reply = self.comment(top)
+        nested = self.comment(reply)
+        self.assertEqual(threads.ancestor_ids(nested.path), [top.id, reply.id])
+        top.refresh_from_db()
+        reply.refresh_from_db()
+        self.assertEqual((top.reply_count, reply.reply_count), (2, 1))
+        self.assertEqual(threads.subtree(top), ([reply, nested], None))
+
+        nested.delete()
+        top.refresh_from_db()
+        self.assertEqual(top.reply_count, 1)
+
+    def test_deleting_a_post_takes_its_thread_in_one_statement(self):
+        def delete_queries(post):
+            with CaptureQueriesContext(connections['default']) as queries:
+                post.delete(self.user)
+            return len(queries)
+        top = self.comment()
+        for _ in range(5):
+            self.comment(self.comment(top))
+        empty = make_post(self.post.community, self.user)
+        self.assertEqual(delete_queries(self.post), delete_queries(empty))
+        self.assertFalse(Comment.objects.exists())
+
+    def test_ids_from_a_later_shards_range(self):
+        # Shard n hands out ids from n * SHARD_ID_SPAN
+        first_id = 2 * sharding.SHARD_ID_SPAN + 5
+        top = self.comment(id=first_id)
+        reply = self.comment(top, id=first_id + 1)
+        self.assertEqual(threads.ancestor_ids(reply.path), [top.id])
+        top.refresh_from_db()
+        self.assertEqual(top.reply_count, 1)
+        self.assertEqual(threads.subtree(top), ([reply], None))
+
+
+# COMMUNITY SHARDS
+# shard1 and shard2 are separate SQLite databases next to the default one.
+# The test databases are migrated before these settings apply, so the tests
+# reserve the shards' id ranges themselves, as post_migrate would
+
+SHARDS = ['default', 'shard1', 'shard2']
+
+
+def make_community_on(alias, name, *members):
+    community = make_community(name, *members)
+    Community.objects.filter(pk=community.pk).update(shard=alias)
+    community.shard = alias
+    return community
+
+
+@override_settings(DATABASE_SHARDS=SHARDS, SHARDS_FOR_NEW_COMMUNITIES=['default', 'shard1'])
+class ShardTests(TestCase):
+    databases = set(SHARDS)
+
+    def setUp(self):
+        for alias in SHARDS:
+            sharding.reserve_id_ranges(using=alias)
+        self.user = make_user('alice')
+        self.communities = [make_community_on(alias, f'On {alias}', self.user) for alias in SHARDS]
+
+    def test_new_communities_go_to_the_least_loaded_shard(self):
+        make_post(self.communities[0], self.user)
+        self.assertEqual(make_community('Next').shard, 'shard1')
+        # shard2 isn't in SHARDS_FOR_NEW_COMMUNITIES
+        make_post(self.communities[1], self.user)
+        make_post(self.communities[1], self.user)
+        self.assertEqual(make_community('After that').shard, 'default')
+
+    def test_reserve_id_ranges(self):
+        ids = []
+        for number, (community, alias) in enumerate(zip(self.communities, SHARDS)):
+            post = make_post(community, self.user)
+            self.assertEqual(post._state.db, alias)
+            self.assertTrue(number * sharding.SHARD_ID_SPAN <= post.id < (number + 1) * sharding.SHARD_ID_SPAN)
+            ids.append(post.id)
+
+        # Running it again (another migrate) doesn't hand out the same ids
+        sharding.reserve_id_ranges(using='shard1')
+        self.assertEqual(make_post(self.communities[1], self.user).id, ids[1] + 1)
+
+    def test_fan_out(self):
+        for count, community in enumerate(self.communities, 1):
+            for _ in range(count):
+                make_post(community, self.user)
+        self.assertEqual(sharding.fan_out(lambda: Post.objects.count()), [1, 2, 3])
+        self.assertEqual(sharding.fan_out(lambda: Post.objects.count(), ['shard2']), [3])
+
+    def test_paginate_merges_the_shards_in_order(self):
+        start = timezone.now()
+        for minutes in range(9):
+            # Round robin over the shards, newest last
+            post = make_post(self.communities[minutes % 3], self.user, title=f'Post {minutes}')
+            Post.objects.using(post._state.db).filter(pk=post.pk).update(created_at=start + timedelta(minutes=minutes))
+        titles, request = [], None
+        for _ in range(3):
+            page = sharding.paginate(Post.objects.all(), request, page_size=4, related_fields=('community',))
+            titles += [post.title for post in page]
+            if not page.has_next:
+                break
+            request = RequestFactory().get('/', {'cursor': page.next_cursor})
+        self.assertEqual(titles, [f'Post {minutes}' for minutes in range(8, -1, -1)])
+        self.assertFalse(page.has_next)
+        self.assertEqual(page.items[-1].community, self.communities[0])
+
+    def test_move_community(self):
+        community = self.communities[1]
+        posts = [make_post(community, self.user, title=f'Post {number}') for number in range(3)]
+        top = make_comment(posts[0], self.user)
+        reply = make_comment(posts[0], self.user, parent=top)
+        call_command('move_community', community.id, 'shard2', grace=0, batch_size=2, stdout=StringIO())
+
+        community.refresh_from_db()
+        self.assertEqual((community.shard, community.moving_to, community.post_count), ('shard2', '', 3))
+        self.assertEqual(sorted(Post.objects.using('shard2').values_list('id', flat=True)), [post.id for post in posts])
+        moved = Comment.objects.using('shard2').get(pk=top.pk)
+        self.assertEqual((moved.reply_count, moved.path), (1, top.path))
+        self.assertTrue(Comment.objects.using('shard2').filter(pk=reply.pk, parent_id=top.pk).exists())
+        for model, lookup in sharding.COMMUNITY_ROWS:
+            self.assertFalse(model.objects.using('shard1').filter(**{lookup: community.id}).exists(), model)
+
+        # shard2 keeps handing out ids from its own range
+        post = make_post(community, self.user)
+        self.assertEqual(post._state.db, 'shard2')
+        self.assertGreaterEqual(post.id, 2 * sharding.SHARD_ID_SPAN)
+
+    def test_copy_and_purge(self):
+        community = self.communities[0]
+        post = make_post(community, self.user)
+        copied = sharding.copy_community(community.id, 'default', 'shard1')
+        self.assertEqual((copied['Post'], copied['SearchDocument']), (1, 1))
+        self.assertEqual(Post.objects.using('shard1').get(pk=post.pk).title, post.title)
+
+        sharding.purge_community(community.id, 'shard1')
+        self.assertFalse(Post.objects.using('shard1').filter(community_id=community.id).exists())
+        # The source is left alone
+        self.assertTrue(Post.objects.using('default').filter(pk=post.pk).exists())
+
+    def test_writes_wait_while_the_community_moves(self):
+        community = self.communities[1]
+        post = make_post(community, self.user)
+        Community.objects.filter(pk=community.pk).update(moving_to='shard2')
+        client = logged_in(self.user)
+        response = client.post(reverse('view_post', args=[community.id, post.id]), {'content': 'Hi'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '60')
+        response = client.get(reverse('view_post', args=[community.id, post.id]))
+        self.assertContains(response, post.title)
+
+
+@override_settings(DATABASE_SHARDS=SHARDS)
+class ShardFanOutTests(TransactionTestCase):
+    # Outside a transaction fan_out() runs on the pool threads
+    databases = set(SHARDS)
+
+    def test_fan_out_in_parallel(self):
+        user = make_user('alice')
+        for alias in SHARDS:
+            make_post(make_community_on(alias, f'On {alias}'), user)
+        results = sharding.fan_out(lambda: (threading.current_thread().name, Post.objects.count()))
+        self.assertEqual([count for _, count in results], [1, 1, 1])
+        self.assertTrue(all(name.startswith('shard') for name, _ in results))
+
+
+# IMAGE PIPELINE
+# Staging and media in temporary directories
+
+def image_bytes(size=(2000, 1000), mode='RGB', image_format='JPEG', **options):
+    buffer = BytesIO()
+    Image.new(mode, size).save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+class ImagePipelineTests(TestCase):
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=os.path.join(root.name, 'media'),
+                                              IMAGE_STAGING_ROOT=os.path.join(root.name, 'staging'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.root = root.name
+        cache.clear()
+        self.user = make_user('alice')
+        self.community = make_community('Rivers', self.user)
+
+    def render(self, content):
+        path = os.path.join(self.root, 'original')
+        with open(path, 'wb') as fileobj:
+            fileobj.write(content)
+        return images.render_variants(path)
+
+    def queued_post(self, content):
+        # What create_post leaves behind for an image field
+        entry = images.stage_upload(SimpleUploadedFile('River photo.jpg', content))
+        post = make_post(self.community, self.user, photo=None, image=None, _images={'photo': entry})
+        images.queue_images(post)
+        return post
+
+    def test_every_width_in_both_formats_without_exif(self):
+        exif = Image.Exif()
+        exif[0x010F] = 'Camera maker'
+        exif[0x0112] = 6  # orientation: rotated 90 degrees
+        width, height, variants = self.render(image_bytes((3000, 1500), exif=exif.tobytes()))
+        # Turned upright first
+        self.assertEqual((width, height), (1500, 3000))
+        self.assertEqual(sorted((variant[0], variant[2]) for variant in variants),
+                         [(w, extension) for w in images.VARIANT_WIDTHS for extension in ('jpg', 'webp')])
+        for variant_width, variant_height, extension, content in variants:
+            with Image.open(BytesIO(content)) as variant:
+                self.assertEqual(variant.size, (variant_width, variant_height))
+                self.assertEqual(variant_height, variant_width * 2)
+                self.assertFalse(variant.getexif())
+        # Never scaled up
+        width, height, variants = self.render(image_bytes((500, 250)))
+        self.assertEqual(sorted({variant[0] for variant in variants}), [320, 500])
+
+    def test_transparent_images(self):
+        rgba = Image.new('RGBA', (400, 200), (255, 0, 0, 0))
+        palette = Image.new('P', (400, 200))
+        for image in (rgba, palette):
+            buffer = BytesIO()
+            image.save(buffer, 'PNG', **({'transparency': 0} if image.mode == 'P' else {}))
+            variants = {extension: content for w, h, extension, content in self.render(buffer.getvalue())[2] if w == 400}
+            with Image.open(BytesIO(variants['jpg'])) as jpeg:
+                # Transparent pixels are flattened onto white
+                self.assertEqual((jpeg.mode, jpeg.getpixel((0, 0))), ('RGB', (255, 255, 255)))
+            with Image.open(BytesIO(variants['webp'])) as webp:
+                self.assertEqual(webp.mode, 'RGBA')
+
+    def test_worker_completes_jobs(self):
+        post = self.queued_post(image_bytes())
+        call_command('process_images', once=True, workers=1, stdout=StringIO())
+        post.refresh_from_db()
+        entry = post.data['_images']['photo']
+        self.assertEqual(entry['status'], ImageJob.DONE)
+        self.assertEqual(len(entry['variants']), len(images.VARIANT_WIDTHS) * len(images.VARIANT_FORMATS))
+        paths = {(variant['width'], variant['format']): variant['path'] for variant in entry['variants']}
+        # The largest JPEG is the plain src
+        self.assertEqual(post.data['photo'], paths[1280, 'jpg'])
+        self.assertEqual(post.data['image'], post.data['photo'])
+        self.assertEqual(ImageJob.objects.get().status, ImageJob.DONE)
+        self.assertFalse(os.listdir(os.path.join(self.root, 'staging')))
+
+        page = logged_in(self.user).get(reverse('view_post', args=[self.community.id, post.id])).content.decode()
+        self.assertIn(f'srcset="/media/{paths[320, "webp"]} 320w, /media/{paths[640, "webp"]} 640w', page)
+        self.assertIn('loading="lazy"', page)
+
+    def test_failed_jobs_are_retried_then_marked_failed(self):
+        post = self.queued_post(b'not an image')
+        job = ImageJob.objects.get()
+        images.fail_job(job, 'first try')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (ImageJob.PENDING, 1))
+        # --once keeps taking the job until it runs out of attempts
+        call_command('process_images', once=True, workers=1, stdout=StringIO(), stderr=StringIO())
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (ImageJob.FAILED, images.MAX_ATTEMPTS))
+        post.refresh_from_db()
+        self.assertEqual(post.data['_images']['photo'], {'status': ImageJob.FAILED})
+        self.assertIn('could not be processed', logged_in(self.user).get(
+            reverse('view_post', args=[self.community.id, post.id])).content.decode())
+
+
+# CONTENT-ADDRESSED MEDIA
+# Against the local filesystem backend, in a temporary MEDIA_ROOT
+
+class MediaStorageTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.storage = default_storage
+        self.user = make_user('alice')
+        self.community = make_community('Rivers', self.user)
+
+    def blob(self, name):
+        return MediaBlob.objects.filter(pk=name).first()
+
+    def post_with_image(self, content):
+        # A post whose image went through the pipeline (images.complete_job)
+        post = make_post(self.community, self.user, photo=None, _images={'photo': {'status': ImageJob.PENDING, 'name': 'river'}})
+        job = ImageJob.objects.create(post=post, field_name='photo', staged_name='gone.jpg')
+        images.complete_job(job, (640, 480, [(320, 240, 'jpg', content)]))
+        post.refresh_from_db()
+        return post
+
+    def test_the_same_content_is_stored_once(self):
+        first = self.storage.save('media/images/a.jpg', ContentFile(b'same bytes'))
+        second = self.storage.save('media/images/b.jpg', ContentFile(b'same bytes'))
+        self.assertEqual(first, second)
+        self.assertTrue(storage.is_blob(first))
+        self.assertEqual(self.blob(first).refcount, 2)
+        self.assertEqual(MediaBlob.objects.count(), 1)
+
+        self.storage.delete(first)
+        self.assertEqual(self.blob(first).refcount, 1)
+        self.assertTrue(self.storage.exists(first))
+        self.storage.delete(first)
+        self.assertIsNone(self.blob(first))
+        self.assertFalse(self.storage.exists(first))
+
+    def test_deleting_a_post_gives_its_references_back(self):
+        first = self.post_with_image(b'jpeg bytes')
+        second = self.post_with_image(b'jpeg bytes')
+        key = first.data['photo']
+        self.assertEqual(images.variant_paths(first.data), [key])
+        self.assertEqual(second.data['photo'], key)
+        self.assertEqual(self.blob(key).refcount, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete(self.user)
+        self.assertEqual(self.blob(key).refcount, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete(self.user)
+        self.assertIsNone(self.blob(key))
+        self.assertFalse(self.storage.exists(key))
+
+    def test_an_edit_that_drops_an_image_gives_its_reference_back(self):
+        post = self.post_with_image(b'jpeg bytes')
+        key = post.data['photo']
+        post.data = {'Description': 'No picture after all'}
+        with self.captureOnCommitCallbacks(execute=True):
+            post.save()
+        self.assertIsNone(self.blob(key))
+
+    def test_collect_only_removes_blobs_nothing_counts(self):
+        counted = self.storage.save('media/images/a.jpg', ContentFile(b'still counted'))
+        released = self.storage.save('media/images/b.jpg', ContentFile(b'released'))
+        MediaBlob.objects.filter(pk=released).update(refcount=0)
+        referenced = self.post_with_image(b'in a post').data['photo']
+
+        later = timezone.now() + media_gc.GRACE * 2
+        self.assertEqual(media_gc.collect(self.storage, dry_run=True, now=later)[0], 1)
+        deleted, reclaimed, kept = media_gc.collect(self.storage, now=later)
+        self.assertEqual((deleted, reclaimed, kept), (1, len(b'released'), 2))
+        self.assertFalse(self.storage.exists(released))
+        self.assertIsNone(self.blob(released))
+        self.assertTrue(self.storage.exists(counted))
+        self.assertTrue(self.storage.exists(referenced))
+
+
+# HOT POSTS
+
+class HotScoreTests(TestCase):
+
+    def setUp(self):
+        self.user = make_user('alice')
+        self.community = make_community('Rivers', self.user)
+
+    def test_a_new_post_is_scored_by_its_insert(self):
+        with CaptureQueriesContext(connections['default']) as queries:
+            post = make_post(self.community, self.user)
+        self.assertFalse([q for q in queries if q['sql'].startswith('UPDATE') and 'hot_score' in q['sql']])
+        post.refresh_from_db()
+        self.assertAlmostEqual(post.hot_score, ranking.hot_score(0, post.created_at), places=4)
+
+    def test_refresh_updates_the_touched_posts_in_batches(self):
+        posts = [make_post(self.community, self.user, title=f'Post {n}') for n in range(5)]
+        for post in posts[:3]:
+            for _ in range(10):
+                make_comment(post, self.user)
+        with mock.patch.object(ranking, 'BATCH_SIZE', 2), CaptureQueriesContext(connections['default']) as queries:
+            self.assertEqual(ranking.refresh_scores()[1], 5)
+        # Five posts at two per UPDATE
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('UPDATE "application_post"')]), 3)
+        for post in posts:
+            post.refresh_from_db()
+            self.assertAlmostEqual(post.hot_score, ranking.hot_score(post.comment_count, post.created_at), places=6)
+        self.assertEqual(posts[0].comment_count, 10)
+        self.assertGreater(posts[0].hot_score, posts[4].hot_score)
+
+
+# QUERY BUDGETS
+# Every route of application.benchmark against seeded data. The budgets must
+# hold at any amount of data, so the data is big enough for an N+1 to show:
+# medium's posts and comments, many pages of each, with fewer follows since
+# each one backfills a timeline. QUERY_BUDGET_SCALE names a SCALES entry to
+# run it at instead (large takes about a quarter of an hour on SQLite)
+BUDGET_SCALE = dict(SCALES['medium'], users=100, follows=5)
+
+
+class QueryBudgetTests(QueryBudgetAssertions, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        scale = os.environ.get('QUERY_BUDGET_SCALE')
+        seed(**(SCALES[scale] if scale else BUDGET_SCALE))
+
+    def test_every_route_is_within_its_budget(self):
+        self.assertEqual(uncovered_url_names(), [])
+        self.assertEqual(unbudgeted_url_names(), [])
+        self.assertRoutesWithinBudget(run_routes(iterations=1, warmup=0))
+
+    def test_assert_within_budget(self):
+        client = logged_in(benchmark_context()['user'])
+        with self.assertWithinBudget('home'):
+            self.assertEqual(client.get(reverse('home')).status_code, 200)
+        with self.assertRaises(AssertionError):
+            with self.assertWithinBudget('conduct') as counter:
+                client.get(reverse('home'))
+        self.assertGreater(counter.count, budget_for('conduct'))
+
+    def test_deleting_an_account_is_exempt(self):
+        user = benchmark_context()['user']
+        self.assertIsNone(budget_for('delete_user', 'POST'))
+        response = logged_in(user).get(reverse('delete_user', args=[user.id]))
+        self.assertEqual(response.status_code, 200)
+        # The confirmation page doesn't delete anything
+        self.assertTrue(User.objects.filter(pk=user.pk).exists())
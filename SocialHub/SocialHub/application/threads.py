@@ -0,0 +1,73 @@
+from django.db.models import F
+from . import sharding
+from .models import Comment
+
+# THREADED COMMENTS
+# Comment.path is the chain of ids from the top-level comment down to the
+# comment itself, each zero-padded to SEGMENT_WIDTH digits. Sorting by path
+# gives depth-first thread order, and a comment's subtree is every path in
+# [path, next sibling path): one range scan on (post, path)
+
+# Digits of the largest bigint id, so ids from any shard's range (see
+# sharding.SHARD_ID_SPAN) fit
+SEGMENT_WIDTH = 19
+# Replies to a comment this deep become siblings of it instead
+MAX_DEPTH = 6
+THREADS_PER_PAGE = 20
+REPLIES_PER_PAGE = 50
+
+
+def segment(comment_id):
+    return str(comment_id).zfill(SEGMENT_WIDTH)
+
+
+def subtree_upper_bound(path):
+    # The smallest path after every descendant of path. Paths are digits only,
+    # so this compares the same under any collation
+    return str(int(path) + 1).zfill(len(path))
+
+
+def ancestor_ids(path):
+    return [int(path[start:start + SEGMENT_WIDTH]) for start in range(0, len(path) - SEGMENT_WIDTH, SEGMENT_WIDTH)]
+
+
+def reply_parent(parent):
+    # Where a reply to `parent` is attached, keeping threads at most MAX_DEPTH deep
+    while parent is not None and parent.depth >= MAX_DEPTH:
+        parent = parent.parent
+    return parent
+
+
+def assign_path(comment):
+    # Called once the comment has an id (post_save); also counts the new
+    # reply on every ancestor with one UPDATE
+    if comment.parent_id:
+        parent_path, depth = Comment.objects.filter(pk=comment.parent_id).values_list('path', 'depth').get()
+        comment.path, comment.depth = parent_path + segment(comment.pk), depth + 1
+    else:
+        comment.path, comment.depth = segment(comment.pk), 0
+    Comment.objects.filter(pk=comment.pk).update(path=comment.path, depth=comment.depth)
+    ancestors = ancestor_ids(comment.path)
+    if ancestors:
+        Comment.objects.filter(pk__in=ancestors).update(reply_count=F('reply_count') + 1)
+
+
+def forget_reply(comment):
+    # post_delete: ancestors still there lose one reply (and its own replies,
+    # which are deleted with it and come through here too)
+    ancestors = ancestor_ids(comment.path) if comment.path else []
+    if ancestors:
+        Comment.objects.filter(pk__in=ancestors, reply_count__gt=0).update(reply_count=F('reply_count') - 1)
+
+
+def subtree(comment, after=None, limit=REPLIES_PER_PAGE):
+    # Descendants of comment in thread order, `limit` at a time after the
+    # given path; returns (replies, path to continue after or None)
+    replies = Comment.objects.filter(
+        post_id=comment.post_id, path__gt=after or comment.path, path__lt=subtree_upper_bound(comment.path),
+    ).order_by('path')
+    replies = sharding.related(replies, 'user')
+    rows = list(replies[:limit + 1])
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].path
+    return rows, None
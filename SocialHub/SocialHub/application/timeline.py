@@ -0,0 +1,108 @@
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from . import sharding
+from .models import Post, TimelineEntry
+from .pagination import KeysetPage, apaginate, paginate, PAGE_SIZE
+
+User = get_user_model()
+
+# How many of the followed user's latest posts are copied in on follow
+BACKFILL_LIMIT = 200
+BATCH_SIZE = 1000
+
+
+def _entries_for(post, user_ids):
+    return [
+        TimelineEntry(user_id=user_id, post_id=post.id, author_id=post.created_by_id, created_at=post.created_at)
+        for user_id in user_ids
+    ]
+
+
+def fan_out_post(post):
+    # Push a new post into the timeline of everyone following its author
+    follower_ids = post.created_by.followed_by.values_list('id', flat=True)
+    TimelineEntry.objects.bulk_create(_entries_for(post, follower_ids), batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+def fan_out_posts(posts):
+    # fan_out_post for a batch (bulk import): one follower lookup for all authors
+    followers = {}
+    for author_id, follower_id in (User.following.through.objects
+                                   .filter(to_socialhubuser_id__in={post.created_by_id for post in posts})
+                                   .values_list('to_socialhubuser_id', 'from_socialhubuser_id')):
+        followers.setdefault(author_id, []).append(follower_id)
+    entries = []
+    for post in posts:
+        entries.extend(_entries_for(post, followers.get(post.created_by_id, ())))
+    TimelineEntry.objects.bulk_create(entries, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+def backfill_follow(follower, followed, limit=BACKFILL_LIMIT):
+    # The latest posts of followed on every shard
+    recent = ('-created_at', '-id')
+    posts = [post for posts in sharding.fan_out(
+        lambda: list(Post.objects.filter(created_by_id=followed.id).only('id', 'created_by_id', 'created_at').order_by(*recent)[:limit])
+    ) for post in posts]
+    posts = sharding.merged(posts, Post, recent)[:limit]
+    entries = [
+        TimelineEntry(user_id=follower.id, post_id=post.id, author_id=post.created_by_id, created_at=post.created_at)
+        for post in posts
+    ]
+    TimelineEntry.objects.bulk_create(entries, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+def prune_unfollow(follower, unfollowed):
+    TimelineEntry.objects.filter(user=follower, author=unfollowed).delete()
+
+
+def _entries(user):
+    entries = TimelineEntry.objects.filter(user=user)
+    if sharding.enabled():
+        return entries  # the posts are looked up on the shards (_sharded_posts)
+    return entries.select_related('post', 'post__community', 'post__created_by')
+
+
+def _sharded_posts(entries):
+    # The entries' posts, by id from every shard; a post deleted meanwhile is skipped
+    posts = sharding.in_bulk(Post.objects.all(), [entry.post_id for entry in entries])
+    posts = [posts[entry.post_id] for entry in entries if entry.post_id in posts]
+    prefetch_related_objects(posts, 'community', 'created_by')
+    return posts
+
+
+def get_timeline(user, request=None, param='cursor', page_size=PAGE_SIZE):
+    if not user.is_authenticated:
+        return KeysetPage([], None)
+    page = paginate(_entries(user), request, param=param, ordering=('-created_at', '-id'), page_size=page_size)
+    if sharding.enabled():
+        page.items = _sharded_posts(page.items)
+    else:
+        page.items = [entry.post for entry in page.items]
+    return page
+
+
+async def aget_timeline(user, request=None, param='cursor', page_size=PAGE_SIZE):
+    if not user.is_authenticated:
+        return KeysetPage([], None)
+    page = await apaginate(_entries(user), request, param=param, ordering=('-created_at', '-id'), page_size=page_size)
+    if sharding.enabled():
+        page.items = await sync_to_async(_sharded_posts)(page.items)
+    else:
+        page.items = [entry.post for entry in page.items]
+    return page
+
+
+def rebuild_timelines(users=None, limit=BACKFILL_LIMIT):
+    # Rebuild from scratch for the given users (all users by default)
+    if users is None:
+        users = User.objects.all()
+    rebuilt = 0
+    for user in users.iterator():
+        with transaction.atomic():
+            TimelineEntry.objects.filter(user=user).delete()
+            for followed in user.following.all():
+                backfill_follow(user, followed, limit=limit)
+        rebuilt += 1
+    return rebuilt
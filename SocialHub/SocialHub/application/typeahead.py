@@ -0,0 +1,58 @@
+from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connections, router
+from django.db.models import Case, IntegerField, Q, TextField, Value, When
+from django.db.models.functions import Cast, Upper
+from django.urls import reverse
+from .models import Community
+
+User = get_user_model()
+
+MIN_QUERY_LENGTH = 2
+MAX_RESULTS = 10
+
+# Searchable name column per suggestion type. On PostgreSQL each column has a
+# pg_trgm GIN index on UPPER(column::text), which is exactly what Django emits
+# for icontains/istartswith, so both prefix and substring matches are indexed
+SOURCES = {
+    'users': (User, 'username'),
+    'communities': (Community, 'name'),
+}
+
+
+def _uses_postgres(model):
+    return connections[router.db_for_read(model)].vendor == 'postgresql'
+
+
+def matching(model, field, term):
+    # Substring match on the indexed name column (used by search)
+    return model.objects.filter(**{f'{field}__icontains': term})
+
+
+def suggest(kind, term, limit=MAX_RESULTS):
+    # Prefix matches first, then fuzzy (trigram) matches on PostgreSQL or
+    # substring matches elsewhere
+    model, field = SOURCES[kind]
+    term = term.strip()
+    if len(term) < MIN_QUERY_LENGTH:
+        return []
+    prefix = Q(**{f'{field}__istartswith': term})
+    queryset = model.objects.annotate(
+        is_prefix=Case(When(prefix, then=Value(1)), default=Value(0), output_field=IntegerField()),
+    )
+    if _uses_postgres(model):
+        key = Upper(Cast(field, TextField()))
+        queryset = (queryset.annotate(key=key, similarity=TrigramSimilarity(key, term.upper()))
+                    .filter(prefix | Q(key__trigram_similar=term.upper()))
+                    .order_by('-is_prefix', '-similarity', field))
+    else:
+        queryset = queryset.filter(**{f'{field}__icontains': term}).order_by('-is_prefix', field)
+    return list(queryset.values_list('id', field)[:limit])
+
+
+def suggestions(kind, term, limit=MAX_RESULTS):
+    url_name = 'view_user' if kind == 'users' else 'community_content'
+    return [
+        {'id': pk, 'label': label, 'url': reverse(url_name, args=[pk])}
+        for pk, label in suggest(kind, term, limit)
+    ]
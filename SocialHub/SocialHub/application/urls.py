@@ -1,27 +1,40 @@
+from django.conf import settings
 from django.urls import path
 from . import views
+from . import async_views
+
+# The read-heavy pages come from async_views when running under uvicorn workers
+read_views = async_views if settings.ASYNC_VIEWS else views
 
 urlpatterns = [
-    path('', views.home, name="home"),
-    path('search/', views.search, name='search'),
+    path('', read_views.home, name="home"),
+    path('search/', read_views.search, name='search'),
+    path('typeahead/', views.typeahead, name='typeahead'),
     path('create/', views.create_community, name='create_community'),
-    path('community/<int:community_id>/', views.community_content, name='community_content'),
+    path('community/<int:community_id>/', read_views.community_content, name='community_content'),
+    path('community/<int:community_id>/locations/', views.community_locations, name='community_locations'),
+    path('community/<int:community_id>/events', views.community_events, name='community_events'),
     path('community/<int:community_id>/join/', views.join_community, name='join_community'),
     path('community/<int:community_id>/leave/', views.leave_community, name='leave_community'),
-    path('community/', views.list_communities, name='list_communities'),
+    path('community/', read_views.list_communities, name='list_communities'),
     path('community/<int:community_id>/manage/', views.manage_community, name='manage_community'),
+    path('community/<int:community_id>/manage/import', views.import_posts, name='import_posts'),
+    path('community/<int:community_id>/manage/export', views.export_community, name='export_community'),
     path('community/<int:community_id>/manage/create_template', views.create_template, name='create_template'),
     path('community/<int:community_id>/posts/<int:template_id>/create', views.create_post, name='create_post'),
-    path('community/<int:community_id>/posts/<int:post_id>/', views.view_post, name='view_post'),
+    path('community/<int:community_id>/posts/<int:post_id>/', read_views.view_post, name='view_post'),
+    path('community/<int:community_id>/posts/<int:post_id>/comments/<int:comment_id>/replies', views.comment_replies, name='comment_replies'),
+    path('community/<int:community_id>/posts/<int:post_id>/events', views.post_events, name='post_events'),
     path('community/<int:community_id>/posts/<int:post_id>/edit', views.edit_post, name='edit_post'),
     path('community/<int:community_id>/posts/<int:post_id>/delete', views.delete_post, name='delete_post'),
     path('community/<int:community_id>/manage/invite_users', views.invite_users, name='invite_users'),
     path('community/<int:community_id>/manage/<int:user_id>/add_moderator', views.add_moderator, name='add_moderator'),
     path('community/<int:community_id>/manage/<int:user_id>/remove_moderator', views.remove_moderator, name='remove_moderator'),
-    path('users/<int:user_id>', views.view_user, name='view_user'),
+    path('users/<int:user_id>', read_views.view_user, name='view_user'),
     path('users/<int:user_id>/delete', views.delete_user, name='delete_user'),
     path('users/<int:user_id>/follow', views.follow_user, name='follow_user'),
     path('users/<int:user_id>/unfollow', views.unfollow_user, name='unfollow_user'),
     path('code_of_conduct', views.conduct, name='conduct'),
+    path('metrics', views.metrics, name='metrics'),
     
 ]
\ No newline at end of file
@@ -0,0 +1,68 @@
+from django.contrib.auth import get_user_model
+from django.utils.functional import cached_property
+from .models import Community, CommunityMembership
+
+User = get_user_model()
+
+
+class ViewerContext:
+    # Everything about the current user that permission checks need, loaded
+    # once per request as ID sets (one query per set, on first use)
+
+    def __init__(self, user):
+        self.user = user
+        self.user_id = user.id if user.is_authenticated else None
+
+    def _ids(self, queryset):
+        if self.user_id is None:
+            return frozenset()
+        return frozenset(queryset)
+
+    @cached_property
+    def member_ids(self):
+        return self._ids(CommunityMembership.objects.filter(user_id=self.user_id).values_list('community_id', flat=True))
+
+    @cached_property
+    def admin_ids(self):
+        return self._ids(Community.admin.through.objects.filter(socialhubuser_id=self.user_id).values_list('community_id', flat=True))
+
+    @cached_property
+    def moderator_ids(self):
+        return self._ids(Community.moderator.through.objects.filter(socialhubuser_id=self.user_id).values_list('community_id', flat=True))
+
+    @cached_property
+    def invited_ids(self):
+        return self._ids(Community.invited.through.objects.filter(socialhubuser_id=self.user_id).values_list('community_id', flat=True))
+
+    @cached_property
+    def following_ids(self):
+        return self._ids(User.following.through.objects.filter(from_socialhubuser_id=self.user_id).values_list('to_socialhubuser_id', flat=True))
+
+    def preload(self, *names):
+        # Loads the given ID sets now, e.g. through sync_to_async before an
+        # async view reads them
+        for name in names:
+            getattr(self, name)
+
+    def is_member(self, community_id):
+        return community_id in self.member_ids
+
+    def is_admin(self, community_id):
+        return community_id in self.admin_ids
+
+    def is_moderator(self, community_id):
+        return community_id in self.moderator_ids
+
+    def is_invited(self, community_id):
+        return community_id in self.invited_ids
+
+    def is_following(self, user_id):
+        return user_id in self.following_ids
+
+
+def get_viewer(user):
+    # Reuse the context attached by ViewerContextMiddleware when there is one
+    viewer = getattr(user, 'viewer', None)
+    if viewer is None:
+        viewer = ViewerContext(user)
+    return viewer
@@ -1,47 +1,91 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import get_user_model
 from django import forms
 from .models import Community, CommunityMembership, Template, TemplateField, Post, Comment 
 from .forms import CommunityForm, TemplateForm, DynamicPostForm, CommentForm, InviteForm
 from django.core.serializers.json import DjangoJSONEncoder
-from django.http import HttpResponse
-from django.db.models import Count
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.conf import settings
+import asyncio
 import json
+import math
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
 from datetime import date
 from django.core.exceptions import PermissionDenied
-from django.core.files.storage import default_storage
+from .timeline import fan_out_post, backfill_follow, prune_unfollow, get_timeline
+from .viewer import get_viewer
+from .replicas import read_from_replica
+from .pagination import paginate
+from . import sharding
+from . import search as search_engine
+from .typeahead import SOURCES, MAX_RESULTS, suggestions
+from .field_types import compile_template
+from .filtering import filterable_fields, filter_from_query, index_field_values
+from . import geo
+from .images import queue_images, display_image
+from .importer import FORMATS as IMPORT_FORMATS, detect_format, import_posts as run_import
+from .exporter import FORMATS as EXPORT_FORMATS, export_lines
+from .pagination import encode_cursor, decode_cursor
+from . import threads
+from . import live
+from . import metrics as request_metrics
+import hmac
+
+FILTER_OPERATORS = [('eq', '='), ('gt', '>'), ('gte', '>='), ('lt', '<'), ('lte', '<='), ('between', 'between')]
 
 User = get_user_model()
 
+POPULAR_COMMUNITIES = 10
+LOCATIONS_PER_PAGE = 200
+IMPORT_ERRORS_SHOWN = 100
+# The web upload runs in the request; bigger files go through the
+# import_posts management command
+IMPORT_MAX_BYTES = 10 * 1024 * 1024
+IMPORT_MAX_ROWS = 5000
+# Live update streams: heartbeat interval, and how long one stays open before
+# the browser reconnects (Django 4.2 doesn't tell a streaming view that the
+# client went away, so streams end on their own)
+LIVE_HEARTBEAT_SECONDS = 15
+LIVE_STREAM_SECONDS = 300
+
+@read_from_replica
 def home(request):
-    posts = Post.objects.all().order_by('-created_at')
-    for post in posts:
-        post.is_followed = post.created_by.is_followed(request.user)
-    communities= Community.objects.annotate(num_members=Count('members')).order_by('-num_members')
-    followed_communities = [community for community in communities if community.is_member(request.user)]
-    return render(request, 'home.html', {'posts': posts, 'communities': communities, 'followed_communities': followed_communities})
-
+    # Newest posts of every shard, merged into one page
+    posts = sharding.paginate(Post.objects.all(), request, related_fields=('community', 'created_by'))
+    # Following column is read from the materialized timeline, not by scanning every post
+    following_posts = get_timeline(request.user, request, param='following_cursor')
+    # Stored member_count keeps the sidebar to one indexed ORDER BY
+    communities = Community.objects.exclude(isPrivate=True).order_by('-member_count', 'id')[:POPULAR_COMMUNITIES]
+    trending_communities = Community.objects.exclude(isPrivate=True).filter(trending_score__gt=0).order_by('-trending_score', 'id')[:POPULAR_COMMUNITIES]
+    followed_communities = Community.objects.filter(id__in=get_viewer(request.user).member_ids).order_by('-member_count', 'id')
+    return render(request, 'home.html', {'posts': posts, 'following_posts': following_posts, 'communities': communities, 'trending_communities': trending_communities, 'followed_communities': followed_communities})
+
+@read_from_replica
 @login_required
 def search(request):
-    if request.method == "POST":
-        searched = request.POST.get('searched', '').strip()
-
+    searched = (request.POST.get('searched') or request.GET.get('searched') or '').strip()
+    if request.method == "POST" or 'searched' in request.GET:
         if searched:
-            posts = Post.objects.filter(title__icontains=searched)
-            communities = Community.objects.filter(name__icontains=searched)
-            users = User.objects.filter(username__icontains=searched)
-            return render(request, 'search.html', {
-                'searched': searched,
-                'posts': posts,
-                'communities': communities,
-                'users': users
-            })
+            return render(request, 'search.html', {'searched': searched, **search_engine.search(request, searched)})
         else:
             return render(request, 'search.html', {'error': 'Please enter a search term.'})
     else:
         return render(request, 'search.html')
 
+@login_required
+def typeahead(request):
+    kind = request.GET.get('type', 'users')
+    if kind not in SOURCES:
+        return JsonResponse({'error': 'Unknown suggestion type.'}, status=400)
+    try:
+        limit = min(max(int(request.GET.get('limit', MAX_RESULTS)), 1), MAX_RESULTS)
+    except ValueError:
+        limit = MAX_RESULTS
+    return JsonResponse({'results': suggestions(kind, request.GET.get('q', ''), limit)})
+
 
 # COMMUNITY VIEWS BELOW    
 @login_required
@@ -56,18 +100,19 @@ def create_community(request):
             CommunityMembership.objects.create(community=community, user=request.user)
             community.moderator.add(request.user)  # Adding as admin
 
-            # Creating a default template for the new community
-            default_template = Template.objects.create(
-                title="Default Template",
-                description="This is a default template with Title and Description fields.",
-                community=community
-            )
+            # Creating a default template for the new community, on the shard it was placed on
+            with sharding.in_shard(community.shard):
+                default_template = Template.objects.create(
+                    title="Default Template",
+                    description="This is a default template with Title and Description fields.",
+                    community=community
+                )
 
-            TemplateField.objects.create(
-                template=default_template,
-                field_name='Description',
-                field_type='textArea'
-            )
+                TemplateField.objects.create(
+                    template=default_template,
+                    field_name='Description',
+                    field_type='textArea'
+                )
 
             return redirect('community_content', community_id=community.id)
     else:
@@ -75,14 +120,15 @@ def create_community(request):
     return render(request, 'create_community.html', {'form': form})
 
 
+@read_from_replica
 @login_required
 def community_content(request, community_id):
     community = get_object_or_404(Community, id=community_id)
     user = request.user
     user_is_member = community.is_member(user)
-    user_is_admin = community.admin.filter(id=user.id).exists()
+    user_is_admin = community.is_admin(user)
     is_private = community.isPrivate
-    user_is_invited = community.invited.filter(id=user.id).exists()
+    user_is_invited = community.is_invited(user)
 
     # If the community is private and the user is not a member or invited
     if is_private and not (user_is_member or user_is_invited):
@@ -91,7 +137,18 @@ def community_content(request, community_id):
     # Fetching templates related to the community directly
     templates = community.templates.all()
     # Fetching posts related to the community directly
-    posts = community.posts.all().order_by('-created_at')
+    sort = 'hot' if request.GET.get('sort') == 'hot' else 'new'
+    ordering = ('-hot_score', '-id') if sort == 'hot' else ('-created_at', '-id')
+    filter_fields = filterable_fields(community.id)
+    posts, active_filter, filter_error = filter_from_query(sharding.related(community.posts.all(), 'created_by'), filter_fields, request.GET)
+    posts = paginate(posts, request, ordering=ordering)
+    memberships = paginate(
+        CommunityMembership.objects.filter(community=community).select_related('user'),
+        request, param='members_cursor', ordering=('date_joined', 'id'),
+    )
+    # Roles of the listed members, so the member loop doesn't query per row
+    member_admin_ids = set(community.admin.values_list('id', flat=True))
+    member_moderator_ids = set(community.moderator.values_list('id', flat=True))
 
     return render(request, 'community.html', {
         'community': community,
@@ -101,8 +158,68 @@ def community_content(request, community_id):
         'user_is_invited': user_is_invited,
         'templates': templates,
         'posts': posts,
+        'sort': sort,
+        'filter_fields': filter_fields,
+        'filter_operators': FILTER_OPERATORS,
+        'active_filter': active_filter,
+        'filter_error': filter_error,
+        'memberships': memberships,
+        'member_admin_ids': member_admin_ids,
+        'member_moderator_ids': member_moderator_ids,
     })
 
+def _location_json(location):
+    row = {
+        'post_id': location.post_id,
+        'title': location.post.title,
+        'field': location.field_name,
+        'latitude': location.latitude,
+        'longitude': location.longitude,
+        'url': reverse('view_post', args=[location.community_id, location.post_id]),
+    }
+    if hasattr(location, 'distance_km'):
+        row['distance_km'] = round(location.distance_km, 3)
+    return row
+
+@login_required
+def community_locations(request, community_id):
+    # JSON for map views: ?bbox=south,west,north,east | ?lat=&lng=&radius=(km) | ?lat=&lng=&k=
+    community = get_object_or_404(Community, id=community_id)
+    if community.isPrivate and not (community.is_member(request.user) or community.is_invited(request.user)):
+        return JsonResponse({'error': 'This community is private.'}, status=403)
+    try:
+        if 'bbox' in request.GET:
+            south, west, north, east = [float(value) for value in request.GET['bbox'].split(',')]
+            if not all(math.isfinite(value) for value in (south, west, north, east)):
+                raise ValueError
+            page = paginate(geo.in_bbox(community.id, south, west, north, east).select_related('post'),
+                            request, ordering=('id',), page_size=LOCATIONS_PER_PAGE)
+            return JsonResponse({'results': [_location_json(location) for location in page], 'next': page.next_querystring or None})
+        latitude, longitude = float(request.GET['lat']), float(request.GET['lng'])
+        if not geo.valid_point(latitude, longitude):
+            raise ValueError
+        if 'k' in request.GET:
+            hits = geo.nearest(community.id, latitude, longitude, max(int(request.GET['k']), 1))
+            return JsonResponse({'results': [_location_json(location) for location in hits], 'next': None})
+        radius = float(request.GET['radius'])
+        if not 0 < radius < math.inf:
+            raise ValueError
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Pass bbox=south,west,north,east or lat, lng and radius (km) or k.'}, status=400)
+    # Radius results are ordered by distance; the cursor is the last (distance, id)
+    locations = geo.within_radius(community.id, latitude, longitude, radius).select_related('post')
+    after = decode_cursor(request.GET.get('cursor', ''))
+    if after and len(after) == 2 and isinstance(after[0], (int, float)) and isinstance(after[1], int):
+        locations = geo.after_distance(locations, *after)
+    hits = list(locations[:LOCATIONS_PER_PAGE + 1])
+    next_querystring = None
+    if len(hits) > LOCATIONS_PER_PAGE:
+        hits = hits[:LOCATIONS_PER_PAGE]
+        params = request.GET.copy()
+        params['cursor'] = encode_cursor([hits[-1].distance_km, hits[-1].id])
+        next_querystring = params.urlencode()
+    return JsonResponse({'results': [_location_json(location) for location in hits], 'next': next_querystring})
+
 @login_required
 def join_community(request, community_id):
     community = get_object_or_404(Community, id=community_id)
@@ -115,22 +232,18 @@ def leave_community(request, community_id):
     CommunityMembership.objects.filter(community=community, user=request.user).delete()
     return redirect('list_communities')
 
+@read_from_replica
 @login_required
 def list_communities(request):
     communities = Community.objects.all()
+    viewer = get_viewer(request.user)
     communities_data = []
     for community in communities:
-        is_member = request.user.is_member(community.id)
-        is_admin = community.admin.filter(id=request.user.id).exists()
-        if request.user in community.invited.all():
-            is_invited = True
-        else:
-            is_invited = False
         communities_data.append({
             'community': community,
-            'is_member': is_member,
-            'is_invited': is_invited,
-            'is_admin': is_admin,
+            'is_member': viewer.is_member(community.id),
+            'is_invited': viewer.is_invited(community.id),
+            'is_admin': viewer.is_admin(community.id),
         })
     return render(request, 'list_communities.html', {'communities': communities_data})
 
@@ -160,6 +273,51 @@ def manage_community(request, community_id):
     community = get_object_or_404(Community, id=community_id)
     return render (request, 'manage_community.html', {'community': community})
 
+@login_required
+def import_posts(request, community_id):
+    community = get_object_or_404(Community, id=community_id)
+    if not community.is_admin(request.user):
+        raise PermissionDenied
+    templates = community.templates.all()
+    context = {'community': community, 'templates': templates, 'formats': IMPORT_FORMATS, 'max_rows': IMPORT_MAX_ROWS}
+    if request.method == 'POST':
+        template = templates.filter(pk=request.POST.get('template')).first()
+        upload = request.FILES.get('file')
+        file_format = request.POST.get('format') or (detect_format(upload.name) if upload else None)
+        if template is None or upload is None or file_format not in IMPORT_FORMATS:
+            context['error'] = 'Choose a template and a .jsonl or .csv file.'
+        elif upload.size > IMPORT_MAX_BYTES:
+            context['error'] = f'Files over {IMPORT_MAX_BYTES // (1024 * 1024)} MB have to be imported by a site administrator.'
+        else:
+            errors = []
+
+            def on_error(number, message):
+                if len(errors) < IMPORT_ERRORS_SHOWN:
+                    errors.append((number, message))
+
+            # Uploads over FILE_UPLOAD_MAX_MEMORY_SIZE are spooled to disk by
+            # Django, so the file is read row by row either way
+            # Every post is created by the importing admin: the author column
+            # is only honoured by the management command
+            result = run_import(template, upload.file, file_format, request.user, on_error=on_error,
+                                max_rows=IMPORT_MAX_ROWS)
+            context.update({'result': result, 'errors': errors, 'template': template})
+    return render(request, 'import_posts.html', context)
+
+@login_required
+def export_community(request, community_id):
+    community = get_object_or_404(Community, id=community_id)
+    if not community.is_admin(request.user):
+        raise PermissionDenied
+    file_format = request.GET.get('format', 'jsonl')
+    if file_format not in EXPORT_FORMATS:
+        file_format = 'jsonl'
+    content_type = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+    # Streamed chunk by chunk, so big communities never sit in the worker's memory
+    response = StreamingHttpResponse(export_lines(community.id, file_format), content_type=f'{content_type}; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="community-{community.id}.{file_format}"'
+    return response
+
 def create_template(request, community_id):
     community = get_object_or_404(Community, pk=community_id)  # Fetching the community instance
 
@@ -196,45 +354,24 @@ def create_template(request, community_id):
 @login_required
 def create_post(request, community_id, template_id):
     template = get_object_or_404(Template, pk=template_id)
-    template_fields = list(template.fields.all().values('field_name', 'field_type'))
+    # Form class and serializer are compiled once per template version
+    compiled = compile_template(template)
 
     if request.method == 'POST':
-        form = DynamicPostForm(request.POST, request.FILES, template_fields=template_fields)
+        form = compiled.form_class(request.POST, request.FILES)
         if form.is_valid():
             new_post = form.save(commit=False)
             new_post.community_id = community_id
             new_post.created_by = request.user
-
-            # Handling JSON data
-            data = {}
-            for field in template_fields:
-                field_name = field['field_name']
-                field_value = form.cleaned_data.get(field_name)
-                # Handling data types one by one
-                if field['field_type'] == 'date' and field_value:
-                    field_value = field_value.isoformat()
-                elif field['field_type'] == 'time' and field_value:
-                    field_value = field_value.isoformat()
-                elif field['field_type'] == 'image' and field_value:
-                    file_path = default_storage.save(f'media/images/{field_value.name}', field_value)
-                    field_value = file_path
-                    data["image"] = field_value  
-                elif field['field_type'] == 'color' and field_value:
-                    data["color"] = field_value
-                elif field['field_type'] == 'geolocation':
-                    latitude = form.cleaned_data.get(field_name + '_latitude')
-                    longitude = form.cleaned_data.get(field_name + '_longitude')
-                    field_value = {
-                        'latitude': float(latitude) if latitude else None,
-                        'longitude': float(longitude) if longitude else None
-                    }
-                data[field_name] = field_value
-            
-            new_post.data = data
+            new_post.data = compiled.serialize(form.cleaned_data)
             new_post.save()
+            index_field_values(new_post, compiled.fields)
+            geo.index_locations(new_post, compiled.fields)
+            queue_images(new_post)
+            fan_out_post(new_post)
             return redirect('community_content', community_id=community_id)
     else:
-        form = DynamicPostForm(template_fields=template_fields)
+        form = compiled.form_class()
 
     return render(request, 'create_post.html', {
         'form': form,
@@ -243,11 +380,14 @@ def create_post(request, community_id, template_id):
         'template_id': template_id,
     })
 
+@read_from_replica
 def view_post(request, community_id, post_id):
     community = get_object_or_404(Community, pk=community_id)
     post = get_object_or_404(Post, pk=post_id)
     user_is_member = community.is_member(request.user)
-    comments = post.comments.all()
+    # Top-level comments only; their replies are loaded by comment_replies
+    comments = paginate(sharding.related(post.comments.filter(depth=0), 'user'), request,
+                        ordering=('path',), page_size=threads.THREADS_PER_PAGE)
 
     if isinstance(post.data, str):
         try:
@@ -261,6 +401,9 @@ def view_post(request, community_id, post_id):
             comment = form.save(commit=False)
             comment.post = post
             comment.user = request.user
+            parent_id = request.POST.get('parent', '')
+            if parent_id.isdigit():
+                comment.parent = threads.reply_parent(post.comments.filter(pk=parent_id).first())
             comment.save()
             return redirect('view_post', community_id=community_id, post_id=post_id)
     else:
@@ -272,8 +415,71 @@ def view_post(request, community_id, post_id):
         'comments': comments,
         'form': form,
         'user_is_member': user_is_member,
+        'post_image': display_image(post.data),
+    })
+
+def comment_replies(request, community_id, post_id, comment_id):
+    # HTML fragment with the next page of a comment's replies, in thread order
+    community = get_object_or_404(Community, pk=community_id)
+    comment = get_object_or_404(Comment, pk=comment_id, post_id=post_id, post__community_id=community_id)
+    after = request.GET.get('after', '')
+    if not (after.isdigit() and after.startswith(comment.path)):
+        after = None
+    replies, next_after = threads.subtree(comment, after)
+    for reply in replies:
+        reply.indent = reply.depth - comment.depth - 1
+    return render(request, 'comment_replies.html', {
+        'community_id': community_id,
+        'comment': comment,
+        'replies': replies,
+        'next_after': next_after,
+        'user_is_member': community.is_member(request.user),
     })
 
+def _can_follow_community(request, community_id, post_id=None):
+    # Whether the user may see the community's live updates, as in community_content
+    community = get_object_or_404(Community, pk=community_id)
+    if post_id is not None:
+        get_object_or_404(Post, pk=post_id, community_id=community_id)
+    return not community.isPrivate or community.is_member(request.user) or community.is_invited(request.user)
+
+
+async def _event_stream(channel):
+    broker = live.get_broker()
+    subscription = await broker.subscribe(channel)
+    try:
+        yield 'retry: 5000\n\n'
+        loop = asyncio.get_running_loop()
+        closes_at = loop.time() + LIVE_STREAM_SECONDS
+        while loop.time() < closes_at:
+            message = await subscription.get(LIVE_HEARTBEAT_SECONDS)
+            yield f'data: {message}\n\n' if message is not None else ': keepalive\n\n'
+    finally:
+        await broker.unsubscribe(subscription)
+
+
+async def _live_response(request, channel, community_id, post_id=None):
+    if not isinstance(request, ASGIRequest):
+        # A WSGI worker would be held for the whole stream; 204 tells
+        # EventSource not to reconnect
+        return HttpResponse(status=204)
+    if not await sync_to_async(_can_follow_community)(request, community_id, post_id):
+        raise PermissionDenied
+    response = StreamingHttpResponse(_event_stream(channel), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def post_events(request, community_id, post_id):
+    # Server-sent events: new comments on the post
+    return await _live_response(request, live.post_channel(post_id), community_id, post_id)
+
+
+async def community_events(request, community_id):
+    # Server-sent events: new posts in the community
+    return await _live_response(request, live.community_channel(community_id), community_id)
+
 @login_required
 def edit_post(request, community_id, post_id):
     community = get_object_or_404(Community, id=community_id)
@@ -292,12 +498,11 @@ def edit_post(request, community_id, post_id):
 def delete_post(request, community_id, post_id):
     community = get_object_or_404(Community, id=community_id)
     post = get_object_or_404(Post, id=post_id)
-    user = get_object_or_404(User, id=request.user.id)
     if request.method == "POST":
         post.delete(request.user)
         return redirect('community_content', community_id=community_id)
     
-    return render(request, 'delete_post.html', {'community': community, 'post': post, 'user': user})
+    return render(request, 'delete_post.html', {'community': community, 'post': post, 'user': request.user})
 
 @login_required
 def invite_users(request, community_id):
@@ -305,7 +510,7 @@ def invite_users(request, community_id):
     if request.method == 'POST':
         form = InviteForm(request.POST)
         if form.is_valid():
-            if request.user in community.admin.all():
+            if community.is_admin(request.user):
                 selected_users = form.cleaned_data['invited']
                 for user in selected_users:
                     community.invited.add(user)
@@ -318,33 +523,52 @@ def invite_users(request, community_id):
         form = InviteForm()
     return render(request, 'invite_users.html', {'form': form, 'community': community})
 
+@read_from_replica
 @login_required
 def view_user(request, user_id):
     user = get_object_or_404(User, pk=user_id)
     communities = user.get_communities()
-    following = user.following.all() 
-    followed_by = user.get_followers()
+    Follow = User.following.through
+    following = paginate(
+        Follow.objects.filter(from_socialhubuser=user).select_related('to_socialhubuser'),
+        request, param='following_cursor', ordering=('-id',),
+    )
+    followed_by = paginate(
+        Follow.objects.filter(to_socialhubuser=user).select_related('from_socialhubuser'),
+        request, param='followers_cursor', ordering=('-id',),
+    )
     return render(request, 'view_user.html', {'user': user, 'communities': communities, 'following': following, 'followed_by': followed_by})
 
 def conduct(request):
     return render(request, 'conduct.html')
 
+def metrics(request):
+    # Prometheus scrape endpoint: staff, or the METRICS_TOKEN bearer token
+    authorization = request.headers.get('Authorization', '')
+    token_ok = bool(settings.METRICS_TOKEN) and hmac.compare_digest(authorization, f'Bearer {settings.METRICS_TOKEN}')
+    if not (token_ok or request.user.is_staff):
+        raise PermissionDenied
+    return HttpResponse(request_metrics.render(request_metrics.collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @login_required
 def follow_user(request, user_id):
     user_to_follow = get_object_or_404(User, id=user_id)
-    request.user.follow(user_to_follow)
+    if user_to_follow != request.user:
+        request.user.follow(user_to_follow)
+        backfill_follow(request.user, user_to_follow)
     return redirect('view_user', user_id)
 
 @login_required
 def unfollow_user(request, user_id):
     user_to_unfollow = get_object_or_404(User, id=user_id)
-    request.user.unfollow(user_to_unfollow)
+    if user_to_unfollow != request.user:
+        request.user.unfollow(user_to_unfollow)
+        prune_unfollow(request.user, user_to_unfollow)
     return redirect('view_user', user_id)
 
 @login_required
 def delete_user(request, user_id):
     user = get_object_or_404(User, id=user_id)
-    request.user.delete(user)
     if request.method == "POST":
         user.delete(request.user)
         return redirect('home')
@@ -356,7 +580,7 @@ def add_moderator(request, community_id, user_id):
     community = get_object_or_404(Community, pk=community_id)
     user = get_object_or_404(User, pk=user_id)
 
-    if community.admin.filter(id=request.user.id).exists():
+    if community.is_admin(request.user):
         community.make_moderator(user)
         return redirect('community_content', community_id=community_id)
     else:
@@ -367,7 +591,7 @@ def remove_moderator(request, community_id, user_id):
     community = get_object_or_404(Community, pk=community_id)
     user = get_object_or_404(User, pk=user_id)
 
-    if community.admin.filter(id=request.user.id).exists():
+    if community.is_admin(request.user):
         community.remove_moderator(user)
         return redirect('community_content', community_id=community.id)
     else:
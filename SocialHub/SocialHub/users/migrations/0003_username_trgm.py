@@ -0,0 +1,18 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+from application.migration_utils import postgres_only
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_socialhubuser_following'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        postgres_only(
+            'CREATE INDEX users_socialhubuser_username_trgm ON users_socialhubuser USING gin ((UPPER(username::text)) gin_trgm_ops)',
+            'DROP INDEX IF EXISTS users_socialhubuser_username_trgm',
+        ),
+    ]
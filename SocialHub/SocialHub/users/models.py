@@ -9,11 +9,14 @@ def get_community_membership_model():
 # Create your models here.
 class SocialHubUser(AbstractUser):
     def is_member(self, community_id):
+        viewer = getattr(self, 'viewer', None)
+        if viewer is not None:
+            return viewer.is_member(community_id)
         CommunityMembership = get_community_membership_model()
         return CommunityMembership.objects.filter(community_id=community_id, user=self).exists()
     def get_communities(self):
         CommunityMembership = get_community_membership_model()
-        return [membership.community for membership in CommunityMembership.objects.filter(user=self)]
+        return [membership.community for membership in CommunityMembership.objects.filter(user=self).select_related('community')]
     
     # FOLLOW
     following = models.ManyToManyField('self', related_name='followed_by', symmetrical=False, blank=True)
@@ -27,9 +30,15 @@ class SocialHubUser(AbstractUser):
             self.following.remove(user)
 
     def is_following(self, user):
+        viewer = getattr(self, 'viewer', None)
+        if viewer is not None:
+            return viewer.is_following(user.id)
         return self.following.filter(id=user.id).exists()
     
     def is_followed(self, user):
+        viewer = getattr(user, 'viewer', None)
+        if viewer is not None:
+            return viewer.is_following(self.id)
         return self.followed_by.filter(id=user.id).exists()
 
     def get_followers(self):